@@ -0,0 +1,54 @@
+"""
+Compares the size of the test messages stored as they are, compressed with zlib on their own,
+and compressed with the raw_message dictionary using zlib and (when the zstandard package is
+installed) zstd, and how fast each can be decompressed. The dictionary was made from the test
+messages, so the same is done for synthetic messages from sensors.load_generator that it has not
+seen. Run from the top of the repository:
+
+PYTHONPATH=src python benchmarks/bench_compression.py
+"""
+import timeit
+import zlib
+from pathlib import Path
+
+from models.compression import CODEC_ZLIB, CODEC_ZSTD, compress_message, decompress_message, zstandard
+from sensors.load_generator import TrafficGenerator
+
+test_data_path = Path(__file__).parent.parent / "tests" / "testdata" / "messages.txt"
+
+
+def compare(title: str, messages):
+    raw_size = sum(len(x) for x in messages)
+    repeat = 20
+    print(f"{title}: {len(messages)} messages, {raw_size / len(messages):.0f} bytes each on average")
+    print(f"Decompression best of 5 runs of {repeat} passes")
+
+    plain = [zlib.compress(x, 9) for x in messages]
+    candidates = [("zlib, no dictionary", plain, zlib.decompress)]
+    codecs = [("zlib, dictionary", CODEC_ZLIB)]
+    if zstandard is not None:
+        codecs.append(("zstd, dictionary", CODEC_ZSTD))
+    for name, codec in codecs:
+        candidates.append((name, [compress_message(x, codec) for x in messages], decompress_message))
+
+    for name, stored, decompress in candidates:
+        assert [decompress(x) for x in stored] == messages
+
+        def decode_all():
+            for value in stored:
+                decompress(value)
+
+        size = sum(len(x) for x in stored)
+        best = min(timeit.repeat(decode_all, number=repeat, repeat=5))
+        rate = repeat * len(stored) / best
+        print(f"{name:20s} {size / len(stored):6.0f} bytes/message  "
+              f"{raw_size / size:5.1f}x smaller  {rate:10.0f} messages/s")
+
+
+def main():
+    compare("Test messages", test_data_path.read_bytes().splitlines())
+    compare("Synthetic messages", [payload for _, payload in TrafficGenerator(devices=100, seed=1).messages(2000)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Measures what deferring event.raw_message saves when the measurements are loaded as ORM
+objects: the bytes the database hands back for the query, and the peak Python memory of
+loading them, with the message deferred (the default) and with it loaded up front. The test
+messages are stored many times over in a temporary SQLite database. Run from the top of the
+repository:
+
+PYTHONPATH=src python benchmarks/bench_deferred_raw_message.py
+"""
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, undefer
+
+from models.migrations import upgrade_schema
+from models.models import TempHumidityMeasurement
+from sensors.db_streamer import Streamer
+
+test_data_path = Path(__file__).parent.parent / "tests" / "testdata" / "messages.txt"
+
+# How many times the test messages are stored
+COPIES = 40
+
+
+def fill_database(Session):
+    streamer = Streamer(Session)
+    records = [streamer.parse_message(x) for x in test_data_path.read_bytes().splitlines()]
+    records = [x for x in records if x is not None]
+    sensor_ids = [streamer.registry.ensure(x.device_id, x.device_name) for x in records]
+    session = Session()
+    try:
+        for copy in range(COPIES):
+            events = [x.to_event(y) for x, y in zip(records, sensor_ids)]
+            for event in events:
+                event.counter += copy * 100000
+            session.add_all(events)
+            session.commit()
+    finally:
+        session.close()
+    streamer.close()
+
+
+def bytes_read(engine, query) -> int:
+    """
+    Run the SQL of the query on the DBAPI connection and add up the size of what comes back
+    """
+    compiled = query.statement.compile(dialect=engine.dialect)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(str(compiled), [compiled.params[x] for x in compiled.positiontup])
+        total = 0
+        for row in cursor.fetchall():
+            for value in row:
+                total += len(value) if isinstance(value, (bytes, str)) else 8
+        return total
+    finally:
+        connection.close()
+
+
+def peak_memory(Session, options) -> int:
+    session = Session()
+    try:
+        tracemalloc.start()
+        measurements = session.query(TempHumidityMeasurement).options(*options).all()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert measurements
+        return peak
+    finally:
+        session.close()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine(f"sqlite:///{Path(folder) / 'lora.db'}")
+        upgrade_schema(engine)
+        Session = sessionmaker(bind=engine)
+        fill_database(Session)
+        session = Session()
+        count = session.query(TempHumidityMeasurement).count()
+        print(f"{count} measurements")
+        for name, options in [("raw_message deferred", []),
+                              ("raw_message loaded", [undefer(TempHumidityMeasurement.raw_message)])]:
+            read = bytes_read(engine, session.query(TempHumidityMeasurement).options(*options))
+            peak = peak_memory(Session, options)
+            print(f"{name:22s} {read / 1024:10.0f} KiB read  {peak / 1024:10.0f} KiB peak memory")
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Measures how many messages a second the feed stores, using synthetic traffic from
+sensors.load_generator rather than TTN. The messages are stored in a temporary SQLite database
+by a Streamer with the given options, either by calling on_message directly or through the
+local stand-in for the broker, which delivers them on a thread of its own as Paho does. Reports
+the messages per second, the latency of on_message, how long the flush at the end waited for
+buffered messages to be stored, and how much the database grew for each message. With
+--metrics-sample the Streamer keeps the metrics of sensors.metrics, to see what they cost, and
+their summary is printed. Run from the top of the repository:
+
+PYTHONPATH=src python benchmarks/bench_ingest.py --devices 1000 --messages 50000 --mode broker
+"""
+import argparse
+import logging
+import logging.config
+import os
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models.migrations import upgrade_schema
+from sensors.db_streamer import Streamer
+from sensors.load_generator import TrafficGenerator, LocalBroker, run_load
+from sensors.metrics import IngestMetrics, LogSummarySink, MetricsRegistry
+from sensors.mqtt_comms import MqttComms
+
+logging_configuration = Path(__file__).parent.parent / "public-config" / "logging.config"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Measure storing synthetic messages")
+    parser.add_argument("--devices", type=int, default=100, help="The number of simulated devices")
+    parser.add_argument("--messages", type=int, default=10000, help="The number of messages to send")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Messages per second to send at, 0 sends them as fast as they are taken")
+    parser.add_argument("--mode", choices=["direct", "broker"], default="direct",
+                        help="Call on_message directly, or deliver through the local broker")
+    parser.add_argument("--batch-size", type=int, default=0, help="The batch size of the Streamer")
+    parser.add_argument("--journal", action="store_true", help="Write the messages to a journal first")
+    parser.add_argument("--dedup-window", type=int, default=0, help="The dedup window of the Streamer")
+    parser.add_argument("--receptions", action="store_true", help="Store the gateway receptions")
+    parser.add_argument("--gateways", type=int, default=1, help="The number of gateways")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the traffic")
+    parser.add_argument("--metrics-sample", type=int, default=0,
+                        help="Keep metrics, timing one message in this many; default 0 is no metrics")
+    return parser.parse_args()
+
+
+def database_bytes(engine) -> int:
+    page_count = engine.execute("PRAGMA page_count").scalar()
+    page_size = engine.execute("PRAGMA page_size").scalar()
+    return page_count * page_size
+
+
+def main():
+    args = parse_arguments()
+    # Logged as the feed logs, see lolevel_mqtt_2
+    os.makedirs("target/logs", exist_ok=True)
+    logging.config.fileConfig(logging_configuration, disable_existing_loggers=False)
+    generator = TrafficGenerator(devices=args.devices, gateways=args.gateways, seed=args.seed)
+    messages = list(generator.messages(args.messages))
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        engine = create_engine(f"sqlite:///{folder / 'lora.db'}")
+        upgrade_schema(engine)
+        empty_bytes = database_bytes(engine)
+        registry = MetricsRegistry()
+        metrics = IngestMetrics(registry, sample_every=args.metrics_sample) if args.metrics_sample > 0 else None
+        streamer = Streamer(sessionmaker(bind=engine),
+                            batch_size=args.batch_size,
+                            dedup_window=args.dedup_window,
+                            capture_receptions=args.receptions,
+                            journal_folder=folder / "journal" if args.journal else None,
+                            metrics=metrics)
+        broker = None
+        if args.mode == "broker":
+            comms = MqttComms(cert_path=None, username="load", password="load", hostname="localhost", port=0,
+                              msg_listener=streamer)
+            broker = LocalBroker(comms)
+            broker.connect()
+        report = run_load(streamer, messages, rate=args.rate, broker=broker)
+        start = perf_counter()
+        streamer.flush()
+        drained = perf_counter() - start
+        streamer.close()
+        grown = database_bytes(engine) - empty_bytes
+        engine.dispose()
+        # The segments are sparse, count the blocks written rather than their size
+        journal_bytes = sum(os.stat(x).st_blocks * 512 for x in (folder / "journal").glob("*")) \
+            if args.journal else 0
+
+    print(f"{report.messages} messages from {args.devices} devices, {args.mode}")
+    print(f"{report.messages_per_second:10.0f} messages/s over {report.seconds:.2f} s")
+    print(f"latency p50 {1e6 * report.latency_p50:8.0f} us  p99 {1e6 * report.latency_p99:8.0f} us  "
+          f"max {1e6 * report.latency_max:8.0f} us")
+    print(f"waited {drained:.2f} s for the rest to be stored, "
+          f"{report.messages / (report.seconds + drained):.0f} messages/s stored")
+    print(f"database grew {grown / 1e6:.1f} MB, {grown / max(1, report.messages):.0f} bytes a message")
+    if args.journal:
+        print(f"journal takes {journal_bytes / 1e6:.1f} MB of disk")
+    if metrics is not None:
+        print("\n".join(LogSummarySink(registry).summary()))
+
+
+if __name__ == "__main__":
+    main()
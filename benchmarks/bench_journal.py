@@ -0,0 +1,59 @@
+"""
+Measures how long Streamer.on_message takes, which is how long the MQTT thread is held up for
+each message, when each message is stored as it arrives and when it is written to the journal
+and stored by the applier. The test messages are stored in a temporary SQLite database. Run
+from the top of the repository:
+
+PYTHONPATH=src python benchmarks/bench_journal.py
+"""
+import logging
+import logging.config
+import os
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models.migrations import upgrade_schema
+from sensors.db_streamer import Streamer
+
+test_data_path = Path(__file__).parent.parent / "tests" / "testdata" / "messages.txt"
+
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+logging_configuration = Path(__file__).parent.parent / "public-config" / "logging.config"
+
+
+def time_messages(folder: Path, name: str, **kwargs):
+    engine = create_engine(f"sqlite:///{folder / (name + '.db')}")
+    upgrade_schema(engine)
+    streamer = Streamer(sessionmaker(bind=engine), **kwargs)
+    times = []
+    for line in test_data_path.read_bytes().splitlines():
+        start = perf_counter()
+        streamer.on_message(topic, line)
+        times.append(perf_counter() - start)
+    start = perf_counter()
+    streamer.flush()
+    drained = perf_counter() - start
+    streamer.close()
+    times.sort()
+    print(f"{name:10s} mean {1e6 * sum(times) / len(times):8.0f} us  "
+          f"p99 {1e6 * times[int(0.99 * len(times))]:8.0f} us  "
+          f"waited {drained:6.2f} s for the rest to be stored")
+
+
+def main():
+    # Logged as the feed logs, see lolevel_mqtt_2
+    os.makedirs("target/logs", exist_ok=True)
+    logging.config.fileConfig(logging_configuration, disable_existing_loggers=False)
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        time_messages(folder, "direct")
+        time_messages(folder, "journal", journal_folder=folder / "journal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures how the messages stored per second scale with the number of worker processes of
+sensors.sharded_streamer, against one Streamer in this process with the same options. The
+synthetic traffic from sensors.load_generator is stored in a new temporary SQLite database
+for each run, or in the database given by URL, which should be empty. SQLite allows one writer
+at a time, so with it only the parsing and dedup are spread over the workers; a server
+database also spreads the writes. The time is from the first message until all of them have
+been stored. Run from the top of the repository:
+
+PYTHONPATH=src python benchmarks/bench_sharded.py --workers 1 2 4 --messages 20000
+"""
+import argparse
+import logging
+import logging.config
+import os
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models.migrations import upgrade_schema
+from models.models import LoraEvent, Reception
+from sensors.db_streamer import Streamer
+from sensors.load_generator import TrafficGenerator
+from sensors.sharded_streamer import ShardedStreamer
+
+logging_configuration = Path(__file__).parent.parent / "public-config" / "logging.config"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Measure storing synthetic messages with worker processes")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="The numbers of workers to try")
+    parser.add_argument("--devices", type=int, default=200, help="The number of simulated devices")
+    parser.add_argument("--messages", type=int, default=10000, help="The number of messages to send")
+    parser.add_argument("--batch-size", type=int, default=100, help="The batch size of each Streamer")
+    parser.add_argument("--dedup-window", type=int, default=32, help="The dedup window of each Streamer")
+    parser.add_argument("--db-url", help="An empty database to use instead of temporary SQLite databases")
+    return parser.parse_args()
+
+
+def clear_events(engine) -> None:
+    # Left by the run before when a database URL is given
+    engine.execute(Reception.__table__.delete())
+    engine.execute(LoraEvent.__table__.delete())
+
+
+def time_run(name: str, streamer, messages) -> float:
+    # Waits for the workers to start, so that is not counted
+    streamer.flush()
+    start = perf_counter()
+    for topic, payload in messages:
+        streamer.on_message(topic, payload)
+    streamer.flush()
+    seconds = perf_counter() - start
+    streamer.close()
+    print(f"{name:12s} {len(messages) / seconds:10.0f} messages/s  {seconds:6.2f} s")
+    return seconds
+
+
+def main():
+    args = parse_arguments()
+    # Logged as the feed logs, see lolevel_mqtt_2
+    os.makedirs("target/logs", exist_ok=True)
+    logging.config.fileConfig(logging_configuration, disable_existing_loggers=False)
+    messages = list(TrafficGenerator(devices=args.devices).messages(args.messages))
+    options = dict(batch_size=args.batch_size, dedup_window=args.dedup_window)
+    with tempfile.TemporaryDirectory() as folder:
+        def database(name: str) -> str:
+            db_url = args.db_url or f"sqlite:///{Path(folder) / (name + '.db')}"
+            engine = create_engine(db_url)
+            upgrade_schema(engine)
+            clear_events(engine)
+            engine.dispose()
+            return db_url
+
+        db_url = database("streamer")
+        engine = create_engine(db_url)
+        base = time_run("streamer", Streamer(sessionmaker(bind=engine), **options), messages)
+        engine.dispose()
+        for workers in args.workers:
+            seconds = time_run(f"{workers} workers",
+                               ShardedStreamer(database(f"workers-{workers}"), workers=workers, **options),
+                               messages)
+            print(f"{'':12s} {base / seconds:10.2f} times one Streamer")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Compares parsing the metadata.time of the test messages with dateutil (what parseiso8601
+used to do), with the parseiso8601 fast path and with the numpy column parser. Run from
+the top of the repository:
+
+PYTHONPATH=src python benchmarks/bench_timestamps.py
+"""
+import timeit
+from datetime import timezone
+from pathlib import Path
+
+from dateutil import parser as dp
+
+from sensors.uplink_decoder import decode_uplink
+from utils.date_time_utils import parseiso8601, parseiso8601_array
+
+test_data_path = Path(__file__).parent.parent / "tests" / "testdata" / "messages.txt"
+
+
+def main():
+    times = [decode_uplink(x).metadata.time for x in test_data_path.read_bytes().splitlines()]
+    repeat = 50
+
+    def dateutil_parse():
+        for value in times:
+            dp.parse(value).astimezone(timezone.utc)
+
+    def fast_path():
+        for value in times:
+            parseiso8601(value)
+
+    def column():
+        parseiso8601_array(times)
+
+    print(f"{len(times)} timestamps, best of 5 runs of {repeat} passes")
+    results = {}
+    for name, function in [("dateutil", dateutil_parse),
+                           ("parseiso8601", fast_path),
+                           ("parseiso8601_array", column)]:
+        best = min(timeit.repeat(function, number=repeat, repeat=5))
+        per_value_us = best / (repeat * len(times)) * 1e6
+        results[name] = per_value_us
+        print(f"{name:20s} {per_value_us:8.2f} us/timestamp")
+    print(f"Speed up {results['dateutil'] / results['parseiso8601']:.1f}x, "
+          f"column {results['dateutil'] / results['parseiso8601_array']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
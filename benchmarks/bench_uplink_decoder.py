@@ -0,0 +1,46 @@
+"""
+Compares the time to decode the test messages with the old namedtuple decoder and with
+sensors.uplink_decoder. Run from the top of the repository:
+
+PYTHONPATH=src python benchmarks/bench_uplink_decoder.py
+"""
+import json
+import timeit
+from pathlib import Path
+
+from sensors.db_streamer import customMeasurementDecoder
+from sensors.uplink_decoder import decode_uplink, json_loads
+
+test_data_path = Path(__file__).parent.parent / "tests" / "testdata" / "messages.txt"
+
+
+def main():
+    messages = test_data_path.read_bytes().splitlines()
+    repeat = 20
+
+    def namedtuple_decoder():
+        for payload in messages:
+            json.loads(payload, object_hook=customMeasurementDecoder)
+
+    def json_only():
+        for payload in messages:
+            json_loads(payload)
+
+    def uplink_decoder():
+        for payload in messages:
+            decode_uplink(payload)
+
+    print(f"{len(messages)} messages, best of 5 runs of {repeat} passes, JSON parser is {json_loads.__module__}")
+    results = {}
+    for name, function in [("namedtuple decoder", namedtuple_decoder),
+                           ("JSON parse only", json_only),
+                           ("uplink decoder", uplink_decoder)]:
+        best = min(timeit.repeat(function, number=repeat, repeat=5))
+        per_message_us = best / (repeat * len(messages)) * 1e6
+        results[name] = per_message_us
+        print(f"{name:20s} {per_message_us:8.2f} us/message {1e6 / per_message_us:10.0f} messages/s")
+    print(f"Speed up {results['namedtuple decoder'] / results['uplink decoder']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Compression of the raw TTN messages stored in event.raw_message. The messages are small and
+nearly all the same, so on their own they hardly compress; primed with a dictionary of typical
+messages they shrink to around a fifth of their size. That is measured on messages the dictionary
+was not made from; the test messages it was made from shrink to about a ninth.
+
+A compressed value starts with two bytes: the codec (zlib, or zstd when the zstandard package
+is installed) and the id of the dictionary. A value that starts with any other byte is an
+uncompressed message, as stored before compression was added, and is returned as it is.
+Normally that is '{', but a message stored with leading whitespace or a byte order mark is
+read back too.
+
+A dictionary must never change once rows have been written with it; to use a better one add
+it with a new id and run th_recompress_messages.py.
+"""
+import json
+import logging
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on what is installed
+    zstandard = None
+
+# Not compressed, only used to turn compression off again with th_recompress_messages.py
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_NAMES = {CODEC_NONE: "none", CODEC_ZLIB: "zlib", CODEC_ZSTD: "zstd"}
+
+# The dictionaries, by id. They are the messages of build_dictionary, one per line.
+DICTIONARIES = {1: "raw_message_dictionary_1.jsonl"}  # type: Dict[int, str]
+CURRENT_DICTIONARY = 1
+
+# zlib only looks back this far, so a longer dictionary is no use
+ZLIB_WINDOW = 32 * 1024
+
+# The default levels of zlib and zstd for messages stored as they arrive, and the highest for
+# th_recompress_messages.py, where the time taken matters less
+LIVE_LEVELS = {CODEC_ZLIB: 6, CODEC_ZSTD: 3}
+RECOMPRESS_LEVEL = 9
+
+_JSON_START = ord('{')
+_COMPRESSED_CODECS = (CODEC_ZLIB, CODEC_ZSTD)
+
+
+def default_codec() -> int:
+    """
+    :return: zstd if the zstandard package is installed, otherwise zlib
+    """
+    return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+
+@lru_cache(maxsize=None)
+def load_dictionary(dictionary_id: int) -> bytes:
+    """
+    :param dictionary_id: The id of the dictionary
+    :return: The dictionary
+    """
+    file_name = DICTIONARIES.get(dictionary_id)
+    if file_name is None:
+        raise ValueError(f"Unknown raw_message dictionary {dictionary_id}")
+    return (Path(__file__).parent / file_name).read_bytes()
+
+
+@lru_cache(maxsize=None)
+def _zstd_dictionary(dictionary_id: int):
+    return zstandard.ZstdCompressionDict(load_dictionary(dictionary_id),
+                                         dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+def _require_zstd():
+    if zstandard is None:
+        raise RuntimeError("This message was compressed with zstd, install the zstandard package to read it")
+
+
+def compress_message(message: bytes, codec: int = None, dictionary_id: int = CURRENT_DICTIONARY,
+                     level: int = None) -> bytes:
+    """
+    Compress a raw message for storing
+    :param message: The JSON message
+    :param codec: CODEC_ZLIB or CODEC_ZSTD, default is default_codec(); CODEC_NONE
+    returns the message as it is
+    :param dictionary_id: The dictionary to use, default is the current one
+    :param level: The compression level, default is the one in LIVE_LEVELS for the codec
+    :return: The compressed message with its two byte header
+    """
+    if codec is None:
+        codec = default_codec()
+    if codec == CODEC_NONE:
+        return message
+    if level is None:
+        level = LIVE_LEVELS.get(codec)
+    dictionary = load_dictionary(dictionary_id)
+    header = bytes((codec, dictionary_id))
+    if codec == CODEC_ZLIB:
+        # Raw deflate, the header already says what this is
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zdict=dictionary[-ZLIB_WINDOW:])
+        return header + compressor.compress(message) + compressor.flush()
+    if codec == CODEC_ZSTD:
+        _require_zstd()
+        compressor = zstandard.ZstdCompressor(level=level, dict_data=_zstd_dictionary(dictionary_id),
+                                              write_content_size=True, write_checksum=False,
+                                              write_dict_id=False)
+        return header + compressor.compress(message)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompress_message(value: bytes) -> bytes:
+    """
+    Get back the raw message
+    :param value: The stored value, compressed or not
+    :return: The JSON message
+    """
+    if stored_format(value) is None:
+        if value and value[0] != _JSON_START:
+            logging.getLogger("lora.mqtt").warning(f"A stored message starts with byte {value[0]}, "
+                                                   f"reading it as not compressed")
+        return value
+    codec, dictionary_id = value[0], value[1]
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj(-15, zdict=load_dictionary(dictionary_id)[-ZLIB_WINDOW:])
+        return decompressor.decompress(value[2:]) + decompressor.flush()
+    if codec == CODEC_ZSTD:
+        _require_zstd()
+        decompressor = zstandard.ZstdDecompressor(dict_data=_zstd_dictionary(dictionary_id))
+        return decompressor.decompress(value[2:])
+
+
+def stored_format(value: bytes) -> Optional[tuple]:
+    """
+    :param value: The stored value
+    :return: The codec and dictionary id, or None if the value is not compressed
+    """
+    if len(value) < 2 or value[0] not in _COMPRESSED_CODECS:
+        return None
+    return value[0], value[1]
+
+
+def build_dictionary(messages: Iterable[bytes], max_size: int = ZLIB_WINDOW) -> bytes:
+    """
+    Make a dictionary from one example of each kind of message: each device, message type,
+    sensor event type and first copy or retry. This is how the shipped dictionaries were made,
+    from tests/testdata/messages.txt.
+    :param messages: Messages as received
+    :param max_size: The most bytes to keep, the first examples are dropped beyond this
+    :return: The dictionary, the examples one per line
+    """
+    examples = {}
+    for message in messages:
+        msg = json.loads(message)
+        fields = msg.get('payload_fields') or {}
+        key = (msg.get('dev_id'), fields.get('msgtype'), fields.get('sensor_event_type'), msg.get('is_retry', False))
+        examples.setdefault(key, message.strip())
+    return b"\n".join(examples.values())[-max_size:] + b"\n"
@@ -0,0 +1,136 @@
+"""
+Brings the schema of an existing database up to date with the models. SQLAlchemy's
+create_all makes missing tables but does not touch tables that are already there, so
+anything added to an existing table since it was made is added here.
+"""
+import logging
+from typing import List, NamedTuple
+
+from sqlalchemy import inspect, select, bindparam, type_coerce, LargeBinary
+from sqlalchemy.engine import Engine
+
+from models.compression import CODEC_NONE, CURRENT_DICTIONARY, RECOMPRESS_LEVEL, compress_message, \
+    decompress_message, default_codec, stored_format
+from models.models import Base, LoraEvent
+
+
+def add_missing_columns(engine: Engine) -> List[str]:
+    """
+    Add any nullable column declared in the models that is not yet in the database.
+    Columns that cannot be null need a default and are not handled here.
+    :param engine: The database engine
+    :return: The names of the columns added, as table.column
+    """
+    logger = logging.getLogger("lora.mqtt")
+    inspector = inspect(engine)
+    table_names = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        existing = {x['name'] for x in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable or column.primary_key:
+                raise RuntimeError(f"Cannot add column {table.name}.{column.name} to an existing table")
+            logger.info(f"Adding column {column.name} to {table.name}")
+            column_type = column.type.compile(dialect=engine.dialect)
+            engine.execute(f"ALTER TABLE {preparer.format_table(table)} "
+                           f"ADD COLUMN {preparer.format_column(column)} {column_type}")
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def create_missing_indexes(engine: Engine) -> List[str]:
+    """
+    Create any index declared in the models that is not yet in the database
+    :param engine: The database engine
+    :return: The names of the indexes created
+    """
+    logger = logging.getLogger("lora.mqtt")
+    inspector = inspect(engine)
+    table_names = set(inspector.get_table_names())
+    created = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        existing = {x['name'] for x in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"Creating index {index.name} on {table.name}, this can take a while")
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
+
+
+def upgrade_schema(engine: Engine) -> None:
+    """
+    Create missing tables and bring existing ones up to date. Use this in place of
+    Base.metadata.create_all
+    :param engine: The database engine
+    :return: None
+    """
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    create_missing_indexes(engine)
+
+
+class RecompressReport(NamedTuple):
+    """
+    What recompress_messages did
+    """
+    rows_read: int
+    rows_rewritten: int
+    bytes_before: int
+    bytes_after: int
+
+
+def recompress_messages(engine: Engine, codec: int = None, batch_size: int = 1000) -> RecompressReport:
+    """
+    Rewrite the stored raw messages that are not in the given format, e.g. those stored before
+    compression was added. They are compressed at RECOMPRESS_LEVEL, higher than when the
+    messages are stored as they arrive. Rows are read in id order in batches, each batch in its
+    own transaction, so this can be stopped and run again.
+    :param engine: The database engine
+    :param codec: The codec from models.compression, default is the best one installed;
+    CODEC_NONE stores the messages uncompressed
+    :param batch_size: The number of rows read and written in one transaction
+    :return: The counts of rows and bytes
+    """
+    logger = logging.getLogger("lora.mqtt")
+    if codec is None:
+        codec = default_codec()
+    target = None if codec == CODEC_NONE else (codec, CURRENT_DICTIONARY)
+    events = LoraEvent.__table__
+    # The stored bytes, not what the CompressedBlob column type makes of them
+    stored = type_coerce(events.c.raw_message, LargeBinary).label('stored')
+    update = events.update() \
+        .where(events.c.id == bindparam('event_id')) \
+        .values(raw_message=bindparam('stored', type_=LargeBinary))
+    rows_read = rows_rewritten = bytes_before = bytes_after = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(select([events.c.id, stored])
+                                      .where(events.c.id > last_id)
+                                      .order_by(events.c.id)
+                                      .limit(batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            changes = []
+            for row in rows:
+                value = bytes(row.stored)
+                bytes_before += len(value)
+                if stored_format(value) != target:
+                    value = compress_message(decompress_message(value), codec, level=RECOMPRESS_LEVEL)
+                    changes.append({'event_id': row.id, 'stored': value})
+                bytes_after += len(value)
+            if changes:
+                connection.execute(update, changes)
+            rows_read += len(rows)
+            rows_rewritten += len(changes)
+        logger.info(f"Recompressed {rows_rewritten} of {rows_read} messages")
+    return RecompressReport(rows_read, rows_rewritten, bytes_before, bytes_after)
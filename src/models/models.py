@@ -3,14 +3,15 @@ This is the ORM mapping, it maps classes to tables using SQLAlchemy mapping
 The message classes form a hierarchy. This is mapped to the database using
 "Single Table Inheritance" described here: https://docs.sqlalchemy.org/en/13/orm/inheritance.html
 """
-from enum import Enum
+from enum import Enum, IntEnum
 from datetime import timezone, datetime
 
-from sqlalchemy import types, Column, Integer, Float, String, ForeignKey, LargeBinary
+from sqlalchemy import types, Column, Integer, SmallInteger, Float, String, ForeignKey, Index, Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.types import Enum as SQLAlchemyEnumType
 
+from models.compression import compress_message, decompress_message
 from utils.date_time_utils import formatiso8601
 
 
@@ -36,6 +37,28 @@ class CustomDateTime(types.TypeDecorator):
             return datetime.fromtimestamp(value, timezone.utc)
 
 
+class CompressedBlob(types.TypeDecorator):
+    """
+    Stores a raw message compressed with a dictionary of typical messages, see
+    models.compression. Values stored before compression was added are read as they are.
+    """
+
+    impl = types.LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        return compress_message(bytes(value))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decompress_message(bytes(value))
+
+
 Base = declarative_base()
 
 
@@ -106,9 +129,31 @@ class LoraEvent(Base):
 
     timestamp = Column(CustomDateTime, nullable=False)
     counter = Column(Integer, nullable=False)
-    raw_message = Column(LargeBinary, nullable=False)
+    # Only loaded when it is used, or up front with .options(undefer(LoraEvent.raw_message)),
+    # so queries for the readings do not read the messages as well
+    raw_message = deferred(Column(CompressedBlob, nullable=False))
     sensor_id = Column(String(16), ForeignKey('sensor.device_id'))
     sensor = relationship("Sensor", back_populates="events")
+    # How many more copies of a confirmed uplink were folded into this row, and the best
+    # signal of any copy at any gateway. Copies are only folded when the feed suppresses
+    # them, see sensors.dedup
+    retry_count = Column(Integer, nullable=True)
+    best_rssi = Column(Float, nullable=True)
+    best_snr = Column(Float, nullable=True)
+    # The period the message was received in, see sensors.dedup.time_bucket_of. Null
+    # unless copies are suppressed, so the unique index does not apply to those rows
+    time_bucket = Column(Integer, nullable=True)
+
+    # The analysis tools get the events of one sensor, of one type or all types, in
+    # time or counter order; these indexes let them do that without scanning the table.
+    # Existing databases get them from models.migrations.upgrade_schema
+    __table_args__ = (
+        Index('ix_event_sensor_type_timestamp', 'sensor_id', 'type', 'timestamp'),
+        Index('ix_event_sensor_counter', 'sensor_id', 'counter'),
+        # The events of a sensor stored since a given one, see gap_analysis.update_checkpoints
+        Index('ix_event_sensor_id', 'sensor_id', 'id'),
+        Index('ux_event_sensor_counter_bucket', 'sensor_id', 'counter', 'time_bucket', unique=True),
+    )
 
     __mapper_args__ = {
         'polymorphic_on': type,
@@ -168,3 +213,179 @@ class LinkQ(LoraEvent):
                f"Device_Name={self.sensor.device_name}, " \
                f"Counter={self.counter}, " \
                f"Timestamp={formatiso8601(self.timestamp)})"
+
+
+class MeasurementRollup(Base):
+    """
+    The temperature and humidity measurements of a sensor summarised over a fixed period
+    (the resolution, in seconds) starting at bucket, seconds since the epoch. Used to draw
+    long-range charts without reading every measurement; see sensors.rollups.
+    Sums are kept rather than means so that more measurements can be added to a bucket.
+    """
+    __tablename__ = 'measurement_rollup'
+
+    sensor_id = Column(String(16), ForeignKey('sensor.device_id'), primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+    temp_min = Column(Float)
+    temp_max = Column(Float)
+    temp_sum = Column(Float)
+    humidity_min = Column(Float)
+    humidity_max = Column(Float)
+    humidity_sum = Column(Float)
+
+    @property
+    def temp_mean(self) -> float:
+        return self.temp_sum / self.count
+
+    @property
+    def humidity_mean(self) -> float:
+        return self.humidity_sum / self.count
+
+    def __repr__(self):
+        return f"MeasurementRollup(Sensor_ID={self.sensor_id}, " \
+               f"Resolution={self.resolution}, " \
+               f"Bucket={formatiso8601(datetime.fromtimestamp(self.bucket, timezone.utc))}, " \
+               f"Count={self.count}, " \
+               f"Temp_C={self.temp_min}/{self.temp_mean:.2f}/{self.temp_max})"
+
+
+class GapCheckpoint(Base):
+    """
+    How far the gap analysis has got for a sensor, so the next run only needs to look at
+    the events stored since. There is a checkpoint for each sensor with and without the
+    gaps next to Supervisory messages counted.
+    """
+    __tablename__ = 'gap_checkpoint'
+
+    sensor_id = Column(String(16), ForeignKey('sensor.device_id'), primary_key=True)
+    exclude_supervisory = Column(Boolean, primary_key=True)
+    # The highest event id looked at, events with a higher id are new
+    last_event_id = Column(Integer, nullable=False)
+    # The latest event of the current run, in the order received
+    last_counter = Column(Integer, nullable=False)
+    last_timestamp = Column(CustomDateTime, nullable=False)
+    last_type = Column(String(32))
+    first_counter = Column(Integer, nullable=False)
+    first_timestamp = Column(CustomDateTime, nullable=False)
+    # Where the current unbroken run of counters started
+    run_start_counter = Column(Integer, nullable=False)
+    # Running totals; the events that arrived late and were skipped are not counted
+    event_count = Column(Integer, nullable=False)
+    gap_count = Column(Integer, nullable=False)
+    missing_total = Column(Integer, nullable=False)
+    updated = Column(CustomDateTime, nullable=False)
+
+    def __repr__(self):
+        return f"GapCheckpoint(Sensor_ID={self.sensor_id}, " \
+               f"Last_Counter={self.last_counter}, " \
+               f"Events={self.event_count}, " \
+               f"Gaps={self.gap_count}, " \
+               f"Missing={self.missing_total}, " \
+               f"Updated={formatiso8601(self.updated)})"
+
+
+class Modulation(IntEnum):
+    """
+    The modulation of an uplink as stored in reception.modulation
+    """
+    UNKNOWN = 0
+    LORA = 1
+    FSK = 2
+
+
+class Gateway(Base):
+    """
+    A gateway that has received uplinks. The gateway id from TTN is only stored here, the
+    receptions refer to the gateway by the small integer key.
+    """
+    __tablename__ = 'gateway'
+
+    id = Column(Integer, primary_key=True)
+    gtw_id = Column(String(64), nullable=False, unique=True)
+    first_seen = Column(CustomDateTime, nullable=False)
+
+    def __repr__(self):
+        return f"Gateway(Id={self.id}, Gtw_ID={self.gtw_id}, First_Seen={formatiso8601(self.first_seen)})"
+
+
+class Reception(Base):
+    """
+    The reception of an uplink by one gateway, with the radio metadata, all as numbers so
+    link quality can be analysed without reading the raw messages. The sensor and time of
+    the event are repeated here so the queries by sensor, gateway and time need only this
+    table; see sensors.link_quality.
+    """
+    __tablename__ = 'reception'
+
+    event_id = Column(Integer, ForeignKey('event.id'), primary_key=True)
+    gateway_id = Column(Integer, ForeignKey('gateway.id'), primary_key=True)
+    sensor_id = Column(String(16), ForeignKey('sensor.device_id'), nullable=False)
+    timestamp = Column(CustomDateTime, nullable=False)
+    rssi = Column(Float)
+    snr = Column(Float)
+    channel = Column(SmallInteger)
+    # metadata.data_rate, e.g. SF7BW125, as the spreading factor and the bandwidth in kHz
+    spreading_factor = Column(SmallInteger)
+    bandwidth_khz = Column(SmallInteger)
+    # A Modulation
+    modulation = Column(SmallInteger)
+    frequency_khz = Column(Integer)
+    airtime_us = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_reception_sensor_gateway_timestamp', 'sensor_id', 'gateway_id', 'timestamp'),
+        Index('ix_reception_gateway_timestamp', 'gateway_id', 'timestamp'),
+    )
+
+    def __repr__(self):
+        return f"Reception(Event_ID={self.event_id}, " \
+               f"Gateway_ID={self.gateway_id}, " \
+               f"RSSI={self.rssi}, " \
+               f"SNR={self.snr}, " \
+               f"SF={self.spreading_factor})"
+
+
+class ReplayProgress(Base):
+    """
+    How far the replay of a message archive has got, see sensors.replay. It is updated in
+    the same transaction as the events, so an interrupted replay carries on from exactly
+    where it stopped.
+    """
+    __tablename__ = 'replay_progress'
+
+    archive = Column(String(255), primary_key=True)
+    # Bytes of the (uncompressed) archive read so far
+    offset = Column(Integer, nullable=False)
+    lines = Column(Integer, nullable=False)
+    events = Column(Integer, nullable=False)
+    updated = Column(CustomDateTime, nullable=False)
+
+    def __repr__(self):
+        return f"ReplayProgress(Archive={self.archive}, " \
+               f"Lines={self.lines}, " \
+               f"Events={self.events}, " \
+               f"Updated={formatiso8601(self.updated)})"
+
+
+class JournalProgress(Base):
+    """
+    How far the messages of a journal have been stored, see sensors.journal. It is updated in
+    the same transaction as the events, so the messages stored just before a crash are not
+    stored again if the checkpoint file of the journal had not been written yet.
+    """
+    __tablename__ = 'journal_progress'
+
+    # The absolute path of the journal folder
+    folder = Column(String(255), primary_key=True)
+    # The position after the last message stored, see sensors.journal.JournalPosition
+    segment = Column(Integer, nullable=False)
+    offset = Column(Integer, nullable=False)
+    updated = Column(CustomDateTime, nullable=False)
+
+    def __repr__(self):
+        return f"JournalProgress(Folder={self.folder}, " \
+               f"Segment={self.segment}, " \
+               f"Offset={self.offset}, " \
+               f"Updated={formatiso8601(self.updated)})"
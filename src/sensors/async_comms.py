@@ -0,0 +1,401 @@
+"""
+An asyncio front end to the MQTT broker. AsyncMqttComms drives the Paho client from the event
+loop instead of loop_forever, using the socket callbacks Paho has for running inside another
+event loop, so one thread can hold several connections, e.g. to several applications or
+regions, see sensors.connections. The messages go to an AsyncSensorListener whose on_message is a coroutine. They are
+queued and handed over in the order they arrived; while the queue is full the socket is not
+read, so the broker is held back by TCP rather than the messages piling up in memory.
+
+AsyncStreamer stores the messages with a Streamer. SQLAlchemy 1.3 has no asyncio engine, so
+the database work is done in a thread pool: the messages are parsed and checked against the
+dedup window on the event loop, and writer tasks hand batches to the pool and wait for them.
+"""
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import List, Optional
+
+import paho.mqtt.client as mqtt
+
+from sensors.db_streamer import Streamer, EventRecord
+from sensors.mqtt_comms import MqttComms, SensorListener, DEFAULT_CLIENT_ID
+
+# How often Paho's housekeeping (keep alive pings and retries) is run, in seconds
+MISC_INTERVAL_SECONDS = 1.0
+
+# How long to wait before connecting again, doubling up to the maximum
+RECONNECT_SECONDS = 1.0
+MAX_RECONNECT_SECONDS = 120.0
+# A connection that lasted this long resets the wait before connecting again
+STABLE_SECONDS = 60.0
+
+
+class AsyncSensorListener(ABC):
+    """
+    The asyncio counterpart of SensorListener, on_message is a coroutine. The connection
+    callbacks are called on the event loop and must not block.
+    """
+
+    @abstractmethod
+    async def on_message(self, topic: str, payload: bytes):
+        pass
+
+    @abstractmethod
+    def on_disconnect(self, reason: str):
+        pass
+
+    @abstractmethod
+    def on_connection_event(self, reason: str, level: int = logging.INFO) -> None:
+        pass
+
+    async def close(self) -> None:
+        """
+        Called when the connection is shut down so that anything still buffered by the
+        listener can be written out. The default does nothing.
+        :return: None
+        """
+        pass
+
+
+class ThreadedListener(AsyncSensorListener):
+    """
+    Hands the messages to a SensorListener, e.g. a Streamer, on a thread of its own so that
+    storing them does not hold up the event loop. They are handed over one at a time, in order.
+    """
+
+    def __init__(self, listener: SensorListener):
+        """
+        :param listener: The listener
+        """
+        self.listener = listener
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="threaded-listener")
+
+    async def on_message(self, topic: str, payload: bytes):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.listener.on_message, topic, payload)
+
+    def on_disconnect(self, reason: str):
+        self.listener.on_disconnect(reason)
+
+    def on_connection_event(self, reason: str, level: int = logging.INFO) -> None:
+        self.listener.on_connection_event(reason, level)
+
+    async def close(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.listener.close)
+        self._executor.shutdown()
+
+
+class AsyncMqttComms(MqttComms):
+    """
+    MqttComms run by the asyncio event loop. Connecting, subscribing and the connection
+    events are handled as in MqttComms; run() takes the place of connect_and_start.
+    """
+
+    def __init__(self,
+                 cert_path: str,
+                 username: str,
+                 password: str,
+                 hostname: str,
+                 port: int,
+                 msg_listener: AsyncSensorListener = None,
+                 client_id: str = DEFAULT_CLIENT_ID,
+                 queue_size: int = 1000,
+                 name: str = None,
+                 close_listener: bool = True):
+        """
+        :param cert_path: Path to the trust store of the broker
+        :param username: The application id
+        :param password: The access key of the application
+        :param hostname: The host name of the broker
+        :param port: The TLS port of the broker
+        :param msg_listener: Where the messages go
+        :param client_id: The MQTT client id, each connection needs its own
+        :param queue_size: The most messages waiting for the listener before the socket is
+        no longer read
+        :param name: The name of the connection in the logs, by default the host name
+        :param close_listener: Close the listener when run() returns; False when the listener
+        is shared with other connections
+        """
+        super().__init__(cert_path, username, password, hostname, port, msg_listener, client_id)
+        self.queue_size = queue_size
+        self.name = name if name is not None else hostname
+        self.close_listener = close_listener
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._loop_thread = None
+        self._messages = None  # type: Optional[asyncio.Queue]
+        self._disconnected = None  # type: Optional[asyncio.Event]
+        self._stopped = None  # type: Optional[asyncio.Event]
+        self._reading = True
+        self._stopping = False
+
+    @property
+    def paused(self) -> bool:
+        """
+        :return: True while the socket is not read because the listener has fallen behind
+        """
+        return not self._reading
+
+    def _start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._messages = asyncio.Queue()
+        self._disconnected = asyncio.Event()
+        self._stopped = asyncio.Event()
+
+    async def run(self, keep_alive_seconds: int) -> None:
+        """
+        Connect, and keep connecting again, until stop() is called or the task is cancelled.
+        The listener is closed at the end, unless close_listener is False.
+        :param keep_alive_seconds: The MQTT keep alive
+        :return: None
+        """
+        self._start()
+        deliver = asyncio.create_task(self._deliver())
+        delay = RECONNECT_SECONDS
+        try:
+            while not self._stopping:
+                self._disconnected.clear()
+                self.health.state = "connecting"
+                try:
+                    # Looking up the host and the TLS handshake block, so they are done in the pool
+                    await self._loop.run_in_executor(None, lambda: self.client.connect(
+                        host=self.hostname, port=self.ssl_port, keepalive=keep_alive_seconds))
+                except Exception as e:
+                    self.logger.warning(f"Connecting to {self.name} failed, trying again in {delay} seconds: "
+                                        f"{str(e)}")
+                    self.health.last_error = str(e)
+                    self.msg_listener.on_connection_event(f"Connection failed {str(e)}", logging.ERROR)
+                else:
+                    connected = monotonic()
+                    await self._run_connected()
+                    if self._stopping:
+                        break
+                    if monotonic() - connected >= STABLE_SECONDS:
+                        delay = RECONNECT_SECONDS
+                    self.logger.warning(f"Disconnected from {self.name}, connecting again in {delay} seconds")
+                self.health.state = "waiting"
+                self.health.retry_seconds = delay
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(2 * delay, MAX_RECONNECT_SECONDS)
+        finally:
+            self.health.state = "stopped"
+            if self.client.socket() is not None:
+                self.client.disconnect()
+            # Hand over what has been received before closing the listener
+            await self._messages.join()
+            deliver.cancel()
+            if self.close_listener:
+                await self.msg_listener.close()
+
+    async def _run_connected(self) -> None:
+        while not self._disconnected.is_set():
+            if self.client.loop_misc() != mqtt.MQTT_ERR_SUCCESS:
+                break
+            try:
+                await asyncio.wait_for(self._disconnected.wait(), MISC_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self) -> None:
+        """
+        Disconnect, run() returns once the messages received have been handed over
+        :return: None
+        """
+        self._stopping = True
+        if self._stopped is not None:
+            self._stopped.set()
+        self.client.disconnect()
+
+    def on_message(self, client, userdata, msg: mqtt.MQTTMessage):
+        self._count_message()
+        self._messages.put_nowait((msg.topic, msg.payload))
+        if self._messages.qsize() >= self.queue_size:
+            self._pause_reading()
+
+    def on_disconnect(self, client, userdata, rc):
+        super().on_disconnect(client, userdata, rc)
+        if self._disconnected is not None:
+            self._disconnected.set()
+
+    async def _deliver(self) -> None:
+        while True:
+            topic, payload = await self._messages.get()
+            try:
+                await self.msg_listener.on_message(topic, payload)
+            except Exception as e:
+                self.logger.error(f"Exception handling message {str(e)}")
+            finally:
+                self._messages.task_done()
+            if not self._reading and self._messages.qsize() <= self.queue_size // 2:
+                self._resume_reading()
+
+    def _pause_reading(self) -> None:
+        if self._reading:
+            self._reading = False
+            self.logger.warning(f"{self._messages.qsize()} messages waiting, not reading from {self.name}")
+            sock = self.client.socket()
+            if sock is not None:
+                self._loop.remove_reader(sock)
+
+    def _resume_reading(self) -> None:
+        self._reading = True
+        self.logger.info(f"Reading from {self.name} again")
+        sock = self.client.socket()
+        if sock is not None:
+            self._loop.add_reader(sock, self._on_readable)
+            # Anything the TLS layer has already read would not wake the loop
+            self._on_readable()
+
+    def _on_readable(self) -> None:
+        self.client.loop_read()
+        sock = self.client.socket()
+        # Messages already decrypted by the TLS layer do not make the socket readable
+        while self._reading and sock is not None and hasattr(sock, "pending") and sock.pending() > 0:
+            self.client.loop_read()
+            sock = self.client.socket()
+
+    def _in_loop(self, callback, *args) -> None:
+        # The socket callbacks are called on the thread that connects as well as by the loop
+        if threading.get_ident() == self._loop_thread:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._in_loop(self._add_reader, sock)
+
+    def _add_reader(self, sock):
+        if self._reading:
+            self._loop.add_reader(sock, self._on_readable)
+
+    def _on_socket_close(self, client, userdata, sock):
+        # The socket is closed once this returns, so it is removed by its number
+        self._in_loop(self._loop.remove_reader, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self._loop.remove_writer, sock.fileno())
+
+
+class AsyncStreamer(AsyncSensorListener):
+    """
+    Stores the messages with a Streamer, the database work done in a thread pool by writer
+    tasks. With more than one writer the batches can be stored out of order, and a copy of a
+    message could be counted before the first one is stored, so one writer is the default.
+    """
+
+    def __init__(self, Session,
+                 batch_size: int = 100,
+                 max_latency_seconds: float = 1.0,
+                 queue_size: int = 10000,
+                 writers: int = 1,
+                 **streamer_options):
+        """
+        :param Session: The session factory
+        :param batch_size: The most messages stored in one transaction
+        :param max_latency_seconds: The longest a message waits before its batch is stored
+        :param queue_size: The most messages waiting to be stored; on_message waits when the
+        queue is full
+        :param writers: The number of batches stored at the same time
+        :param streamer_options: Passed to the Streamer, e.g. dedup_window, capture_receptions,
+        maintain_rollups and connection_log_level
+        """
+        if batch_size < 1:
+            raise ValueError("The batch size must be at least 1")
+        self.streamer = Streamer(Session, **streamer_options)
+        self.logger = self.streamer.logger
+        self.batch_size = batch_size
+        self.max_latency_seconds = max_latency_seconds
+        self.writers = writers
+        self._records = asyncio.Queue(maxsize=queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=writers, thread_name_prefix="async-streamer")
+        self._tasks = []  # type: List[asyncio.Task]
+
+    async def on_message(self, topic: str, payload: bytes):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._write()) for _ in range(self.writers)]
+        try:
+            record = self.streamer.parse_message(payload)
+            if record is None:
+                return
+            if self.streamer.dedup is not None and self.streamer.suppress_duplicate(record):
+                return
+        except Exception as e:
+            self.streamer.count_error("parse")
+            self.logger.error(f"Exception parsing payload message {str(e)}")
+            self.logger.error(f"Bad payload: {payload.decode()}")
+            return
+        await self._records.put(record)
+
+    async def _write(self) -> None:
+        loop = asyncio.get_running_loop()
+        # Kept from one batch to the next, so a record is never lost to a timeout
+        getter = None
+        try:
+            while True:
+                if getter is None:
+                    getter = asyncio.ensure_future(self._records.get())
+                batch = [await getter]  # type: List[EventRecord]
+                getter = None
+                deadline = loop.time() + self.max_latency_seconds
+                while len(batch) < self.batch_size:
+                    if not self._records.empty():
+                        batch.append(self._records.get_nowait())
+                        continue
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    getter = asyncio.ensure_future(self._records.get())
+                    done, _ = await asyncio.wait({getter}, timeout=remaining)
+                    if getter not in done:
+                        break
+                    batch.append(getter.result())
+                    getter = None
+                try:
+                    await loop.run_in_executor(self._executor, self.streamer.store_events, batch)
+                except Exception as e:
+                    self.logger.error(f"Batch of {len(batch)} could not be stored: {str(e)}")
+                finally:
+                    for _ in batch:
+                        self._records.task_done()
+        finally:
+            if getter is not None:
+                getter.cancel()
+
+    async def flush(self) -> None:
+        """
+        Wait until everything received so far has been stored
+        :return: None
+        """
+        await self._records.join()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.streamer.flush)
+
+    async def close(self) -> None:
+        """
+        Store what is waiting and stop the writer tasks
+        :return: None
+        """
+        await self.flush()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.streamer.close)
+        self._executor.shutdown()
+
+    def on_disconnect(self, reason: str):
+        self.streamer.on_disconnect(reason)
+
+    def on_connection_event(self, reason: str, level: int = logging.INFO) -> None:
+        self.streamer.on_connection_event(reason, level)
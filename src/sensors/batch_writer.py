@@ -0,0 +1,182 @@
+"""
+A write-behind helper. Items are put on a bounded queue by the producer (for example the
+Paho callback thread) and a single writer thread hands them to a flush function in batches.
+A batch is flushed when it reaches the size limit or when the oldest item in it has waited
+for the maximum latency, whichever comes first. A tick function can be given for items that
+are made on a timer rather than put by a producer, such as periodic summaries.
+"""
+import logging
+import queue
+import threading
+from time import monotonic
+from typing import Any, Callable, List, Optional
+
+# Sentinels placed on the queue to control the writer thread
+_STOP = object()
+
+
+class _FlushRequest:
+    """
+    Placed on the queue to ask the writer to flush what it has and signal when done
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class BatchWriter:
+    """
+    Collects items on a bounded queue and flushes them in batches on a background thread
+    """
+
+    def __init__(self,
+                 flush_function: Callable[[List[Any]], None],
+                 batch_size: int = 100,
+                 max_latency_seconds: float = 1.0,
+                 queue_size: int = 10000,
+                 name: str = "batch-writer",
+                 tick_function: Callable[[], List[Any]] = None,
+                 tick_seconds: float = 60.0):
+        """
+        :param flush_function: Called on the writer thread with a list of items to persist.
+        Exceptions are logged and the batch is discarded, the writer keeps going.
+        :param batch_size: Flush as soon as this many items are waiting
+        :param max_latency_seconds: Flush when the oldest waiting item is this old
+        :param queue_size: Maximum number of items waiting on the queue; put() blocks when full
+        :param name: The name of the writer thread, handy in the logs
+        :param tick_function: Called on the writer thread every tick_seconds, the items it
+        returns are written as if they had been put. Exceptions are logged.
+        :param tick_seconds: How often to call the tick function
+        """
+        if batch_size < 1:
+            raise ValueError("The batch size must be at least 1")
+        self.flush_function = flush_function
+        self.batch_size = batch_size
+        self.max_latency_seconds = max_latency_seconds
+        self.tick_function = tick_function
+        self.tick_seconds = tick_seconds
+        self.logger = logging.getLogger("lora.mqtt")
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        # Guards _closed and the count of puts under way, so nothing is queued after the stop
+        self._state = threading.Condition()
+        self._putting = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, item: Any, timeout: Optional[float] = None) -> None:
+        """
+        Queue an item for writing. Blocks if the queue is full.
+        :param item: The item to hand to the flush function later on
+        :param timeout: Seconds to wait for space on the queue, None waits forever
+        :raise queue.Full: If the timeout expires before there is space
+        :raise RuntimeError: If the writer has been closed
+        """
+        with self._state:
+            if self._closed:
+                raise RuntimeError("The batch writer has been closed")
+            self._putting += 1
+        try:
+            self._queue.put(item, timeout=timeout)
+        finally:
+            with self._state:
+                self._putting -= 1
+                self._state.notify_all()
+
+    def qsize(self) -> int:
+        """
+        :return: Approximate number of items waiting on the queue
+        """
+        return self._queue.qsize()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ask the writer to flush everything queued so far and wait for it to happen
+        :param timeout: Seconds to wait, None waits forever
+        :return: True if the flush completed within the timeout
+        """
+        if not self._thread.is_alive():
+            return True
+        request = _FlushRequest()
+        try:
+            self.put(request)
+        except RuntimeError:
+            # Closed, which writes everything
+            return True
+        return request.done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Flush whatever is waiting and stop the writer thread. Safe to call more than once.
+        :param timeout: Seconds to wait for the writer thread to finish
+        """
+        with self._state:
+            if self._closed:
+                return
+            self._closed = True
+            # A put that got in before the close goes on the queue ahead of the stop
+            while self._putting:
+                self._state.wait()
+            self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.logger.warning(f"Writer thread {self._thread.name} did not stop within {timeout} seconds")
+
+    def _write(self, batch: List[Any]) -> None:
+        try:
+            self.flush_function(batch)
+        except Exception as e:
+            self.logger.error(f"Failed to write a batch of {len(batch)} items: {str(e)}")
+
+    def _tick(self) -> List[Any]:
+        try:
+            return self.tick_function()
+        except Exception as e:
+            self.logger.error(f"Tick of writer thread {self._thread.name} failed: {str(e)}")
+            return []
+
+    def _run(self) -> None:
+        batch = []
+        deadline = 0.0
+        next_tick = monotonic() + self.tick_seconds if self.tick_function is not None else None
+        while True:
+            now = monotonic()
+            if next_tick is not None and now >= next_tick:
+                next_tick = now + self.tick_seconds
+                items = self._tick()
+                if items and not batch:
+                    deadline = now + self.max_latency_seconds
+                batch.extend(items)
+                if len(batch) >= self.batch_size:
+                    self._write(batch)
+                    batch = []
+            timeout = None
+            if batch:
+                timeout = max(0.0, deadline - now)
+            if next_tick is not None:
+                timeout = min(next_tick - now, timeout) if timeout is not None else next_tick - now
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                if batch and monotonic() >= deadline:
+                    # The oldest item has waited long enough
+                    self._write(batch)
+                    batch = []
+                continue
+            if item is _STOP:
+                # Anything queued after the stop was refused by put()
+                if batch:
+                    self._write(batch)
+                return
+            if isinstance(item, _FlushRequest):
+                if batch:
+                    self._write(batch)
+                    batch = []
+                item.done.set()
+                continue
+            if not batch:
+                deadline = monotonic() + self.max_latency_seconds
+            batch.append(item)
+            if len(batch) >= self.batch_size or monotonic() >= deadline:
+                self._write(batch)
+                batch = []
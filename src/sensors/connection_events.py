@@ -0,0 +1,167 @@
+"""
+Records connection events (the MQTT protocol log and connect/disconnect notices) in the
+connection table without holding up the MQTT network thread. Events below a configurable
+logging level are dropped, routine chatter such as pings is counted and written as one
+summary row per period on the timer of the writer, and rows are written by a background
+BatchWriter.
+"""
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from time import monotonic
+from typing import Dict, List, Tuple
+
+from models.models import ConnectionEvent, ConnectEnum
+from sensors.batch_writer import BatchWriter
+from utils.date_time_utils import get_utc_now
+
+# Log lines starting with these are routine and are counted rather than stored one by one
+COALESCED_PREFIXES = ("Sending PINGREQ", "Received PINGRESP",
+                      "Received PUBLISH", "Sending PUBACK",
+                      "Sending PUBREC", "Received PUBREL", "Sending PUBCOMP")
+
+# Text that marks the kind of an event, checked in this order
+_CONNECTED_MARKERS = ("Subscribed", "Connection Accepted", "Received CONNACK (0, 0)", "Received CONNACK (1, 0)")
+_SOCKET_ERROR_MARKERS = ("Connection failed", "Disconnected", "socket", "Socket", "connection lost",
+                         "Connection refused", "The connection was lost")
+
+DESC_LENGTH = ConnectionEvent.__table__.c.desc.type.length
+
+
+def classify(reason: str) -> ConnectEnum:
+    """
+    Work out what kind of connection event this is from its text
+    :param reason: The text of the event
+    :return: The kind of event
+    """
+    if any(x in reason for x in _CONNECTED_MARKERS):
+        return ConnectEnum.CONNECTED
+    if any(x in reason for x in _SOCKET_ERROR_MARKERS):
+        return ConnectEnum.SOCKET_ERROR
+    return ConnectEnum.GENERIC
+
+
+def _coalesce_key(reason: str):
+    for prefix in COALESCED_PREFIXES:
+        if reason.startswith(prefix):
+            return prefix
+    return None
+
+
+class ConnectionEventRecorder:
+    """
+    Filters, coalesces and writes connection events in the background
+    """
+
+    def __init__(self, Session,
+                 level: int = logging.INFO,
+                 coalesce_seconds: float = 300.0,
+                 batch_size: int = 50,
+                 max_latency_seconds: float = 5.0,
+                 queue_size: int = 1000):
+        """
+        :param Session: The session factory
+        :param level: Events logged below this level are not stored
+        :param coalesce_seconds: How often to write the counts of the routine events
+        :param batch_size: The most rows written in one transaction
+        :param max_latency_seconds: The longest an event waits before it is written
+        :param queue_size: The most events waiting to be written; more than that are dropped
+        rather than make the caller wait
+        """
+        self.Session = Session
+        self.level = level
+        self.coalesce_seconds = coalesce_seconds
+        self.logger = logging.getLogger("lora.mqtt")
+        self.dropped = 0
+        # The counts are added to on the MQTT network thread and taken on the writer thread
+        self._counts = {}  # type: Dict[str, int]
+        self._counts_since = monotonic()
+        self._counts_lock = threading.Lock()
+        self.writer = BatchWriter(self._write,
+                                  batch_size=batch_size,
+                                  max_latency_seconds=max_latency_seconds,
+                                  queue_size=queue_size,
+                                  name="connection-event-writer",
+                                  tick_function=self._take_counts,
+                                  tick_seconds=coalesce_seconds)
+
+    @contextmanager
+    def session_scope(self):
+        """ Provide a transactional scope around a series of operations"""
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def record(self, reason: str, level: int = logging.INFO) -> None:
+        """
+        Record an event. Never waits for the database.
+        :param reason: The text of the event
+        :param level: The logging level of the event
+        :return: None
+        """
+        if level < self.level:
+            return
+        key = _coalesce_key(reason)
+        if key is not None:
+            with self._counts_lock:
+                self._counts[key] = self._counts.get(key, 0) + 1
+        else:
+            self._put((get_utc_now(), classify(reason), reason))
+
+    def flush(self) -> None:
+        """
+        Write the counts so far and anything waiting, and wait for that to happen
+        :return: None
+        """
+        self._put_counts()
+        self.writer.flush()
+
+    def close(self) -> None:
+        """
+        Write the counts and anything waiting and stop the writer thread
+        :return: None
+        """
+        self._put_counts()
+        self.writer.close()
+        if self.dropped:
+            self.logger.warning(f"{self.dropped} connection events were dropped because the queue was full")
+
+    def _take_counts(self) -> List[Tuple[datetime, ConnectEnum, str]]:
+        """
+        Take the counts so far and start counting again, called on the writer thread every
+        coalesce period as well as by flush and close
+        :return: A summary row for each kind of routine event seen
+        """
+        with self._counts_lock:
+            counts, self._counts = self._counts, {}
+            now = monotonic()
+            elapsed = now - self._counts_since
+            self._counts_since = now
+        timenow = get_utc_now()
+        return [(timenow, ConnectEnum.GENERIC, f"{key} x{count} in {elapsed:.0f}s") for key, count in counts.items()]
+
+    def _put_counts(self) -> None:
+        for event in self._take_counts():
+            self._put(event)
+
+    def _put(self, event: Tuple[datetime, ConnectEnum, str]) -> None:
+        try:
+            self.writer.put(event, timeout=0)
+        except queue.Full:
+            self.dropped += 1
+        except RuntimeError:
+            # Closed, a callback of the connection can still come in while it shuts down
+            self.dropped += 1
+
+    def _write(self, events: List[Tuple[datetime, ConnectEnum, str]]) -> None:
+        with self.session_scope() as session:
+            session.add_all([ConnectionEvent(timestamp=timestamp, kind=kind, desc=desc[:DESC_LENGTH])
+                             for timestamp, kind, desc in events])
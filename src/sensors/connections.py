@@ -0,0 +1,177 @@
+"""
+Subscribes to several TTN applications, possibly in different regions, from one process. Each
+connection is a section of the INI file: [ttn-explore.mqtt.connection] as before, and any
+number of [ttn-explore.mqtt.connection.<name>] sections with the same keys. The connections
+are run on one asyncio event loop by AsyncMqttComms and all hand their messages to the same
+listener, so they share one pipeline and one database engine. Each connection waits longer
+before connecting again while it keeps failing, and its state is kept in its ConnectionHealth,
+which SubscriptionManager logs from time to time.
+"""
+import asyncio
+import configparser
+import logging
+from typing import Dict, List, NamedTuple
+
+from sensors.async_comms import AsyncMqttComms, AsyncSensorListener
+from sensors.mqtt_comms import ConnectionHealth, DEFAULT_CLIENT_ID
+
+SECTION = "ttn-explore.mqtt.connection"
+
+
+class ConnectionSettings(NamedTuple):
+    """
+    The settings of one connection from the INI file
+    """
+    name: str
+    username: str
+    password: str
+    hostname: str
+    port: int
+    keep_alive_seconds: int
+    client_id: str
+
+
+def read_connections(config: configparser.ConfigParser) -> List[ConnectionSettings]:
+    """
+    Read the connection sections of the INI file
+    :param config: The INI file
+    :return: The connections, the unnamed section first wherever it is in the file, as it is
+    the one used when there is only one connection; then the named ones in the file's order
+    :raise ValueError: If there are no connection sections or two have the same client id
+    """
+    unnamed = []
+    named = []
+    for section in config.sections():
+        if section == SECTION:
+            # The client id it has always had, so the broker keeps its session
+            name, client_id = "default", DEFAULT_CLIENT_ID
+        elif section.startswith(SECTION + "."):
+            name = section[len(SECTION) + 1:]
+            client_id = f"{DEFAULT_CLIENT_ID}-{name}"
+        else:
+            continue
+        connection = config[section]
+        hostname = connection.get('hostname') or f"{connection['region']}.thethings.network"
+        settings = ConnectionSettings(name=name,
+                                      username=connection['username'],
+                                      password=connection['password'],
+                                      hostname=hostname,
+                                      port=connection.getint('sslport'),
+                                      keep_alive_seconds=connection.getint('keep_alive_seconds'),
+                                      client_id=connection.get('client_id', client_id))
+        (unnamed if section == SECTION else named).append(settings)
+    connections = unnamed + named
+    if not connections:
+        raise ValueError(f"There is no [{SECTION}] section")
+    client_ids = [x.client_id for x in connections]
+    if len(set(client_ids)) != len(client_ids):
+        raise ValueError("Each connection needs its own client_id")
+    return connections
+
+
+class _ConnectionListener(AsyncSensorListener):
+    """
+    Names the connection in the connection events passed on to the shared listener
+    """
+
+    def __init__(self, listener: AsyncSensorListener, name: str):
+        self.listener = listener
+        self.name = name
+
+    async def on_message(self, topic: str, payload: bytes):
+        await self.listener.on_message(topic, payload)
+
+    def on_disconnect(self, reason: str):
+        self.listener.on_disconnect(f"{reason} ({self.name})")
+
+    def on_connection_event(self, reason: str, level: int = logging.INFO) -> None:
+        # At the end, the routine events are recognised by how they start
+        self.listener.on_connection_event(f"{reason} ({self.name})", level)
+
+
+class SubscriptionManager:
+    """
+    Runs the connections on the event loop, all handing their messages to one listener
+    """
+
+    def __init__(self,
+                 connections: List[ConnectionSettings],
+                 listener: AsyncSensorListener,
+                 cert_path: str,
+                 queue_size: int = 1000,
+                 health_log_seconds: float = 300.0):
+        """
+        :param connections: The connections, see read_connections
+        :param listener: Where the messages of all the connections go, closed when they stop
+        :param cert_path: Path to the MQTT trust store
+        :param queue_size: The most messages waiting for the listener from each connection
+        before it is no longer read
+        :param health_log_seconds: How often the state of the connections is logged, 0 for never
+        """
+        self.connections = connections
+        self.listener = listener
+        self.health_log_seconds = health_log_seconds
+        self.logger = logging.getLogger("lora.mqtt")
+        self.comms = {}  # type: Dict[str, AsyncMqttComms]
+        for connection in connections:
+            self.comms[connection.name] = AsyncMqttComms(
+                cert_path=cert_path,
+                username=connection.username,
+                password=connection.password,
+                hostname=connection.hostname,
+                port=connection.port,
+                # With one connection its events are stored as they always were
+                msg_listener=_ConnectionListener(listener, connection.name) if len(connections) > 1 else listener,
+                client_id=connection.client_id,
+                queue_size=queue_size,
+                name=connection.name,
+                close_listener=False)
+
+    def health(self) -> Dict[str, ConnectionHealth]:
+        """
+        :return: The state of each connection by name
+        """
+        return {name: comms.health for name, comms in self.comms.items()}
+
+    async def run(self) -> None:
+        """
+        Run the connections until stop() is called or the task is cancelled, then close the listener
+        :return: None
+        """
+        tasks = [asyncio.create_task(self.comms[x.name].run(x.keep_alive_seconds)) for x in self.connections]
+        self.logger.info(f"Running {len(tasks)} connections: {', '.join(self.comms)}")
+        health_task = asyncio.create_task(self._log_health()) if self.health_log_seconds > 0 else None
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if health_task is not None:
+                health_task.cancel()
+            for task in tasks:
+                task.cancel()
+            # Each hands over what it has received before it finishes
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.listener.close()
+
+    def stop(self) -> None:
+        """
+        Disconnect all the connections, run() returns once the messages received have been handed over
+        :return: None
+        """
+        for comms in self.comms.values():
+            comms.stop()
+
+    def log_health(self) -> None:
+        """
+        Log the state of each connection
+        :return: None
+        """
+        for name, health in self.health().items():
+            paused = ", not being read" if self.comms[name].paused else ""
+            self.logger.info(f"Connection {name} {health.state}{paused}: {health.messages} messages, "
+                             f"{health.connects} connects, {health.disconnects} disconnects, "
+                             f"last message {health.last_message}, last error {health.last_error}")
+
+    async def _log_health(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_log_seconds)
+            self.log_health()
@@ -1,33 +1,404 @@
-import json
 import logging
+import threading
 from collections import namedtuple
 from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import List, Optional
 
+from sqlalchemy import and_, case, or_, func
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import scoped_session
 
-from models.models import Sensor, TempHumidityMeasurement, Supervisory, LinkQ, ConnectionEvent, ConnectEnum
+from models.models import TempHumidityMeasurement, Supervisory, LinkQ, LoraEvent, Reception, JournalProgress
+from sensors.batch_writer import BatchWriter
+from sensors.connection_events import ConnectionEventRecorder
+from sensors.dedup import DedupWindow, time_bucket_of
+from sensors.journal import MessageJournal, JournalApplier, JournalPosition
+from sensors.link_quality import identified_gateways, reception_rows
+from sensors.metrics import IngestMetrics
 from sensors.message_protocol import THSensorEventType, THSensorMsgType
 from sensors.mqtt_comms import SensorListener
-from utils.date_time_utils import parseiso8601, get_utc_now
+from sensors.rollups import add_measurements
+from sensors.sensor_registry import SensorRegistry, GatewayRegistry
+from sensors.uplink_decoder import decode_uplink, Metadata, Uplink
+from utils.date_time_utils import get_utc_now, parseiso8601
+
+
+# With a journal and no batch size, the most messages stored in one transaction
+JOURNAL_BATCH_SIZE = 100
+# How long to wait before trying the database again, doubling up to the maximum
+JOURNAL_RETRY_SECONDS = 1.0
+JOURNAL_MAX_RETRY_SECONDS = 60.0
 
 
 def customMeasurementDecoder(measurementDict):
     """
-    Convert the dictionary into a named tuple
+    Convert the dictionary into a named tuple. This was used to decode the messages before
+    sensors.uplink_decoder, it makes a new class for every object so is much slower.
     :param measurementDict: A dictionary loaded from the JSON measurement measure
     :return: A NamedTuple that has all the values in an easily accessible format
     """
     return namedtuple('X', measurementDict.keys())(*measurementDict.values())
 
 
+class EventRecord:
+    """
+    The fields of a message that are needed to store it, pulled out of the JSON on the
+    receiving thread so the database work can be done later, possibly in a batch
+    """
+    __slots__ = ('event_class', 'device_id', 'device_name', 'counter', 'timestamp',
+                 'raw_message', 'temp_c', 'humidity_percent',
+                 'retry_count', 'best_rssi', 'best_snr', 'time_bucket', 'is_duplicate', 'taken',
+                 'stored', 'metadata', 'journal_position')
+
+    def __init__(self, event_class, device_id: str, device_name: str, counter: int,
+                 timestamp: datetime, raw_message: bytes,
+                 temp_c: float = None, humidity_percent: float = None,
+                 best_rssi: float = None, best_snr: float = None, metadata: Metadata = None):
+        self.event_class = event_class
+        self.device_id = device_id
+        self.device_name = device_name
+        self.counter = counter
+        self.timestamp = timestamp
+        self.raw_message = raw_message
+        self.temp_c = temp_c
+        self.humidity_percent = humidity_percent
+        self.retry_count = 0
+        self.best_rssi = best_rssi
+        self.best_snr = best_snr
+        # Only set when copies are suppressed, see sensors.dedup
+        self.time_bucket = None  # type: Optional[int]
+        # True for a copy of a message that has already been handed to the database
+        self.is_duplicate = False
+        # True once the record has been handed to the database
+        self.taken = False
+        # True once the record has been committed
+        self.stored = False
+        # The radio metadata, for the reception table
+        self.metadata = metadata
+        # From a journal, the position after the message, stored with the event
+        self.journal_position = None  # type: Optional[JournalPosition]
+
+    def fold(self, other: "EventRecord") -> None:
+        """
+        Count another copy of the same message into this one, keeping the best signal
+        :param other: The copy
+        :return: None
+        """
+        self.retry_count += 1 + other.retry_count
+        self.best_rssi = _best(self.best_rssi, other.best_rssi)
+        self.best_snr = _best(self.best_snr, other.best_snr)
+
+    def to_event(self, sensor_id: str) -> LoraEvent:
+        """
+        Make the ORM object for this record
+        :param sensor_id: The primary key of the sensor that sent the message
+        :return: A new event for the sensor
+        """
+        if self.event_class is TempHumidityMeasurement:
+            return TempHumidityMeasurement(temp_c=self.temp_c,
+                                           humidity_percent=self.humidity_percent,
+                                           timestamp=self.timestamp,
+                                           raw_message=self.raw_message,
+                                           counter=self.counter,
+                                           sensor_id=sensor_id,
+                                           retry_count=self.retry_count,
+                                           best_rssi=self.best_rssi,
+                                           best_snr=self.best_snr,
+                                           time_bucket=self.time_bucket)
+        return self.event_class(timestamp=self.timestamp,
+                                raw_message=self.raw_message,
+                                counter=self.counter,
+                                sensor_id=sensor_id,
+                                retry_count=self.retry_count,
+                                best_rssi=self.best_rssi,
+                                best_snr=self.best_snr,
+                                time_bucket=self.time_bucket)
+
+    def to_row(self, sensor_id: str) -> dict:
+        """
+        Make the values of the event row, for inserting many rows at once with Core
+        :param sensor_id: The primary key of the sensor that sent the message
+        :return: The value of every column of the event table but the id
+        """
+        return {'type': self.event_class.__mapper_args__['polymorphic_identity'],
+                'timestamp': self.timestamp,
+                'counter': self.counter,
+                'raw_message': self.raw_message,
+                'sensor_id': sensor_id,
+                'retry_count': self.retry_count,
+                'best_rssi': self.best_rssi,
+                'best_snr': self.best_snr,
+                'time_bucket': self.time_bucket,
+                'temp_c': self.temp_c,
+                'humidity_percent': self.humidity_percent}
+
+
+def _best(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+# The sensor events that are stored as measurements
+MEASUREMENT_EVENT_TYPES = frozenset([THSensorEventType.PERIODIC.value,
+                                     THSensorEventType.HMD_CHANGE_DECREASE.value,
+                                     THSensorEventType.HMD_CHANGE_INCREASE.value,
+                                     THSensorEventType.TEMP_CHANGE_DECREASE.value,
+                                     THSensorEventType.TEMP_CHANGE_INCREASE.value])
+
+# The message type of each kind of record in the metrics, OTHER for the messages that are not stored
+EVENT_TYPE_NAMES = {TempHumidityMeasurement: THSensorMsgType.UPLINK.name,
+                    Supervisory: THSensorMsgType.SUPERVISORY.name,
+                    LinkQ: THSensorMsgType.LINK_QUALITY.name}
+OTHER_TYPE_NAME = "OTHER"
+
+
+def parse_message(payload: bytes) -> Optional[EventRecord]:
+    """
+    Pull the fields to be stored out of the message
+    :param payload: The JSON message from TTN
+    :return: The record to store or None if this is not a message that is stored
+    """
+    return record_from_uplink(decode_uplink(payload), payload)
+
+
+def record_from_uplink(msgobj: Uplink, payload: bytes, timestamp: datetime = None) -> Optional[EventRecord]:
+    """
+    Pull the fields to be stored out of the decoded message, see parse_message
+    :param msgobj: The decoded message
+    :param payload: The JSON message from TTN
+    :param timestamp: The time of the message if it has been parsed already
+    :return: The record to store or None if this is not a message that is stored
+    """
+    msgtype = msgobj.payload_fields.msgtype
+    if msgtype == THSensorMsgType.SUPERVISORY.value:
+        event_class = Supervisory
+    elif msgtype == THSensorMsgType.LINK_QUALITY.value:
+        event_class = LinkQ
+    elif msgtype == THSensorMsgType.UPLINK.value:
+        # Sensor event
+        if msgobj.payload_fields.sensor_event_type not in MEASUREMENT_EVENT_TYPES:
+            logging.getLogger("lora.mqtt").warning(f"Not one of the expected uplink messages" \
+                                                   f"{msgobj.payload_fields.sensor_event_type}")
+            return None
+        event_class = TempHumidityMeasurement
+    else:
+        # Some other kind of message
+        return None
+    if timestamp is None:
+        timestamp = parseiso8601(msgobj.metadata.time)
+    gateways = msgobj.metadata.gateways
+    best_rssi = max((x.rssi for x in gateways if x.rssi is not None), default=None)
+    best_snr = max((x.snr for x in gateways if x.snr is not None), default=None)
+    if event_class is TempHumidityMeasurement:
+        return EventRecord(TempHumidityMeasurement,
+                           device_id=msgobj.hardware_serial,
+                           device_name=msgobj.dev_id,
+                           counter=msgobj.counter,
+                           timestamp=timestamp,
+                           raw_message=payload,
+                           temp_c=msgobj.payload_fields.temp_c,
+                           humidity_percent=msgobj.payload_fields.humidity_percent,
+                           best_rssi=best_rssi,
+                           best_snr=best_snr,
+                           metadata=msgobj.metadata)
+    return EventRecord(event_class,
+                       device_id=msgobj.hardware_serial,
+                       device_name=msgobj.dev_id,
+                       counter=msgobj.counter,
+                       timestamp=timestamp,
+                       raw_message=payload,
+                       best_rssi=best_rssi,
+                       best_snr=best_snr,
+                       metadata=msgobj.metadata)
+
+
+def suppress_duplicate(window: DedupWindow, record: EventRecord, fold_lock) -> bool:
+    """
+    Check the record against the dedup window. A copy of a message that has not been
+    handed to the database yet is folded into it; a copy of one that has been is marked
+    as a duplicate, and storing it only increments the retry count of the stored row.
+    :param window: The recent messages
+    :param record: The record just received
+    :param fold_lock: Held while the taken flag of a record is looked at or set
+    :return: True if there is nothing more to do with the record
+    """
+    record.time_bucket = time_bucket_of(record.timestamp)
+    first = window.check(record.device_id, record.counter, record)
+    if first is None:
+        return False
+    with fold_lock:
+        if not first.taken:
+            first.fold(record)
+            return True
+    record.time_bucket = first.time_bucket
+    record.is_duplicate = True
+    return False
+
+
+def fold_into_stored(bind, record: EventRecord, sensor_id: str) -> bool:
+    """
+    Count a copy of a message into the row already stored for it
+    :param bind: The session or connection to use
+    :param record: The copy, marked is_duplicate
+    :param sensor_id: The sensor that sent it
+    :return: False if there is no stored row for it
+    """
+    events = LoraEvent.__table__
+
+    def best(column, value):
+        if value is None:
+            return column
+        return case([(or_(column.is_(None), column < value), value)], else_=column)
+
+    result = bind.execute(events.update()
+                          .where(and_(events.c.sensor_id == sensor_id,
+                                      events.c.counter == record.counter,
+                                      events.c.time_bucket == record.time_bucket))
+                          .values(retry_count=func.coalesce(events.c.retry_count, 0) + 1 + record.retry_count,
+                                  best_rssi=best(events.c.best_rssi, record.best_rssi),
+                                  best_snr=best(events.c.best_snr, record.best_snr)))
+    return result.rowcount > 0
+
+
+def fold_copies(bind, records: List[EventRecord], sensor_ids: List[str]) -> int:
+    """
+    Count the copies among the records into their stored rows, see fold_into_stored. A copy
+    whose first message was never stored, because writing it failed, is stored in its place:
+    it is no longer marked is_duplicate.
+    :param bind: The session or connection to use
+    :param records: The records being stored
+    :param sensor_ids: The sensor of each record
+    :return: The number of copies folded
+    """
+    folded = 0
+    for record, sensor_id in zip(records, sensor_ids):
+        if not record.is_duplicate:
+            continue
+        if fold_into_stored(bind, record, sensor_id):
+            folded += 1
+        else:
+            logging.getLogger("lora.mqtt").warning(f"Message {record.counter} from {record.device_id} "
+                                                   f"was not stored, storing its copy instead")
+            record.is_duplicate = False
+    return folded
+
+
 class Streamer(SensorListener):
     """
-    This receives the payload and stores it to the database
+    This receives the payload and stores it to the database. By default each message is
+    written in its own transaction as it arrives. Give a batch size to switch to write-behind
+    mode: messages are parsed on the receiving thread and queued, and a writer thread stores
+    them in batches, one transaction per batch. Connection events are always written by a
+    background thread, see sensors.connection_events.
+
+    Give a dedup window to suppress the copies of confirmed uplinks that are sent again:
+    a copy that arrives before the first one is written is folded into it, one that arrives
+    later only increments the retry count of the stored row.
+
+    Give a journal folder to write each message to a journal before the database, see
+    sensors.journal. Receiving a message then only appends it to the journal, and an applier
+    thread stores the messages in batches. While the database is not available the messages
+    wait in the journal, and what was not stored before a restart is stored after it.
+
+    Give metrics to count the messages and time the stages of storing them, see sensors.metrics.
     """
 
-    def __init__(self, Session):
+    def __init__(self, Session,
+                 batch_size: int = 0,
+                 max_latency_seconds: float = 1.0,
+                 queue_size: int = 10000,
+                 registry: SensorRegistry = None,
+                 maintain_rollups: bool = False,
+                 connection_log_level: int = logging.INFO,
+                 coalesce_seconds: float = 300.0,
+                 dedup_window: int = 0,
+                 capture_receptions: bool = False,
+                 journal_folder: Path = None,
+                 journal_sync: bool = False,
+                 metrics: IngestMetrics = None):
+        """
+        :param Session: The session factory
+        :param batch_size: 0 to write each message as it arrives, otherwise the maximum
+        number of messages written in one transaction by the writer thread
+        :param max_latency_seconds: In write-behind mode, the longest a message waits on
+        the queue before it is written
+        :param queue_size: In write-behind mode, the most messages that can be waiting;
+        on_message blocks when the queue is full
+        :param registry: The cache of known sensors; if not given one is made and warmed
+        from the sensor table
+        :param maintain_rollups: Add the measurements to the measurement_rollup table as they are stored
+        :param connection_log_level: Connection events logged below this level are not stored
+        :param coalesce_seconds: How often the counts of routine connection events such as
+        pings are stored
+        :param dedup_window: 0 to store every copy of a message, otherwise the number of recent
+        counters of each device remembered to recognise the copies
+        :param capture_receptions: Store the gateways that received each message and the radio
+        metadata in the gateway and reception tables
+        :param journal_folder: Write the messages to a journal in this folder before they are
+        stored; batch_size is then the most messages stored in one transaction, default
+        JOURNAL_BATCH_SIZE
+        :param journal_sync: Flush each message in the journal to the disk as it is written
+        :param metrics: Where the messages are counted and a sample of them timed, default none
+        """
+        self.metrics = metrics
         self.Session = scoped_session(Session)
         self.logger = logging.getLogger("lora.mqtt")
+        if registry is None:
+            registry = SensorRegistry(Session)
+            self.logger.info(f"Loaded {registry.warm()} known sensors")
+        self.registry = registry
+        self.maintain_rollups = maintain_rollups
+        self.gateways = None
+        if capture_receptions:
+            self.gateways = GatewayRegistry(Session)
+            self.logger.info(f"Loaded {self.gateways.warm()} known gateways")
+        self.dedup = DedupWindow(per_device=dedup_window) if dedup_window > 0 else None
+        # Guards the taken flag of the records, so a copy is folded into a record only
+        # while the writer has not started writing it
+        self._fold_lock = threading.Lock()
+        self.writer = None
+        self.journal = None
+        self.applier = None
+        self.journal_key = None
+        if journal_folder is None and batch_size > 0:
+            self.writer = BatchWriter(self.store_events,
+                                      batch_size=batch_size,
+                                      max_latency_seconds=max_latency_seconds,
+                                      queue_size=queue_size,
+                                      name="streamer-writer")
+        self.connection_events = ConnectionEventRecorder(Session,
+                                                         level=connection_log_level,
+                                                         coalesce_seconds=coalesce_seconds)
+        if journal_folder is not None:
+            # Last, the applier starts on what is left in the journal straight away
+            self.journal = MessageJournal(journal_folder, sync=journal_sync)
+            self.journal_key = str(Path(journal_folder).resolve())
+            self._skip_stored_messages()
+            self.applier = JournalApplier(self.journal, self.apply_messages,
+                                          batch_size=batch_size if batch_size > 0 else JOURNAL_BATCH_SIZE,
+                                          name="streamer-journal",
+                                          positions=True)
+
+    def _skip_stored_messages(self) -> None:
+        # The messages stored before the checkpoint file was last written are not stored again
+        try:
+            with self.session_scope() as session:
+                progress = session.query(JournalProgress).get(self.journal_key)
+                stored = JournalPosition(progress.segment, progress.offset) if progress is not None else None
+        except OperationalError as e:
+            self.logger.warning(f"Could not read how far the journal has been stored, starting from its "
+                                f"checkpoint: {str(e)}")
+            return
+        if stored is not None and self.journal.checkpoint < stored <= self.journal.end:
+            self.logger.warning(f"The messages in the journal up to {stored} were stored but the checkpoint "
+                                f"{self.journal.checkpoint} was not written, moving it on")
+            self.journal.commit(stored)
 
     @contextmanager
     def session_scope(self):
@@ -42,88 +413,257 @@ class Streamer(SensorListener):
         finally:
             session.close()
 
+    def parse_message(self, payload: bytes) -> Optional[EventRecord]:
+        """
+        Pull the fields to be stored out of the message, see parse_message
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return parse_message(payload)
+        if not metrics.sample_parse():
+            record = parse_message(payload)
+        else:
+            start = perf_counter()
+            msgobj = decode_uplink(payload)
+            decoded = perf_counter()
+            timestamp = parseiso8601(msgobj.metadata.time)
+            parsed = perf_counter()
+            record = record_from_uplink(msgobj, payload, timestamp)
+            metrics.observe_parse(EVENT_TYPE_NAMES[record.event_class] if record is not None else OTHER_TYPE_NAME,
+                                  decoded - start, parsed - decoded)
+        metrics.count_message(EVENT_TYPE_NAMES[record.event_class] if record is not None else OTHER_TYPE_NAME)
+        return record
+
+    def suppress_duplicate(self, record: EventRecord) -> bool:
+        """
+        Check the record against the dedup window, see suppress_duplicate
+        :param record: The record just received
+        :return: True if there is nothing more to do with the record
+        """
+        suppressed = suppress_duplicate(self.dedup, record, self._fold_lock)
+        if suppressed and self.metrics is not None:
+            self.metrics.duplicates.labels().inc()
+        return suppressed
+
+    def count_error(self, stage: str) -> None:
+        """
+        Count a message that could not be parsed or stored, if there are metrics
+        :param stage: parse or store
+        :return: None
+        """
+        if self.metrics is not None:
+            self.metrics.errors.labels(stage).inc()
+
+    def store_events(self, records: List[EventRecord]) -> None:
+        """
+        Write the records to the database in a single transaction. If that fails each
+        record is tried on its own so one bad message does not lose the whole batch.
+        :param records: The records to write
+        :return: None
+        """
+        timed = self.metrics is not None and self.metrics.sample_store()
+        start = perf_counter() if timed else 0.0
+        with self._fold_lock:
+            for record in records:
+                record.taken = True
+        # Sensors are resolved before the transaction is opened because the registry
+        # writes new sensors in its own session, which with SQLite would have to wait for ours
+        sensor_ids = [self.registry.ensure(x.device_id, x.device_name) for x in records]
+        if self.gateways is not None:
+            for record in records:
+                for gateway in identified_gateways(record.metadata):
+                    self.gateways.ensure(gateway.gtw_id)
+        if self.metrics is not None:
+            self.metrics.batch_size.labels().observe(len(records))
+            if timed:
+                self.metrics.observe_store("sensor_lookup", perf_counter() - start)
+        if len(records) == 1:
+            self._store_one(records[0], sensor_ids[0], timed)
+            return
+        try:
+            self._write(records, sensor_ids, timed)
+        except IntegrityError as e:
+            # Expected after a restart when copies are suppressed, the window starts empty
+            self.logger.warning(f"Batch of {len(records)} failed, writing one at a time: {str(e.orig)}")
+            self._store_each(records, sensor_ids)
+        except Exception as e:
+            if self.journal is not None and isinstance(e, OperationalError):
+                # The database is not available, see apply_messages
+                raise
+            self.logger.error(f"Batch of {len(records)} failed, writing one at a time: {str(e)}")
+            self._store_each(records, sensor_ids)
+        else:
+            for record in records:
+                record.stored = True
+            if self.metrics is not None:
+                self.metrics.count_stored(records)
+
+    def _write(self, records: List[EventRecord], sensor_ids: List[str], timed: bool = False) -> None:
+        if not timed:
+            with self.session_scope() as session:
+                self._add_events(session, records, sensor_ids)
+            return
+        start = perf_counter()
+        with self.session_scope() as session:
+            self._add_events(session, records, sensor_ids)
+            # Flushed here so the commit is timed on its own
+            session.flush()
+            flushed = perf_counter()
+        self.metrics.observe_store("orm_flush", flushed - start)
+        self.metrics.observe_store("commit", perf_counter() - flushed)
+
+    def _store_each(self, records: List[EventRecord], sensor_ids: List[str]) -> None:
+        for record, sensor_id in zip(records, sensor_ids):
+            try:
+                self._store_one(record, sensor_id)
+            except Exception as e:
+                if self.journal is not None and isinstance(e, OperationalError):
+                    raise
+                self.count_error("store")
+                self.logger.error(f"Exception storing message {str(e)}")
+                self.logger.error(f"Bad payload: {record.raw_message.decode()}")
+
+    def _store_one(self, record: EventRecord, sensor_id: str, timed: bool = False) -> None:
+        try:
+            self._write([record], [sensor_id], timed)
+        except IntegrityError:
+            if record.time_bucket is None or record.is_duplicate:
+                raise
+            # Stored before a restart, so the dedup window did not know about it
+            self.logger.info(f"Message {record.counter} from {record.device_id} is already stored")
+            record.is_duplicate = True
+            with self.session_scope() as session:
+                self._add_events(session, [record], [sensor_id])
+        record.stored = True
+        if self.metrics is not None:
+            self.metrics.count_stored([record])
+
+    def _add_events(self, session, records: List[EventRecord], sensor_ids: List[str]) -> None:
+        fold_copies(session, records, sensor_ids)
+        new = [(x, y) for x, y in zip(records, sensor_ids) if not x.is_duplicate]
+        events = [x.to_event(y) for x, y in new]
+        session.add_all(events)
+        if self.gateways is not None and events:
+            # The receptions need the ids of the events
+            session.flush()
+            gateway_ids = {}
+            rows = []
+            for (record, sensor_id), event in zip(new, events):
+                for gateway in identified_gateways(record.metadata):
+                    gateway_ids[gateway.gtw_id] = self.gateways.get_id(gateway.gtw_id)
+                rows.extend(reception_rows(event.id, sensor_id, record.timestamp, record.metadata, gateway_ids))
+            if rows:
+                session.execute(Reception.__table__.insert(), rows)
+        if self.maintain_rollups:
+            add_measurements(session, [(y, x.timestamp, x.temp_c, x.humidity_percent)
+                                       for x, y in new
+                                       if x.event_class is TempHumidityMeasurement])
+        positions = [x.journal_position for x in records if x.journal_position is not None]
+        if positions:
+            session.merge(JournalProgress(folder=self.journal_key,
+                                          segment=max(positions).segment,
+                                          offset=max(positions).offset,
+                                          updated=get_utc_now()))
+
     def on_message(self, topic: bytes, payload: bytes):
+        if self.journal is not None:
+            try:
+                self.journal.append(payload)
+            except Exception as e:
+                self.logger.error(f"Exception writing message to the journal {str(e)}")
+                self.logger.error(f"Lost payload: {payload.decode()}")
+            return
         try:
-            msgobj = json.loads(payload, object_hook=customMeasurementDecoder)
-            # Temporary to gather more messages for testing
-            self.logger.info(payload.decode())
-            if msgobj.payload_fields.msgtype == THSensorMsgType.SUPERVISORY.value:
-                device_id = msgobj.hardware_serial
-                device_name = msgobj.dev_id
-                timestamp = parseiso8601(msgobj.metadata.time)
-                with self.session_scope() as session:
-                    # Make a new device if this one does not exist
-                    sensor = session.query(Sensor).get(device_id)
-                    if sensor is None:
-                        sensor = Sensor(device_id=device_id, device_name=device_name)
-                    th_event = Supervisory(timestamp=timestamp,
-                                           raw_message=payload,
-                                           counter=msgobj.counter,
-                                           sensor=sensor)
-                    session.add(th_event)
-            elif msgobj.payload_fields.msgtype == THSensorMsgType.LINK_QUALITY.value:
-                device_id = msgobj.hardware_serial
-                device_name = msgobj.dev_id
-                timestamp = parseiso8601(msgobj.metadata.time)
-                with self.session_scope() as session:
-                    # Make a new device if this one does not exist
-                    sensor = session.query(Sensor).get(device_id)
-                    if sensor is None:
-                        sensor = Sensor(device_id=device_id, device_name=device_name)
-                    th_event = LinkQ(timestamp=timestamp,
-                                     raw_message=payload,
-                                     counter=msgobj.counter,
-                                     sensor=sensor)
-                    session.add(th_event)
-            elif msgobj.payload_fields.msgtype == THSensorMsgType.UPLINK.value:
-                # Sensor event
-                if msgobj.payload_fields.sensor_event_type == THSensorEventType.PERIODIC.value or \
-                        msgobj.payload_fields.sensor_event_type == THSensorEventType.HMD_CHANGE_DECREASE.value or \
-                        msgobj.payload_fields.sensor_event_type == THSensorEventType.HMD_CHANGE_INCREASE.value or \
-                        msgobj.payload_fields.sensor_event_type == THSensorEventType.TEMP_CHANGE_DECREASE.value or \
-                        msgobj.payload_fields.sensor_event_type == THSensorEventType.TEMP_CHANGE_INCREASE.value:
-                    device_id = msgobj.hardware_serial
-                    device_name = msgobj.dev_id
-                    temp_c = msgobj.payload_fields.temp_c
-                    humidity_percent = msgobj.payload_fields.humidity_percent
-                    timestamp = parseiso8601(msgobj.metadata.time)
-                    with self.session_scope() as session:
-                        # Make a new device if this one does not exist
-                        sensor = session.query(Sensor).get(device_id)
-                        if sensor is None:
-                            sensor = Sensor(device_id=device_id, device_name=device_name)
-                        th_event = TempHumidityMeasurement(temp_c=temp_c,
-                                                           humidity_percent=humidity_percent,
-                                                           timestamp=timestamp,
-                                                           raw_message=payload,
-                                                           counter=msgobj.counter,
-                                                           sensor=sensor)
-                        session.add(th_event)
-                else:
-                    self.logger.warning(f"Not one of the expected uplink messages" \
-                                        f"{msgobj.payload_fields.sensor_event_type}")
-                    pass
+            record = self.parse_message(payload)
+            if record is None:
+                return
+            if self.dedup is not None and self.suppress_duplicate(record):
+                return
+            if self.writer is not None:
+                self.writer.put(record)
             else:
-                # Some other kind of message
-                pass
+                self.store_events([record])
         except Exception as e:
+            self.count_error("parse")
             self.logger.error(f"Exception parsing payload message {str(e)}")
             self.logger.error(f"Bad payload: {payload.decode()}")
 
+    def apply_messages(self, payloads: List[bytes], positions: List[JournalPosition] = None) -> None:
+        """
+        Store messages from the journal, called by the applier thread. While the database is
+        not available the same records are tried again, so the dedup window stays right, until
+        they are stored or the streamer is closed.
+        :param payloads: The messages
+        :param positions: The position in the journal after each message, stored in the
+        journal_progress table in the same transaction as the events
+        :return: None
+        :raise OperationalError: If the database is not available when the streamer is closed
+        """
+        records = []
+        for index, payload in enumerate(payloads):
+            try:
+                record = self.parse_message(payload)
+                if record is None:
+                    continue
+                if self.dedup is not None and self.suppress_duplicate(record):
+                    continue
+                if positions is not None:
+                    record.journal_position = positions[index]
+                records.append(record)
+            except Exception as e:
+                self.count_error("parse")
+                self.logger.error(f"Exception parsing payload message {str(e)}")
+                self.logger.error(f"Bad payload: {payload.decode()}")
+        if records and positions is not None:
+            # The messages after the last record are not stored, but are done with too
+            records[-1].journal_position = positions[-1]
+        delay = JOURNAL_RETRY_SECONDS
+        while records:
+            try:
+                self.store_events(records)
+                return
+            except OperationalError as e:
+                if self.applier.stopping:
+                    raise
+                self.logger.warning(f"Database not available, trying {len(records)} messages again "
+                                    f"in {delay} seconds: {str(e)}")
+            if self.applier.wait_for_stop(delay):
+                raise OperationalError("Closed while the database was not available", None, None)
+            # Some may have been stored one at a time
+            records = [x for x in records if not x.stored]
+            delay = min(2 * delay, JOURNAL_MAX_RETRY_SECONDS)
+
+    def flush(self) -> None:
+        """
+        Wait until everything received so far has been written
+        :return: None
+        """
+        if self.writer is not None:
+            self.writer.flush()
+        if self.applier is not None:
+            self.applier.flush()
+        self.connection_events.flush()
+
+    def close(self) -> None:
+        """
+        Write anything still queued and stop the writer thread
+        :return: None
+        """
+        if self.writer is not None:
+            self.writer.close()
+        if self.applier is not None:
+            self.applier.close()
+            self.journal.close()
+        self.connection_events.close()
+
     def on_disconnect(self, reason: str):
         self.logger.error(f"Upstream disconnected - {reason}")
 
-    def on_connection_event(self, reason: str) -> None:
+    def on_connection_event(self, reason: str, level: int = logging.INFO) -> None:
         """
-        Save this as a generic ConnectionEvent to the database
+        Pass the event to the background recorder, this does not wait for the database
         :param reason: The text of the event
+        :param level: The logging level of the event
         :return: None
         """
-        with self.session_scope() as session:
-            # Make a connection event message to save
-            # Right now the kind of Generic, not bothering to parse
-            # the reason to figure out what kind of event it is, will add
-            # this later
-            timenow = get_utc_now()
-            event = ConnectionEvent(timestamp=timenow, kind=ConnectEnum.GENERIC, desc=reason)
-            session.add(event)
+        self.connection_events.record(reason, level)
@@ -0,0 +1,71 @@
+"""
+Suppresses the repeated copies of confirmed uplinks. When a device does not get the
+acknowledgement of a confirmed uplink it sends it again with the same counter, and TTN
+delivers each copy with "is_retry": true. The window remembers the recent counters of each
+device so a copy can be folded into the first one before any database work is done.
+
+The window is only in memory. Across restarts the unique index on
+event(sensor_id, counter, time_bucket) catches the copies instead.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+# Copies of an uplink arrive within seconds; the counter is only expected to be unique
+# for a device within one of these periods, as it starts again when the device is reset
+DEDUP_BUCKET_SECONDS = 60 * 60
+
+
+def time_bucket_of(timestamp: datetime) -> int:
+    """
+    :param timestamp: The time the message was received
+    :return: The number of the period it falls in, stored in event.time_bucket
+    """
+    return int(timestamp.timestamp()) // DEDUP_BUCKET_SECONDS
+
+
+class DedupWindow:
+    """
+    The most recent counters seen from each device, with the first record received for each.
+    Bounded per device and in the number of devices, the least recently used go first.
+    Not thread safe, it is used from the receiving thread only.
+    """
+
+    def __init__(self, per_device: int = 32, max_devices: int = 1024):
+        """
+        :param per_device: The number of counters remembered for each device
+        :param max_devices: The number of devices remembered
+        """
+        self.per_device = per_device
+        self.max_devices = max_devices
+        self.duplicates = 0
+        self._devices = OrderedDict()  # type: OrderedDict[str, OrderedDict]
+
+    def check(self, device_id: str, counter: int, record) -> Optional[object]:
+        """
+        Look for an earlier copy of this message, remembering this one if there is none
+        :param device_id: The hardware serial of the device
+        :param counter: The counter of the message
+        :param record: What to remember for this message
+        :return: What was remembered for the earlier copy, or None if this is the first
+        """
+        counters = self._devices.get(device_id)
+        if counters is None:
+            counters = OrderedDict()
+            self._devices[device_id] = counters
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        else:
+            self._devices.move_to_end(device_id)
+        first = counters.get(counter)
+        if first is not None:
+            counters.move_to_end(counter)
+            self.duplicates += 1
+            return first
+        counters[counter] = record
+        if len(counters) > self.per_device:
+            counters.popitem(last=False)
+        return None
+
+    def __len__(self):
+        return sum(len(x) for x in self._devices.values())
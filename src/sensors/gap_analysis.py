@@ -0,0 +1,288 @@
+"""
+Finds gaps in the counter sequence of the events from each sensor, which could indicate
+missing messages. The gaps are found by the database using the LAG() window function over
+the events of each sensor in counter order; for databases without window functions the
+events are streamed in the same order and the gaps found as they go by.
+
+update_checkpoints does the same incrementally: a GapCheckpoint per sensor records how far
+the last run got, and only the events stored since then are read.
+"""
+import logging
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Iterable, Union
+
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from models.models import LoraEvent, CustomDateTime, Supervisory, Sensor, GapCheckpoint
+from utils.date_time_utils import get_utc_now
+
+SUPERVISORY_TYPE = Supervisory.__mapper_args__['polymorphic_identity']
+
+
+class CounterGap(NamedTuple):
+    """
+    A jump of more than one in the counter between two consecutive events from a sensor
+    """
+    sensor_id: str
+    prev_counter: int
+    prev_timestamp: datetime
+    counter: int
+    timestamp: datetime
+    # The number of counters in the unbroken run that ended at prev_counter
+    run_length: int
+
+    @property
+    def missing(self) -> int:
+        """
+        :return: The number of counters missing in this gap
+        """
+        return self.counter - self.prev_counter - 1
+
+
+class SensorGapReport(NamedTuple):
+    """
+    The summary of the events from one sensor and the gaps in them
+    """
+    sensor_id: str
+    event_count: int
+    first_counter: int
+    last_counter: int
+    first_timestamp: datetime
+    last_timestamp: datetime
+    gaps: List[CounterGap]
+
+    @property
+    def missing_total(self) -> int:
+        """
+        :return: The number of counters missing across all the gaps
+        """
+        return sum(x.missing for x in self.gaps)
+
+
+def find_gaps(bind: Union[Engine, Connection],
+              sensor_ids: Iterable[str] = None,
+              exclude_supervisory: bool = False,
+              use_window_functions: bool = True) -> List[SensorGapReport]:
+    """
+    Find the gaps in the counters of each sensor
+    :param bind: The engine or connection to query
+    :param sensor_ids: Only look at these sensors, default is all the sensors with events
+    :param exclude_supervisory: Leave out gaps next to a Supervisory message, the counter
+    often jumps around these
+    :param use_window_functions: Find the gaps in the database; if False, or if the database
+    does not support window functions, the events are streamed and the gaps found here
+    :return: A report per sensor, in sensor_id order
+    """
+    logger = logging.getLogger("event.validator")
+    sensor_ids = list(sensor_ids) if sensor_ids is not None else None
+    summaries = _summaries(bind, sensor_ids)
+    gaps = None
+    if use_window_functions:
+        try:
+            gaps = _gaps_by_window(bind, sensor_ids, exclude_supervisory)
+        except DBAPIError as e:
+            logger.warning(f"Window functions not available, streaming the events instead: {str(e)}")
+    if gaps is None:
+        gaps = _gaps_by_streaming(bind, sensor_ids, exclude_supervisory)
+    return make_reports(summaries, gaps)
+
+
+def make_reports(summaries, gaps: Dict[str, List[CounterGap]]) -> List[SensorGapReport]:
+    """
+    Put the summary and the gaps of each sensor together, working out the run before each gap
+    :param summaries: A row per sensor with sensor_id, event_count, first_counter, last_counter,
+    first_timestamp and last_timestamp, in sensor_id order
+    :param gaps: The gaps of each sensor in counter order, by sensor_id
+    :return: A report per sensor, in sensor_id order
+    """
+    reports = []
+    for row in summaries:
+        sensor_gaps = []
+        run_start = row.first_counter
+        for gap in gaps.get(row.sensor_id, []):
+            sensor_gaps.append(gap._replace(run_length=gap.prev_counter - run_start))
+            run_start = gap.counter
+        reports.append(SensorGapReport(sensor_id=row.sensor_id,
+                                       event_count=row.event_count,
+                                       first_counter=row.first_counter,
+                                       last_counter=row.last_counter,
+                                       first_timestamp=row.first_timestamp,
+                                       last_timestamp=row.last_timestamp,
+                                       gaps=sensor_gaps))
+    return reports
+
+
+def _sensor_filter(events, sensor_ids: Optional[List[str]]):
+    if sensor_ids is None:
+        return events.c.sensor_id.isnot(None)
+    return events.c.sensor_id.in_(sensor_ids)
+
+
+def _summaries(bind, sensor_ids: Optional[List[str]]):
+    events = LoraEvent.__table__
+    query = select([events.c.sensor_id,
+                    func.count().label('event_count'),
+                    func.min(events.c.counter).label('first_counter'),
+                    func.max(events.c.counter).label('last_counter'),
+                    func.min(events.c.timestamp).label('first_timestamp'),
+                    func.max(events.c.timestamp).label('last_timestamp')]) \
+        .where(_sensor_filter(events, sensor_ids)) \
+        .group_by(events.c.sensor_id) \
+        .order_by(events.c.sensor_id)
+    return bind.execute(query).fetchall()
+
+
+def window_gap_query(sensor_ids: Optional[List[str]], exclude_supervisory: bool):
+    """
+    Make the query that finds the gaps using the LAG() window function
+    :param sensor_ids: Only look at these sensors, None for all
+    :param exclude_supervisory: Leave out gaps next to a Supervisory message
+    :return: A select of sensor_id, prev_counter, prev_timestamp, counter, timestamp
+    for each gap, in sensor and counter order
+    """
+    events = LoraEvent.__table__
+    # Ordering by id as well makes retries, which share a counter, come in the order received
+    window = {'partition_by': events.c.sensor_id, 'order_by': [events.c.counter, events.c.id]}
+    ordered = select([events.c.sensor_id,
+                      events.c.counter,
+                      events.c.timestamp,
+                      events.c.type,
+                      func.lag(events.c.counter).over(**window).label('prev_counter'),
+                      func.lag(events.c.timestamp, type_=CustomDateTime).over(**window).label('prev_timestamp'),
+                      func.lag(events.c.type).over(**window).label('prev_type')]) \
+        .where(_sensor_filter(events, sensor_ids)) \
+        .alias('ordered')
+    condition = ordered.c.counter > ordered.c.prev_counter + 1
+    if exclude_supervisory:
+        condition = and_(condition,
+                         ordered.c.type != SUPERVISORY_TYPE,
+                         or_(ordered.c.prev_type.is_(None), ordered.c.prev_type != SUPERVISORY_TYPE))
+    return select([ordered.c.sensor_id, ordered.c.prev_counter, ordered.c.prev_timestamp,
+                   ordered.c.counter, ordered.c.timestamp]) \
+        .where(condition) \
+        .order_by(ordered.c.sensor_id, ordered.c.counter)
+
+
+def _gaps_by_window(bind, sensor_ids: Optional[List[str]], exclude_supervisory: bool):
+    gaps = {}
+    for row in bind.execute(window_gap_query(sensor_ids, exclude_supervisory)):
+        gaps.setdefault(row.sensor_id, []).append(CounterGap(*row, run_length=0))
+    return gaps
+
+
+def _gaps_by_streaming(bind, sensor_ids: Optional[List[str]], exclude_supervisory: bool):
+    events = LoraEvent.__table__
+    query = select([events.c.sensor_id, events.c.counter, events.c.timestamp, events.c.type]) \
+        .where(_sensor_filter(events, sensor_ids)) \
+        .order_by(events.c.sensor_id, events.c.counter, events.c.id) \
+        .execution_options(stream_results=True)
+    gaps = {}
+    prev = None
+    for row in bind.execute(query):
+        if prev is not None and prev.sensor_id == row.sensor_id and row.counter > prev.counter + 1:
+            if not exclude_supervisory or SUPERVISORY_TYPE not in (prev.type, row.type):
+                gaps.setdefault(row.sensor_id, []).append(
+                    CounterGap(row.sensor_id, prev.counter, prev.timestamp, row.counter, row.timestamp,
+                               run_length=0))
+        prev = row
+    return gaps
+
+
+def new_events_query(sensor_id: str, last_event_id: int):
+    """
+    Make the query for the events of a sensor stored after a given one
+    :param sensor_id: The sensor
+    :param last_event_id: The id of the last event already seen, 0 for all of them
+    :return: A select of id, counter, timestamp and type, in no particular order
+    """
+    events = LoraEvent.__table__
+    return select([events.c.id, events.c.counter, events.c.timestamp, events.c.type]) \
+        .where(and_(events.c.sensor_id == sensor_id, events.c.id > last_event_id))
+
+
+def update_checkpoints(session: Session,
+                       sensor_ids: Iterable[str] = None,
+                       exclude_supervisory: bool = False) -> List[SensorGapReport]:
+    """
+    Look for gaps in the events stored since the last time this was run, and move the
+    checkpoint of each sensor on. The work done depends only on the number of new events.
+    New events are taken in the order they were received, by timestamp. One with a counter
+    lower than the checkpoint arrived late and is skipped, unless it is also newer, in which
+    case the device was reset and a new run starts.
+    :param session: The session to use, it is committed
+    :param sensor_ids: Only look at these sensors, default is all sensors
+    :param exclude_supervisory: Leave out gaps next to a Supervisory message
+    :return: A report per sensor; the counts and first counter/time are for the whole
+    history, the gaps are only the new ones found by this run
+    """
+    if sensor_ids is None:
+        sensor_ids = [x for x, in session.query(Sensor.device_id).order_by(Sensor.device_id)]
+    reports = []
+    for sensor_id in sensor_ids:
+        checkpoint = session.query(GapCheckpoint).get((sensor_id, exclude_supervisory))
+        last_event_id = checkpoint.last_event_id if checkpoint is not None else 0
+        # Only the new events are read, through ix_event_sensor_id, and put in the order they
+        # were received here; by counter a reset in the batch would come before the events it follows
+        rows = sorted(session.execute(new_events_query(sensor_id, last_event_id)).fetchall(),
+                      key=lambda x: (x.timestamp, x.id))
+        if not rows:
+            if checkpoint is not None:
+                reports.append(_checkpoint_report(checkpoint, []))
+            continue
+        if checkpoint is None:
+            first = rows[0]
+            checkpoint = GapCheckpoint(sensor_id=sensor_id,
+                                       exclude_supervisory=exclude_supervisory,
+                                       last_counter=first.counter,
+                                       last_timestamp=first.timestamp,
+                                       last_type=first.type,
+                                       first_counter=first.counter,
+                                       first_timestamp=first.timestamp,
+                                       run_start_counter=first.counter,
+                                       event_count=0,
+                                       gap_count=0,
+                                       missing_total=0)
+            session.add(checkpoint)
+        new_gaps = []
+        processed = 0
+        for row in rows:
+            if row.counter < checkpoint.last_counter:
+                if row.timestamp > checkpoint.last_timestamp:
+                    # The counter went backwards, the device was reset, start a new run
+                    checkpoint.run_start_counter = row.counter
+                else:
+                    # A message that arrived late
+                    continue
+            elif row.counter > checkpoint.last_counter + 1:
+                if not exclude_supervisory or SUPERVISORY_TYPE not in (checkpoint.last_type, row.type):
+                    gap = CounterGap(sensor_id, checkpoint.last_counter, checkpoint.last_timestamp,
+                                     row.counter, row.timestamp,
+                                     run_length=checkpoint.last_counter - checkpoint.run_start_counter)
+                    new_gaps.append(gap)
+                    checkpoint.gap_count += 1
+                    checkpoint.missing_total += gap.missing
+                    checkpoint.run_start_counter = row.counter
+            checkpoint.last_counter = row.counter
+            checkpoint.last_timestamp = row.timestamp
+            checkpoint.last_type = row.type
+            processed += 1
+        # The late events that were skipped are not counted, as they are not in the runs either
+        checkpoint.event_count += processed
+        checkpoint.last_event_id = max(x.id for x in rows)
+        checkpoint.updated = get_utc_now()
+        reports.append(_checkpoint_report(checkpoint, new_gaps))
+    session.commit()
+    return reports
+
+
+def _checkpoint_report(checkpoint: GapCheckpoint, new_gaps: List[CounterGap]) -> SensorGapReport:
+    return SensorGapReport(sensor_id=checkpoint.sensor_id,
+                           event_count=checkpoint.event_count,
+                           first_counter=checkpoint.first_counter,
+                           last_counter=checkpoint.last_counter,
+                           first_timestamp=checkpoint.first_timestamp,
+                           last_timestamp=checkpoint.last_timestamp,
+                           gaps=new_gaps)
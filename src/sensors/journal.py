@@ -0,0 +1,373 @@
+"""
+An append-only journal of the raw messages, written before they go to the database, so that a
+message is not lost when the database is slow or unavailable. Receiving a message then costs
+a sequential append rather than a database commit, and a background applier drains the journal
+into the database, see JournalApplier.
+
+The journal is a folder of segment files, each made at its full size and memory mapped. Each
+message is written as its length and CRC-32 (two little-endian unsigned 32 bit integers)
+followed by the message; a zero length marks the end of what has been written. A message
+written to the map survives the program crashing, as the operating system writes the pages
+out; with sync the pages are flushed after each message so it also survives losing power.
+
+How far the applier has got is kept in the checkpoint file. When the journal is opened again
+the messages after the checkpoint are applied first, and segments that have been applied are
+deleted. A message that was only partly written when the program stopped fails its CRC and
+is written over. The checkpoint file is written after the messages have been applied, so a
+crash in between would apply them again; an apply function that stores the position after
+each message along with it (see JournalApplier positions) lets the owner of the journal move
+the checkpoint on to that position when it is opened again.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# The length and CRC-32 of a message
+HEADER = struct.Struct("<II")
+
+# The size of a new segment file, a message bigger than this gets a segment of its own size
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+SEGMENT_SUFFIX = ".journal"
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+class JournalPosition(NamedTuple):
+    """
+    A place in the journal, the segment number and the offset within it
+    """
+    segment: int
+    offset: int
+
+
+class MessageJournal:
+    """
+    The segment files of the journal. Messages are appended by one thread and read and
+    applied by another.
+    """
+
+    def __init__(self, folder: Path, segment_size: int = SEGMENT_SIZE, sync: bool = False):
+        """
+        :param folder: The folder of the segment files, made if it does not exist
+        :param segment_size: The size of a new segment file in bytes
+        :param sync: Flush each message to the disk as it is written, otherwise the operating
+        system writes it out in its own time
+        """
+        self.folder = Path(folder)
+        self.segment_size = segment_size
+        self.sync = sync
+        self.logger = logging.getLogger("lora.mqtt")
+        # Notified when a message is appended or the checkpoint moves
+        self._condition = threading.Condition()
+        self._maps = {}  # type: Dict[int, mmap.mmap]
+        self._closed = False
+        os.makedirs(self.folder, exist_ok=True)
+        self._checkpoint = self._read_checkpoint()
+        for number in self._segment_numbers():
+            if number < self._checkpoint.segment:
+                os.remove(self._segment_path(number))
+            else:
+                self._open_segment(number)
+        if not self._maps:
+            self._create_segment(self._checkpoint.segment, self.segment_size)
+        last = max(self._maps)
+        start = self._checkpoint.offset if last == self._checkpoint.segment else 0
+        self._end = self._scan(last, start)
+        pending = self.pending_bytes()
+        if pending:
+            self.logger.info(f"Journal {self.folder} has {pending} bytes of messages to apply")
+
+    @property
+    def checkpoint(self) -> JournalPosition:
+        """
+        :return: Where the messages that have not been applied start
+        """
+        return self._checkpoint
+
+    @property
+    def end(self) -> JournalPosition:
+        """
+        :return: Where the next message will be written
+        """
+        return self._end
+
+    def pending_bytes(self) -> int:
+        """
+        :return: Roughly how many bytes of messages have not been applied yet
+        """
+        with self._condition:
+            if self._end.segment == self._checkpoint.segment:
+                return self._end.offset - self._checkpoint.offset
+            total = len(self._maps[self._checkpoint.segment]) - self._checkpoint.offset
+            for number in range(self._checkpoint.segment + 1, self._end.segment):
+                total += len(self._maps[number])
+            return total + self._end.offset
+
+    def append(self, message: bytes) -> JournalPosition:
+        """
+        Write a message to the end of the journal
+        :param message: The message
+        :return: The position after the message
+        """
+        size = HEADER.size + len(message)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The journal has been closed")
+            segment, offset = self._end
+            data = self._maps[segment]
+            if offset + size > len(data):
+                # Left with a zero length at the end, the reader moves on to the next segment
+                segment, offset = segment + 1, 0
+                data = self._create_segment(segment, max(self.segment_size, size + HEADER.size))
+            HEADER.pack_into(data, offset, len(message), zlib.crc32(message))
+            data[offset + HEADER.size:offset + size] = message
+            if offset + size + HEADER.size <= len(data):
+                # Marks the end, in case of anything left from before a restart
+                HEADER.pack_into(data, offset + size, 0, 0)
+            if self.sync:
+                start = offset - offset % mmap.PAGESIZE
+                data.flush(start, min(len(data), offset + size + HEADER.size) - start)
+            self._end = JournalPosition(segment, offset + size)
+            self._condition.notify_all()
+            return self._end
+
+    def read(self, position: JournalPosition, max_messages: int) -> Tuple[List[bytes], JournalPosition]:
+        """
+        Read the messages after a position
+        :param position: Where to start
+        :param max_messages: The most messages to read
+        :return: The messages, and the position after the last of them
+        """
+        entries, after = self.read_entries(position, max_messages)
+        return [x for x, _ in entries], after
+
+    def read_entries(self, position: JournalPosition,
+                     max_messages: int) -> Tuple[List[Tuple[bytes, JournalPosition]], JournalPosition]:
+        """
+        Read the messages after a position, with the position after each of them
+        :param position: Where to start
+        :param max_messages: The most messages to read
+        :return: The messages and their positions, and the position after the last of them
+        """
+        messages = []
+        with self._condition:
+            end = self._end
+        segment, offset = position
+        while (segment, offset) < end and len(messages) < max_messages:
+            data = self._maps[segment]
+            if offset + HEADER.size > len(data):
+                segment, offset = segment + 1, 0
+                continue
+            length, crc = HEADER.unpack_from(data, offset)
+            if length == 0:
+                segment, offset = segment + 1, 0
+                continue
+            message = data[offset + HEADER.size:offset + HEADER.size + length]
+            if zlib.crc32(message) != crc:
+                self.logger.error(f"Journal segment {segment} is damaged at {offset}, skipping the rest of it")
+                segment, offset = segment + 1, 0
+                continue
+            offset += HEADER.size + length
+            messages.append((message, JournalPosition(segment, offset)))
+        return messages, JournalPosition(segment, offset)
+
+    def wait(self, position: JournalPosition, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for a message to be written after a position
+        :param position: The position
+        :param timeout: Seconds to wait, None waits forever
+        :return: True if there is a message after the position
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._end > position or self._closed, timeout) \
+                and self._end > position
+
+    def commit(self, position: JournalPosition) -> None:
+        """
+        Record that the messages before a position have been applied, deleting the segments
+        that are done with
+        :param position: The position after the last message applied
+        """
+        with self._condition:
+            self._write_checkpoint(position)
+            for number in [x for x in self._maps if x < position.segment]:
+                self._maps.pop(number).close()
+                os.remove(self._segment_path(number))
+            self._checkpoint = position
+            self._condition.notify_all()
+
+    def wait_applied(self, position: JournalPosition, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the messages before a position to be applied
+        :param position: The position, e.g. the end when a flush was asked for
+        :param timeout: Seconds to wait, None waits forever
+        :return: True if they were applied within the timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._checkpoint >= position or self._closed, timeout) \
+                and self._checkpoint >= position
+
+    def close(self) -> None:
+        """
+        Close the segment files, the messages not applied stay in them for the next time
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            for data in self._maps.values():
+                data.flush()
+                data.close()
+            self._maps.clear()
+            self._condition.notify_all()
+
+    def _segment_path(self, number: int) -> Path:
+        return self.folder / f"{number:08d}{SEGMENT_SUFFIX}"
+
+    def _segment_numbers(self) -> List[int]:
+        return sorted(int(x.stem) for x in self.folder.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def _open_segment(self, number: int) -> mmap.mmap:
+        with open(self._segment_path(number), "r+b") as file:
+            data = mmap.mmap(file.fileno(), 0)
+        self._maps[number] = data
+        return data
+
+    def _create_segment(self, number: int, size: int) -> mmap.mmap:
+        with open(self._segment_path(number), "w+b") as file:
+            # Sparse, the disk space is taken as the messages are written
+            file.truncate(size)
+        return self._open_segment(number)
+
+    def _scan(self, number: int, offset: int) -> JournalPosition:
+        """
+        Find the end of the messages in the last segment
+        """
+        data = self._maps[number]
+        while offset + HEADER.size <= len(data):
+            length, crc = HEADER.unpack_from(data, offset)
+            if length == 0 or offset + HEADER.size + length > len(data):
+                break
+            if zlib.crc32(data[offset + HEADER.size:offset + HEADER.size + length]) != crc:
+                self.logger.warning(f"Journal segment {number} ends with a partly written message at {offset}")
+                break
+            offset += HEADER.size + length
+        return JournalPosition(number, offset)
+
+    def _read_checkpoint(self) -> JournalPosition:
+        path = self.folder / CHECKPOINT_FILE
+        if path.exists():
+            with open(path, "r") as reader:
+                values = json.load(reader)
+            return JournalPosition(values['segment'], values['offset'])
+        numbers = self._segment_numbers()
+        return JournalPosition(numbers[0] if numbers else 0, 0)
+
+    def _write_checkpoint(self, position: JournalPosition) -> None:
+        temp_path = self.folder / (CHECKPOINT_FILE + ".tmp")
+        with open(temp_path, "w") as writer:
+            json.dump({'segment': position.segment, 'offset': position.offset}, writer)
+            if self.sync:
+                writer.flush()
+                os.fsync(writer.fileno())
+        os.replace(temp_path, self.folder / CHECKPOINT_FILE)
+
+
+class JournalApplier:
+    """
+    Drains the journal on a background thread, handing the messages to an apply function in
+    batches and moving the checkpoint on when each batch has been applied
+    """
+
+    def __init__(self,
+                 journal: MessageJournal,
+                 apply_function: Callable[..., None],
+                 batch_size: int = 100,
+                 name: str = "journal-applier",
+                 positions: bool = False):
+        """
+        :param journal: The journal
+        :param apply_function: Called on the applier thread with a list of messages. It should
+        only return when they have been stored; if it raises the applier stops, and the
+        messages are applied again when the journal is next opened.
+        :param batch_size: The most messages handed over at a time
+        :param name: The name of the applier thread
+        :param positions: Also pass the apply function the position after each message, the
+        last of them being after any that were skipped at the end of the batch
+        """
+        self.journal = journal
+        self.apply_function = apply_function
+        self.batch_size = batch_size
+        self.positions = positions
+        self.logger = logging.getLogger("lora.mqtt")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def stopping(self) -> bool:
+        """
+        :return: True once close has been called, the apply function should stop retrying
+        """
+        return self._stop.is_set()
+
+    def wait_for_stop(self, timeout: float) -> bool:
+        """
+        Wait, e.g. before trying the database again, returning early if close is called
+        :param timeout: Seconds to wait
+        :return: True if close has been called
+        """
+        return self._stop.wait(timeout)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the messages written so far to be applied
+        :param timeout: Seconds to wait, None waits forever
+        :return: True if they were applied within the timeout
+        """
+        if not self._thread.is_alive():
+            return self.journal.checkpoint >= self.journal.end
+        return self.journal.wait_applied(self.journal.end, timeout)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Apply what is in the journal and stop the applier thread. Safe to call more than once.
+        :param timeout: Seconds to wait for the applier thread to finish
+        """
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.logger.warning(f"Applier thread {self._thread.name} did not stop within {timeout} seconds")
+
+    def _run(self) -> None:
+        position = self.journal.checkpoint
+        while True:
+            entries, after = self.journal.read_entries(position, self.batch_size)
+            if not entries:
+                if after != position:
+                    # Only moved past the end of a segment
+                    self.journal.commit(after)
+                    position = after
+                    continue
+                if self._stop.is_set():
+                    return
+                self.journal.wait(position, timeout=0.5)
+                continue
+            messages = [x for x, _ in entries]
+            try:
+                if self.positions:
+                    self.apply_function(messages, [x for _, x in entries[:-1]] + [after])
+                else:
+                    self.apply_function(messages)
+            except Exception as e:
+                self.logger.error(f"Stopped applying the journal, {len(messages)} messages wait "
+                                  f"for the next start: {str(e)}")
+                return
+            self.journal.commit(after)
+            position = after
@@ -0,0 +1,137 @@
+"""
+Link quality from the reception table: the radio metadata of each uplink (which gateways
+heard it, with what RSSI and SNR, at what data rate) coded as numbers when the message is
+stored, so that trends can be found with indexed queries rather than by parsing the raw
+messages again.
+"""
+import re
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple, Union
+
+from sqlalchemy import select, and_, cast, func, Integer, type_coerce, Float
+from sqlalchemy.engine import Engine, Connection
+
+from models.models import Gateway, Modulation, Reception
+
+_DATA_RATE = re.compile(r"SF(\d+)BW(\d+)")
+
+
+def encode_data_rate(data_rate: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+    """
+    :param data_rate: The LoRa data rate as in metadata.data_rate, e.g. SF7BW125
+    :return: The spreading factor and the bandwidth in kHz, None if not a LoRa data rate
+    """
+    match = _DATA_RATE.fullmatch(data_rate or "")
+    if match is None:
+        return None, None
+    return int(match.group(1)), int(match.group(2))
+
+
+def encode_modulation(modulation: Optional[str]) -> int:
+    """
+    :param modulation: The modulation as in metadata.modulation, e.g. LORA
+    :return: The Modulation as stored
+    """
+    try:
+        return Modulation[(modulation or "").upper()].value
+    except KeyError:
+        return Modulation.UNKNOWN.value
+
+
+def identified_gateways(metadata) -> list:
+    """
+    :param metadata: The uplink_decoder.Metadata of a message
+    :return: The gateways that received it and have a gtw_id, a gateway without one can't be
+    stored in the gateway table so it is left out of the receptions
+    """
+    return [x for x in metadata.gateways if x.gtw_id is not None]
+
+
+def reception_rows(event_id: int, sensor_id: str, timestamp: datetime, metadata,
+                   gateway_ids: dict) -> List[dict]:
+    """
+    Make the reception rows for an uplink
+    :param event_id: The id of the stored event
+    :param sensor_id: The sensor that sent it
+    :param timestamp: The time of the event
+    :param metadata: The uplink_decoder.Metadata of the message
+    :param gateway_ids: The primary key of each gateway, by gtw_id
+    :return: A row for each identified gateway that received it, to insert into the reception table
+    """
+    spreading_factor, bandwidth_khz = encode_data_rate(metadata.data_rate)
+    modulation = encode_modulation(metadata.modulation)
+    frequency_khz = int(round(metadata.frequency * 1000)) if metadata.frequency is not None else None
+    # airtime is in nanoseconds
+    airtime_us = metadata.airtime // 1000 if metadata.airtime is not None else None
+    rows = []
+    seen = set()
+    for gateway in identified_gateways(metadata):
+        gateway_id = gateway_ids[gateway.gtw_id]
+        if gateway_id in seen:
+            continue
+        seen.add(gateway_id)
+        rows.append({'event_id': event_id,
+                     'gateway_id': gateway_id,
+                     'sensor_id': sensor_id,
+                     'timestamp': timestamp,
+                     'rssi': gateway.rssi,
+                     'snr': gateway.snr,
+                     'channel': gateway.channel,
+                     'spreading_factor': spreading_factor,
+                     'bandwidth_khz': bandwidth_khz,
+                     'modulation': modulation,
+                     'frequency_khz': frequency_khz,
+                     'airtime_us': airtime_us})
+    return rows
+
+
+def rssi_trend_query(resolution: int,
+                     sensor_ids: Iterable[str] = None,
+                     gtw_ids: Iterable[str] = None,
+                     start: datetime = None,
+                     end: datetime = None):
+    """
+    Make the query for the RSSI and SNR of each sensor at each gateway over time
+    :param resolution: The length of the periods summarised, in seconds
+    :param sensor_ids: Only these sensors, default is all
+    :param gtw_ids: Only these gateways, default is all
+    :param start: Only receptions at or after this time (UTC)
+    :param end: Only receptions before this time (UTC)
+    :return: A select of sensor_id, gtw_id, bucket (seconds since the epoch), count, rssi_min,
+    rssi_mean, rssi_max, snr_mean in sensor, gateway and time order
+    """
+    receptions = Reception.__table__
+    gateways = Gateway.__table__
+    conditions = [receptions.c.gateway_id == gateways.c.id]
+    if sensor_ids is not None:
+        conditions.append(receptions.c.sensor_id.in_(list(sensor_ids)))
+    if gtw_ids is not None:
+        conditions.append(gateways.c.gtw_id.in_(list(gtw_ids)))
+    if start is not None:
+        conditions.append(receptions.c.timestamp >= start)
+    if end is not None:
+        conditions.append(receptions.c.timestamp < end)
+    seconds = cast(type_coerce(receptions.c.timestamp, Float), Integer)
+    bucket = (cast(seconds / resolution, Integer) * resolution).label('bucket')
+    return select([receptions.c.sensor_id,
+                   gateways.c.gtw_id,
+                   bucket,
+                   func.count().label('count'),
+                   func.min(receptions.c.rssi).label('rssi_min'),
+                   func.avg(receptions.c.rssi).label('rssi_mean'),
+                   func.max(receptions.c.rssi).label('rssi_max'),
+                   func.avg(receptions.c.snr).label('snr_mean')]) \
+        .where(and_(*conditions)) \
+        .group_by(receptions.c.sensor_id, gateways.c.gtw_id, bucket) \
+        .order_by(receptions.c.sensor_id, gateways.c.gtw_id, bucket)
+
+
+def rssi_trend(bind: Union[Engine, Connection], resolution: int = 60 * 60, **filters) -> list:
+    """
+    The RSSI and SNR of each sensor at each gateway over time, see rssi_trend_query
+    :param bind: The engine or connection to query
+    :param resolution: The length of the periods summarised, in seconds, default an hour
+    :param filters: sensor_ids, gtw_ids, start and end as for rssi_trend_query
+    :return: The rows
+    """
+    return bind.execute(rssi_trend_query(resolution, **filters)).fetchall()
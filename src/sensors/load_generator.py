@@ -0,0 +1,305 @@
+"""
+Synthetic traffic for benchmarking the feed without TTN. TrafficGenerator makes TTN v2 uplink
+messages like the ones in tests/testdata for any number of simulated devices: measurements,
+Supervisory and Link Quality messages, and the copies of confirmed uplinks that are sent again
+when the acknowledgement is missed. The payloads are encoded as the sensors do, and
+payload_fields are decoded from them by sensors.payload_decoder, so they agree.
+
+run_load hands the messages to a SensorListener (e.g. a Streamer), either by calling
+on_message directly or through a LocalBroker, which stands in for the Paho client so that
+MqttComms delivers the messages on a network thread of its own, as it does when connected to
+TTN. It reports the messages per second and the latency of each message.
+"""
+import base64
+import heapq
+import json
+import queue
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from time import perf_counter, sleep
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+from sensors.message_protocol import THSensorMsgType, THSensorEventType
+from sensors.mqtt_comms import MqttComms, SensorListener
+from sensors.payload_decoder import decode_payload
+
+# The data rates used, with the airtime in nanoseconds of a measurement at each
+DATA_RATES = [("SF7BW125", 56576000), ("SF8BW125", 102912000), ("SF9BW125", 185344000),
+              ("SF10BW125", 370688000)]
+
+# The US915 sub-band 2 uplink channels, in MHz
+FREQUENCIES = [903.9, 904.1, 904.3, 904.5, 904.7, 904.9, 905.1, 905.3]
+
+# The kinds of measurement the sensors send, the threshold events are not configured
+CHANGE_EVENT_TYPES = [THSensorEventType.TEMP_CHANGE_INCREASE, THSensorEventType.TEMP_CHANGE_DECREASE,
+                      THSensorEventType.HMD_CHANGE_INCREASE, THSensorEventType.HMD_CHANGE_DECREASE]
+
+_STOP = object()
+
+
+class SimulatedDevice:
+    """
+    The state of one simulated temperature and humidity sensor
+    """
+    __slots__ = ('dev_id', 'hardware_serial', 'counter', 'temp_c', 'humidity', 'rssi', 'snr',
+                 'data_rate', 'gateways', 'next_time')
+
+    def __init__(self, number: int, gtw_ids: List[str], rng: random.Random, start: datetime):
+        self.dev_id = f"load-sensor-{number}"
+        self.hardware_serial = f"CCC07900{number:08X}"
+        self.counter = rng.randrange(0, 5000)
+        self.temp_c = rng.uniform(2.0, 30.0)
+        self.humidity = rng.uniform(30.0, 70.0)
+        self.rssi = rng.uniform(-110.0, -20.0)
+        self.snr = rng.uniform(-5.0, 11.0)
+        self.data_rate = DATA_RATES[min(len(DATA_RATES) - 1, int(max(0.0, -60.0 - self.rssi) // 15))]
+        # Most devices are heard by one gateway, some by two
+        self.gateways = rng.sample(gtw_ids, min(len(gtw_ids), 1 if rng.random() < 0.8 else 2))
+        self.next_time = start
+
+
+class TrafficGenerator:
+    """
+    Makes the messages of a fleet of simulated devices, in the order they are received
+    """
+
+    def __init__(self,
+                 devices: int = 3,
+                 interval_seconds: float = 600.0,
+                 retry_probability: float = 0.1,
+                 supervisory_probability: float = 0.15,
+                 linkq_probability: float = 0.001,
+                 gateways: int = 1,
+                 payload_fields: bool = True,
+                 start: datetime = None,
+                 app_id: str = "load-test",
+                 seed: int = 0):
+        """
+        :param devices: The number of devices
+        :param interval_seconds: The average time between the messages of a device
+        :param retry_probability: The chance that a confirmed uplink is sent again, then 1 to 5 copies are
+        :param supervisory_probability: The chance that a message is a Supervisory message
+        :param linkq_probability: The chance that a message is a Link Quality message
+        :param gateways: The number of gateways receiving the devices
+        :param payload_fields: Include the payload_fields, as when payload formatting is on in TTN
+        :param start: The time of the first messages, default is 2020-10-01 UTC
+        :param app_id: The TTN application id of the messages
+        :param seed: The seed of the random numbers, the same seed makes the same messages
+        """
+        self.interval_seconds = interval_seconds
+        self.retry_probability = retry_probability
+        self.supervisory_probability = supervisory_probability
+        self.linkq_probability = linkq_probability
+        self.payload_fields = payload_fields
+        self.app_id = app_id
+        self.rng = random.Random(seed)
+        if start is None:
+            start = datetime(2020, 10, 1, tzinfo=timezone.utc)
+        gtw_ids = [f"eui-58a0cbfffe8{x:05x}" for x in range(gateways)]
+        self.devices = [SimulatedDevice(x, gtw_ids, self.rng, start) for x in range(devices)]
+        for device in self.devices:
+            # Spread the first messages over an interval
+            device.next_time = start + timedelta(seconds=self.rng.uniform(0, interval_seconds))
+
+    def topic(self, device: SimulatedDevice) -> str:
+        return f"{self.app_id}/devices/{device.dev_id}/up"
+
+    def messages(self, count: int) -> Iterator[Tuple[str, bytes]]:
+        """
+        :param count: The number of messages, copies included
+        :return: The topic and JSON payload of each message
+        """
+        # The next message of each device, in time order
+        pending = [(x.next_time, i) for i, x in enumerate(self.devices)]
+        heapq.heapify(pending)
+        made = 0
+        while made < count:
+            when, index = heapq.heappop(pending)
+            device = self.devices[index]
+            data = self._payload(device)
+            copies = 0
+            if self.rng.random() < self.retry_probability:
+                copies = self.rng.randint(1, 5)
+            for copy in range(copies + 1):
+                if made >= count:
+                    break
+                # The copies follow a few seconds apart
+                yield self.topic(device), self._message(device, data, when + timedelta(seconds=4.0 * copy),
+                                                        is_retry=copy > 0)
+                made += 1
+            device.counter += 1
+            gap = self.rng.expovariate(1.0 / self.interval_seconds)
+            heapq.heappush(pending, (when + timedelta(seconds=max(1.0, gap)), index))
+
+    def _payload(self, device: SimulatedDevice) -> bytes:
+        header = (1 << 4) | (device.counter & 0x0F)
+        draw = self.rng.random()
+        if draw < self.supervisory_probability:
+            # Error codes, sensor state, battery 3.0 volts, then the rest as the sensors send it
+            return bytes([header, THSensorMsgType.SUPERVISORY.value, 0, 0, 0x30,
+                          0x16, 0x70, 0x2A, 0x70, 0x00, 0x01])
+        if draw < self.supervisory_probability + self.linkq_probability:
+            # The sub-band, then the RSSI and SNR of the last downlink
+            return bytes([header, THSensorMsgType.LINK_QUALITY.value, 2,
+                          int(device.rssi) & 0xFF, int(device.snr) & 0xFF])
+        device.temp_c = min(60.0, max(-20.0, device.temp_c + self.rng.gauss(0.0, 0.3)))
+        # The sensor sends one decimal for both the temperature and the humidity
+        value = round(abs(device.temp_c), 1)
+        whole = int(value)
+        decimal = int(round((value - whole) * 10))
+        device.humidity = min(99.0, max(1.0, device.humidity + self.rng.gauss(0.0, 0.5)))
+        event_type = THSensorEventType.PERIODIC if self.rng.random() < 0.6 \
+            else self.rng.choice(CHANGE_EVENT_TYPES)
+        return bytes([header, THSensorMsgType.UPLINK.value, event_type.value,
+                      whole | (0x80 if device.temp_c < 0 else 0), decimal << 4, int(device.humidity)])
+
+    def _message(self, device: SimulatedDevice, data: bytes, when: datetime, is_retry: bool) -> bytes:
+        data_rate, airtime = device.data_rate
+        time = when.strftime("%Y-%m-%dT%H:%M:%S.%f") + f"{self.rng.randrange(1000):03d}Z"
+        gateways = []
+        for gtw_id in device.gateways:
+            gateways.append({'gtw_id': gtw_id,
+                             'timestamp': self.rng.randrange(1 << 32),
+                             'time': time,
+                             'channel': self.rng.randrange(len(FREQUENCIES)),
+                             'rssi': round(device.rssi + self.rng.gauss(0.0, 3.0)),
+                             # In steps of a quarter dB, as the gateways report it
+                             'snr': round(4 * (device.snr + self.rng.gauss(0.0, 1.0))) / 4,
+                             'rf_chain': 0})
+        message = {'app_id': self.app_id,
+                   'dev_id': device.dev_id,
+                   'hardware_serial': device.hardware_serial,
+                   'port': 2,
+                   'counter': device.counter,
+                   'confirmed': True}
+        if is_retry:
+            message['is_retry'] = True
+        message['payload_raw'] = base64.b64encode(data).decode("ascii")
+        if self.payload_fields:
+            message['payload_fields'] = decode_payload(data)
+        message['metadata'] = {'time': time,
+                               'frequency': self.rng.choice(FREQUENCIES),
+                               'modulation': "LORA",
+                               'data_rate': data_rate,
+                               'airtime': airtime,
+                               'coding_rate': "4/5",
+                               'gateways': gateways}
+        return json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+
+class LocalBroker:
+    """
+    Stands in for the Paho client of an MqttComms: published messages are queued and handed to
+    MqttComms.on_message on a network thread, as Paho does for the messages from the broker.
+    """
+
+    def __init__(self, comms: MqttComms, queue_size: int = 10000):
+        """
+        :param comms: The MqttComms to deliver to, its client is replaced by this
+        :param queue_size: The most messages waiting to be delivered, publish blocks when full
+        """
+        self.comms = comms
+        self.comms.client = self
+        self.subscriptions = []  # type: List[str]
+        # The latency of each message delivered, from publish to on_message returning
+        self.latencies = []  # type: List[float]
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self.subscriptions.append(topic)
+        return mqtt.MQTT_ERR_SUCCESS, len(self.subscriptions)
+
+    def connect(self) -> None:
+        """
+        Start the network thread and tell the MqttComms it is connected
+        """
+        self._thread = threading.Thread(target=self._run, name="local-broker", daemon=True)
+        self._thread.start()
+        self.comms.on_connect(self, None, {}, 0)
+
+    def publish(self, topic: str, payload: bytes) -> None:
+        self._queue.put((topic, payload, perf_counter()))
+
+    def disconnect(self) -> None:
+        """
+        Deliver what has been published and stop the network thread
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+        self.comms.on_disconnect(self, None, 0)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            topic, payload, published = item
+            if any(mqtt.topic_matches_sub(x, topic) for x in self.subscriptions):
+                message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+                message.payload = payload
+                self.comms.on_message(self, None, message)
+                self.latencies.append(perf_counter() - published)
+
+
+class LoadReport(NamedTuple):
+    """
+    What a run of the load generator measured
+    """
+    messages: int
+    # From the first message to the last one delivered
+    seconds: float
+    # Latency from sending a message (its time in the schedule when the rate is limited) to
+    # on_message returning, in seconds
+    latency_p50: float
+    latency_p99: float
+    latency_max: float
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.seconds if self.seconds > 0 else 0.0
+
+
+def run_load(listener: SensorListener,
+             messages: List[Tuple[str, bytes]],
+             rate: float = 0.0,
+             broker: LocalBroker = None) -> LoadReport:
+    """
+    Hand the messages to the listener and time them
+    :param listener: Where the messages go
+    :param messages: The topics and payloads, e.g. from TrafficGenerator.messages
+    :param rate: The messages per second to send at, 0 sends them as fast as they are taken
+    :param broker: Send the messages through this broker to its MqttComms, which should have
+    the listener; by default on_message of the listener is called directly
+    :return: The measurements; it does not wait for anything the listener has buffered
+    """
+    latencies = []
+    start = perf_counter()
+    for number, (topic, payload) in enumerate(messages):
+        sent = perf_counter()
+        if rate > 0:
+            # Sent at its time in the schedule, or late if the listener has fallen behind
+            scheduled = start + number / rate
+            if scheduled > sent:
+                sleep(scheduled - sent)
+            sent = scheduled
+        if broker is not None:
+            broker.publish(topic, payload)
+        else:
+            listener.on_message(topic, payload)
+            latencies.append(perf_counter() - sent)
+    if broker is not None:
+        broker.disconnect()
+        latencies = broker.latencies
+    seconds = perf_counter() - start
+    latencies = sorted(latencies)
+    if not latencies:
+        return LoadReport(messages=0, seconds=seconds, latency_p50=0.0, latency_p99=0.0, latency_max=0.0)
+    return LoadReport(messages=len(latencies),
+                      seconds=seconds,
+                      latency_p50=latencies[len(latencies) // 2],
+                      latency_p99=latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+                      latency_max=latencies[-1])
@@ -6,17 +6,25 @@ https://github.com/eclipse/paho.mqtt.python/blob/master/src/paho/
 
 """
 import argparse
+import asyncio
 import configparser
 import logging
 import logging.config
 import os
+from pathlib import Path
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from models.models import Base
+from models.migrations import upgrade_schema
+from sensors.async_comms import AsyncStreamer, ThreadedListener
+from sensors.connections import SubscriptionManager, read_connections
 from sensors.db_streamer import Streamer
+from sensors.metrics import (DEFAULT_SAMPLE_EVERY, IngestMetrics, LogSummarySink, MetricsRegistry,
+                             PrometheusHttpSink, watch_connections, watch_overload)
 from sensors.mqtt_comms import MqttComms
+from sensors.overload import OverloadGuard, POLICIES
+from sensors.sharded_streamer import ShardedStreamer
 
 """
 Topic format <AppID>/devices/<DevID>/up
@@ -49,7 +57,65 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("-v", "--verbose", required=False, help="SQL logging on or off, default is off",
                         type=str2bool,
                         default=False)
+    parser.add_argument("-b", "--batch-size", required=False, type=int, default=0,
+                        help="Write messages in batches of up to this size on a writer thread, "
+                             "default is 0 meaning each message is written as it arrives")
+    parser.add_argument("--max-latency", required=False, type=float, default=1.0,
+                        help="Longest time in seconds a message waits before its batch is written, default 1.0")
+    parser.add_argument("-r", "--rollups", required=False, type=str2bool, default=False,
+                        help="Keep the measurement rollups used for long-range charts up to date, default is false")
+    parser.add_argument("--connection-log-level", required=False, default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Store connection events logged at this level or above, default INFO. "
+                             "At DEBUG the pings and other routine traffic are stored as periodic counts")
+    parser.add_argument("--coalesce-seconds", required=False, type=float, default=300.0,
+                        help="How often the counts of routine connection events are stored, default 300")
+    parser.add_argument("-d", "--dedup-window", required=False, type=int, default=0,
+                        help="Suppress the copies of confirmed uplinks that are sent again, remembering this many "
+                             "recent counters for each device, default is 0 meaning every copy is stored")
+    parser.add_argument("-g", "--receptions", required=False, type=str2bool, default=False,
+                        help="Store the gateways that received each message and the RSSI, SNR and data rate "
+                             "in the gateway and reception tables, default is false")
+    parser.add_argument("-j", "--journal", required=False,
+                        help="Write each message to a journal in this folder before the database, so messages "
+                             "are kept while the database is not available; default is no journal")
+    parser.add_argument("--journal-sync", required=False, type=str2bool, default=False,
+                        help="Flush each message in the journal to the disk as it is written, default is false")
+    parser.add_argument("-w", "--workers", required=False, type=int, default=0,
+                        help="Store the messages with this many worker processes, each device's messages go to "
+                             "the same worker; default is 0 meaning they are stored in this process")
+    parser.add_argument("-a", "--asyncio", required=False, type=str2bool, default=False,
+                        help="Run the connection on an asyncio event loop and store the messages in batches of "
+                             "--batch-size (default 100) from a thread pool, default is false")
+    parser.add_argument("--overload-policy", required=False, choices=POLICIES,
+                        help="Hand the messages from the MQTT thread to the database through a bounded queue, and "
+                             "what to do when it reaches the high watermark: pause reading, drop the messages "
+                             "that are not measurements, or spill them to --spill-folder; default is no queue")
+    parser.add_argument("--high-watermark", required=False, type=int, default=5000,
+                        help="Messages waiting on the queue when the overload policy starts, default 5000")
+    parser.add_argument("--low-watermark", required=False, type=int, default=1000,
+                        help="Messages waiting on the queue when the overload policy stops, default 1000")
+    parser.add_argument("--spill-folder", required=False,
+                        help="The folder the spill overload policy writes the messages to")
+    parser.add_argument("--metrics-port", required=False, type=int, default=0,
+                        help="Serve the metrics in the Prometheus text format at http://localhost:<port>/metrics, "
+                             "default is 0 meaning they are not served")
+    parser.add_argument("--metrics-log-seconds", required=False, type=float, default=0.0,
+                        help="Log a summary of the metrics this often, default is 0 meaning never")
+    parser.add_argument("--metrics-sample", required=False, type=int, default=DEFAULT_SAMPLE_EVERY,
+                        help="Time the stages of storing one message, and one batch, in this many, "
+                             f"default {DEFAULT_SAMPLE_EVERY}")
     args = parser.parse_args()
+    if args.metrics_sample < 1:
+        parser.error("--metrics-sample must be at least 1")
+    if args.overload_policy == "spill" and args.spill_folder is None:
+        parser.error("--overload-policy spill needs --spill-folder")
+    if args.overload_policy is not None and args.asyncio:
+        parser.error("--asyncio holds back the broker itself, it cannot be used with --overload-policy")
+    if args.workers > 0 and args.journal is not None:
+        parser.error("--workers cannot be used with --journal")
+    if args.asyncio and (args.workers > 0 or args.journal is not None):
+        parser.error("--asyncio cannot be used with --workers or --journal")
     return args
 
 
@@ -75,13 +141,9 @@ def main():
     # The configuration file path will become a command-line argument
     config = configparser.ConfigParser()
     config.read(ini_file_path)
-    connection = config['ttn-explore.mqtt.connection']
-    username = connection['username']  # This is the Application ID for this integration at TTN
-    password = connection['password']  # This is the my-python-client application access key
-    region = connection['region']
-    hostname = f"{region}.thethings.network"
-    sslport = connection.getint('sslport')
-    keep_alive_seconds = connection.getint('keep_alive_seconds')
+    # One or more connections, each with the Application ID for the integration at TTN, the
+    # application access key and the region
+    connections = read_connections(config)
 
     # Use an in-memory database to test
     # Set this true to see all the SQL
@@ -89,20 +151,106 @@ def main():
     db_url = args.db_url
     logger.info(f"Database URL for the ORM {db_url}")
     engine = create_engine(db_url, echo=sql_logging_on)
-    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
     session_factory = sessionmaker(bind=engine)
 
-    streamer = Streamer(session_factory)
+    registry = None
+    ingest_metrics = None
+    sinks = []
+    if args.metrics_port > 0 or args.metrics_log_seconds > 0:
+        registry = MetricsRegistry()
+        if args.workers == 0:
+            # The worker processes keep no metrics, only how many messages each was given
+            ingest_metrics = IngestMetrics(registry, sample_every=args.metrics_sample)
+        if args.metrics_port > 0:
+            sinks.append(PrometheusHttpSink(registry, args.metrics_port))
+        if args.metrics_log_seconds > 0:
+            sinks.append(LogSummarySink(registry, args.metrics_log_seconds))
 
-    comms = MqttComms(cert_path=mqtt_ca_path,
-                      username=username,
-                      password=password,
-                      hostname=hostname,
-                      port=sslport,
-                      msg_listener=streamer)
+    if args.asyncio:
+        streamer = AsyncStreamer(session_factory,
+                                 batch_size=args.batch_size if args.batch_size > 0 else 100,
+                                 max_latency_seconds=args.max_latency,
+                                 maintain_rollups=args.rollups,
+                                 connection_log_level=logging.getLevelName(args.connection_log_level),
+                                 coalesce_seconds=args.coalesce_seconds,
+                                 dedup_window=args.dedup_window,
+                                 capture_receptions=args.receptions,
+                                 metrics=ingest_metrics)
+    elif args.workers > 0:
+        engine.dispose()
+        streamer = ShardedStreamer(db_url,
+                                   workers=args.workers,
+                                   connection_log_level=logging.getLevelName(args.connection_log_level),
+                                   coalesce_seconds=args.coalesce_seconds,
+                                   echo=sql_logging_on,
+                                   batch_size=args.batch_size,
+                                   max_latency_seconds=args.max_latency,
+                                   maintain_rollups=args.rollups,
+                                   dedup_window=args.dedup_window,
+                                   capture_receptions=args.receptions)
+        if registry is not None:
+            sharded = streamer
+            registry.function("sharded_messages_total", "Messages handed to each worker process",
+                              lambda: {(str(x),): y for x, y in enumerate(sharded.shard_counts)},
+                              ("shard",), kind="counter")
+    else:
+        streamer = Streamer(session_factory,
+                            batch_size=args.batch_size,
+                            max_latency_seconds=args.max_latency,
+                            maintain_rollups=args.rollups,
+                            connection_log_level=logging.getLevelName(args.connection_log_level),
+                            coalesce_seconds=args.coalesce_seconds,
+                            dedup_window=args.dedup_window,
+                            capture_receptions=args.receptions,
+                            journal_folder=Path(args.journal) if args.journal is not None else None,
+                            journal_sync=args.journal_sync,
+                            metrics=ingest_metrics)
+
+    if args.overload_policy is not None:
+        streamer = OverloadGuard(streamer,
+                                 policy=args.overload_policy,
+                                 high_watermark=args.high_watermark,
+                                 low_watermark=args.low_watermark,
+                                 spill_folder=Path(args.spill_folder) if args.spill_folder is not None else None,
+                                 # Not waiting so long that the keep alive is missed
+                                 max_pause_seconds=min(connection.keep_alive_seconds for connection in connections) / 2)
+        if registry is not None:
+            watch_overload(registry, streamer.stats)
+
+    for sink in sinks:
+        sink.start()
+    try:
+        if args.asyncio or len(connections) > 1:
+            if not args.asyncio:
+                # Stored on a thread of its own, as the Paho thread does with one connection
+                streamer = ThreadedListener(streamer)
+            manager = SubscriptionManager(connections, streamer, cert_path=mqtt_ca_path)
+            if registry is not None:
+                watch_connections(registry, manager.health)
+            try:
+                # Keeps going until interrupted, the messages received are stored before it returns
+                asyncio.run(manager.run())
+            except KeyboardInterrupt:
+                pass
+            return
+
+        connection = connections[0]
+        comms = MqttComms(cert_path=mqtt_ca_path,
+                          username=connection.username,
+                          password=connection.password,
+                          hostname=connection.hostname,
+                          port=connection.port,
+                          msg_listener=streamer,
+                          client_id=connection.client_id)
+        if registry is not None:
+            watch_connections(registry, lambda: {connection.name: comms.health})
 
-    # Blocking call that keeps going until interrupted
-    comms.connect_and_start(keep_alive_seconds=keep_alive_seconds)
+        # Blocking call that keeps going until interrupted
+        comms.connect_and_start(keep_alive_seconds=connection.keep_alive_seconds)
+    finally:
+        for sink in sinks:
+            sink.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+"""
+Loads temperature and humidity measurements straight into pandas columns with a single Core
+SELECT of the four columns that are needed, rather than loading every row as an ORM object
+(with its raw_message) and taking it apart again. The rollups (see sensors.rollups) can be
+loaded the same way. This requires numpy and pandas.
+"""
+from datetime import datetime
+from typing import Iterable, Union
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, and_, type_coerce, func, Float
+from sqlalchemy.engine import Engine, Connection
+
+from models.models import LoraEvent, TempHumidityMeasurement, MeasurementRollup
+
+MEASUREMENT_TYPE = TempHumidityMeasurement.__mapper_args__['polymorphic_identity']
+
+# Rows fetched from the cursor at a time
+CHUNK_SIZE = 10000
+
+
+def epoch_to_datetime(seconds: "np.ndarray") -> pd.DatetimeIndex:
+    """
+    Convert a column of timestamps as stored (seconds since the epoch, with a fraction)
+    in one step. They are rounded to the microsecond, which is all that is stored, so the
+    times are the same as the ones CustomDateTime would give.
+    :param seconds: The timestamps as stored
+    :return: The UTC times
+    """
+    return pd.to_datetime(np.rint(seconds * 1e6).astype(np.int64), unit='us', utc=True)
+
+
+def measurement_query(sensor_ids: Iterable[str] = None, start: datetime = None, end: datetime = None):
+    """
+    Make the query for the measurements. The timestamp is left as the stored number of
+    seconds since the epoch rather than converted to a datetime for each row.
+    :param sensor_ids: Only these sensors, default is all
+    :param start: Only measurements at or after this time (UTC)
+    :param end: Only measurements before this time (UTC)
+    :return: A select of sensor_id, timestamp, temp_c, humidity_percent in sensor and time order
+    """
+    events = LoraEvent.__table__
+    conditions = [events.c.type == MEASUREMENT_TYPE]
+    if sensor_ids is not None:
+        conditions.append(events.c.sensor_id.in_(list(sensor_ids)))
+    if start is not None:
+        conditions.append(events.c.timestamp >= start)
+    if end is not None:
+        conditions.append(events.c.timestamp < end)
+    return select([events.c.sensor_id,
+                   type_coerce(events.c.timestamp, Float).label('timestamp'),
+                   events.c.temp_c,
+                   events.c.humidity_percent]) \
+        .where(and_(*conditions)) \
+        .order_by(events.c.sensor_id, events.c.timestamp)
+
+
+def load_measurements(bind: Union[Engine, Connection],
+                      sensor_ids: Iterable[str] = None,
+                      start: datetime = None,
+                      end: datetime = None) -> pd.DataFrame:
+    """
+    Load the measurements into a data frame
+    :param bind: The engine or connection to query
+    :param sensor_ids: Only these sensors, default is all
+    :param start: Only measurements at or after this time (UTC)
+    :param end: Only measurements before this time (UTC)
+    :return: A data frame with columns sensor_id (categorical), timestamp (UTC),
+    temp_c and humidity_percent, in sensor and time order
+    """
+    result = bind.execute(measurement_query(sensor_ids, start, end).execution_options(stream_results=True))
+    sensor_chunks, time_chunks, temp_chunks, humidity_chunks = [], [], [], []
+    try:
+        while True:
+            rows = result.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            chunk_sensor_ids, timestamps, temps, humidities = zip(*rows)
+            sensor_chunks.append(np.array(chunk_sensor_ids, dtype=object))
+            time_chunks.append(np.array(timestamps, dtype=np.float64))
+            temp_chunks.append(np.array(temps, dtype=np.float64))
+            humidity_chunks.append(np.array(humidities, dtype=np.float64))
+    finally:
+        result.close()
+    if not time_chunks:
+        return pd.DataFrame({'sensor_id': pd.Categorical([]),
+                             'timestamp': pd.to_datetime(np.array([], dtype=np.int64), unit='us', utc=True),
+                             'temp_c': np.array([], dtype=np.float64),
+                             'humidity_percent': np.array([], dtype=np.float64)})
+    return pd.DataFrame({'sensor_id': pd.Categorical(np.concatenate(sensor_chunks)),
+                         'timestamp': epoch_to_datetime(np.concatenate(time_chunks)),
+                         'temp_c': np.concatenate(temp_chunks),
+                         'humidity_percent': np.concatenate(humidity_chunks)})
+
+
+def measurement_time_range(bind: Union[Engine, Connection], sensor_ids: Iterable[str] = None):
+    """
+    :param bind: The engine or connection to query
+    :param sensor_ids: Only these sensors, default is all
+    :return: The times of the first and last measurements (UTC), both None if there are none
+    """
+    events = LoraEvent.__table__
+    conditions = [events.c.type == MEASUREMENT_TYPE]
+    if sensor_ids is not None:
+        conditions.append(events.c.sensor_id.in_(list(sensor_ids)))
+    query = select([func.min(events.c.timestamp), func.max(events.c.timestamp)]).where(and_(*conditions))
+    return tuple(bind.execute(query).first())
+
+
+def load_rollups(bind: Union[Engine, Connection],
+                 resolution: int,
+                 sensor_ids: Iterable[str] = None,
+                 start: datetime = None,
+                 end: datetime = None) -> pd.DataFrame:
+    """
+    Load the rollups at one resolution into a data frame
+    :param bind: The engine or connection to query
+    :param resolution: The resolution in seconds, one of rollups.RESOLUTIONS
+    :param sensor_ids: Only these sensors, default is all
+    :param start: Only buckets that start at or after this time (UTC)
+    :param end: Only buckets that start before this time (UTC)
+    :return: A data frame with columns sensor_id (categorical), timestamp (UTC, the start of
+    the bucket), count, temp_min, temp_mean, temp_max, humidity_min, humidity_mean and
+    humidity_max, in sensor and time order
+    """
+    rollups = MeasurementRollup.__table__
+    conditions = [rollups.c.resolution == resolution]
+    if sensor_ids is not None:
+        conditions.append(rollups.c.sensor_id.in_(list(sensor_ids)))
+    if start is not None:
+        conditions.append(rollups.c.bucket >= int(start.timestamp()))
+    if end is not None:
+        conditions.append(rollups.c.bucket < int(end.timestamp()))
+    query = select([rollups.c.sensor_id, rollups.c.bucket, rollups.c.count,
+                    rollups.c.temp_min, rollups.c.temp_sum, rollups.c.temp_max,
+                    rollups.c.humidity_min, rollups.c.humidity_sum, rollups.c.humidity_max]) \
+        .where(and_(*conditions)) \
+        .order_by(rollups.c.sensor_id, rollups.c.bucket)
+    df = pd.DataFrame(bind.execute(query).fetchall(),
+                      columns=['sensor_id', 'bucket', 'count', 'temp_min', 'temp_sum', 'temp_max',
+                               'humidity_min', 'humidity_sum', 'humidity_max'])
+    count = df['count'].to_numpy(dtype=np.float64)
+    return pd.DataFrame({'sensor_id': pd.Categorical(df['sensor_id']),
+                         'timestamp': pd.to_datetime(df['bucket'].to_numpy(dtype=np.int64), unit='s', utc=True),
+                         'count': df['count'].to_numpy(dtype=np.int64),
+                         'temp_min': df['temp_min'].to_numpy(dtype=np.float64),
+                         'temp_mean': df['temp_sum'].to_numpy(dtype=np.float64) / count,
+                         'temp_max': df['temp_max'].to_numpy(dtype=np.float64),
+                         'humidity_min': df['humidity_min'].to_numpy(dtype=np.float64),
+                         'humidity_mean': df['humidity_sum'].to_numpy(dtype=np.float64) / count,
+                         'humidity_max': df['humidity_max'].to_numpy(dtype=np.float64)})
@@ -0,0 +1,95 @@
+"""
+Writes the stored raw messages out as JSON lines, e.g. for test data or to replay into another
+database with th_replay_messages.py. The messages are read with a streaming cursor a chunk at
+a time and written as they are read, so memory use does not depend on the size of the table.
+They come out in sensor and counter order, which the ix_event_sensor_counter index gives
+without a sort.
+"""
+import gzip
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Iterable, Union
+
+from sqlalchemy import select, and_
+from sqlalchemy.engine import Engine, Connection
+
+from models.models import LoraEvent
+
+# Rows fetched from the cursor at a time
+CHUNK_SIZE = 1000
+
+
+def export_query(sensor_ids: Iterable[str] = None,
+                 types: Iterable[str] = None,
+                 start: datetime = None,
+                 end: datetime = None):
+    """
+    Make the query for the messages
+    :param sensor_ids: Only these sensors, default is all
+    :param types: Only these kinds of event (measurement, supervisory, linkq), default is all
+    :param start: Only messages received at or after this time (UTC)
+    :param end: Only messages received before this time (UTC)
+    :return: A select of raw_message in sensor and counter order
+    """
+    events = LoraEvent.__table__
+    conditions = [events.c.sensor_id.isnot(None)]
+    if sensor_ids is not None:
+        conditions.append(events.c.sensor_id.in_(list(sensor_ids)))
+    if types is not None:
+        conditions.append(events.c.type.in_(list(types)))
+    if start is not None:
+        conditions.append(events.c.timestamp >= start)
+    if end is not None:
+        conditions.append(events.c.timestamp < end)
+    # The id keeps retries, which share a counter, in the order received; in SQLite the
+    # id is part of every index so this is still the order of ix_event_sensor_counter
+    return select([events.c.raw_message]) \
+        .where(and_(*conditions)) \
+        .order_by(events.c.sensor_id, events.c.counter, events.c.id)
+
+
+def open_output(path: Path) -> BinaryIO:
+    """
+    Open a file to write the messages to, compressing them if the name ends in .gz or .zst
+    :param path: The file
+    :return: The binary stream to write to
+    """
+    if path.suffix == ".gz":
+        return gzip.open(path, "wb")
+    if path.suffix == ".zst":
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"), closefd=True)
+    return open(path, "wb")
+
+
+def export_messages(bind: Union[Engine, Connection],
+                    writer: BinaryIO,
+                    sensor_ids: Iterable[str] = None,
+                    types: Iterable[str] = None,
+                    start: datetime = None,
+                    end: datetime = None,
+                    chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Write the messages, one per line
+    :param bind: The engine or connection to query
+    :param writer: Where to write them
+    :param sensor_ids: Only these sensors, default is all
+    :param types: Only these kinds of event, default is all
+    :param start: Only messages received at or after this time (UTC)
+    :param end: Only messages received before this time (UTC)
+    :param chunk_size: The number of rows fetched at a time
+    :return: The number of messages written
+    """
+    query = export_query(sensor_ids, types, start, end).execution_options(stream_results=True)
+    result = bind.execute(query)
+    count = 0
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.write(b"".join(x.raw_message + b"\n" for x in rows))
+            count += len(rows)
+    finally:
+        result.close()
+    return count
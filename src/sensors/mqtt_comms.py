@@ -3,9 +3,16 @@ A class to wrap dealing with the MQTT broker
 """
 import logging
 from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Optional
 
 import paho.mqtt.client as mqtt
 
+from utils.date_time_utils import get_utc_now
+
+# The broker keeps the session of a client id, so each connection needs its own
+DEFAULT_CLIENT_ID = "kam-th-lora-10132020"
+
 
 class SensorListener(ABC):
     """
@@ -21,14 +28,46 @@ class SensorListener(ABC):
         pass
 
     @abstractmethod
-    def on_connection_event(self, reason: str) -> None:
+    def on_connection_event(self, reason: str, level: int = logging.INFO) -> None:
         """
-        Notifies the Sensor Listener of connection related events
+        Notifies the Sensor Listener of connection related events. This is called on the
+        network thread so it must not block.
         :param reason: Human readable and parseable text describing the event
+        :param level: The logging level of the event
+        :return: None
+        """
+        pass
+
+    def close(self) -> None:
+        """
+        Called when the connection is shut down so that anything still buffered by the
+        listener can be written out. The default does nothing.
         :return: None
         """
         pass
 
+
+class ConnectionHealth:
+    """
+    The state of a connection, kept up to date by MqttComms
+    """
+    __slots__ = ('state', 'connects', 'disconnects', 'messages', 'last_message', 'last_error', 'retry_seconds')
+
+    def __init__(self):
+        # One of "starting", "connecting", "connected", "waiting" (to connect again) and "stopped"
+        self.state = "starting"
+        self.connects = 0
+        self.disconnects = 0
+        self.messages = 0
+        self.last_message = None  # type: Optional[datetime]
+        self.last_error = None  # type: Optional[str]
+        # How long the connection waits before connecting again
+        self.retry_seconds = 0.0
+
+    def __repr__(self):
+        return f"ConnectionHealth({', '.join(f'{x}={getattr(self, x)!r}' for x in self.__slots__)})"
+
+
 class MqttComms:
     """
     A class that wraps the MQTT client and is an interface between
@@ -45,8 +84,8 @@ class MqttComms:
                  password: str,
                  hostname: str,
                  port: int,
-                 msg_listener: SensorListener = None):
-        client_id = "kam-th-lora-10132020"
+                 msg_listener: SensorListener = None,
+                 client_id: str = DEFAULT_CLIENT_ID):
         self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311, clean_session=False)
         # Connect the client's callback functions to the methods in this class
         self.client.on_connect = self.on_connect
@@ -60,8 +99,10 @@ class MqttComms:
         self.ssl_port = port
         self.msg_listener = msg_listener
         self.logger = logging.getLogger("lora.mqtt")
+        self.health = ConnectionHealth()
 
     def connect_and_start(self, keep_alive_seconds: int):
+        self.health.state = "connecting"
         self.client.connect(host=self.hostname, port=self.ssl_port, keepalive=keep_alive_seconds)
         # Blocking call that processes network traffic, dispatches callbacks and
         # handles reconnecting. Which is great, if it disconnects the re-connection is automatic.
@@ -76,36 +117,54 @@ class MqttComms:
             self.logger.warning(f"Some problem {str(e)})")
             self.client.loop_stop(force=True)
             self.client.disconnect()
+        finally:
+            self.health.state = "stopped"
+            # Make sure anything the listener is holding on to gets written
+            if self.msg_listener is not None:
+                self.msg_listener.close()
 
     # The callback for when the client receives a CONNACK response from the server.
     def on_connect(self, client, userdata, flags, rc):
         self.logger.info("Connected with result code " + str(rc) + " " + mqtt.connack_string(rc))
         if rc == 0:
+            self.health.state = "connected"
+            self.health.connects += 1
             # subscribe for all devices of user
             res = client.subscribe('+/devices/+/up')
             if res[0] != mqtt.MQTT_ERR_SUCCESS:
                 raise RuntimeError(f"Subscribe failed, the client is not really connected {res[0]}")
             msg = "Subscribed to messages for all devices"
             self.logger.info(msg)
-            self.msg_listener.on_connection_event(msg)
+            self.msg_listener.on_connection_event(msg, logging.INFO)
         else:
             msg = f"Connection failed {str(rc)} {mqtt.connack_string(rc)}"
-            self.msg_listener.on_connection_event(msg)
+            self.health.last_error = msg
+            self.msg_listener.on_connection_event(msg, logging.ERROR)
             raise RuntimeError(msg)
 
     # The callback for when a PUBLISH message is received from the server.
     def on_message(self, client, userdata, msg: mqtt.MQTTMessage):
+        self._count_message()
         if self.msg_listener is not None:
             self.msg_listener.on_message(msg.topic, msg.payload)
 
+    def _count_message(self) -> None:
+        self.health.messages += 1
+        self.health.last_message = get_utc_now()
+
     # The callback for when a disconnect message is received regarding the mqtt connection.
     def on_disconnect(self, client, userdata, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            # Lost rather than disconnect() called, loop_forever connects again
+            self.health.state = "waiting"
+            self.health.disconnects += 1
+            self.health.last_error = mqtt.error_string(rc)
         msg = f"Disconnected status {mqtt.error_string(rc)}"
         self.logger.warning(msg)
         if self.msg_listener is not None:
             msg = mqtt.error_string(rc)
             self.msg_listener.on_disconnect(mqtt.error_string(rc))
-            self.msg_listener.on_connection_event(msg)
+            self.msg_listener.on_connection_event(msg, logging.WARNING)
 
     def on_log(self, client, userdata, level, buf):
         """
@@ -114,4 +173,5 @@ class MqttComms:
         """
         logging_level = mqtt.LOGGING_LEVEL[level]
         logging.log(logging_level, buf)
-        self.msg_listener.on_connection_event(buf)
+        if self.msg_listener is not None:
+            self.msg_listener.on_connection_event(buf, logging_level)
@@ -0,0 +1,298 @@
+"""
+A bounded hand-off between the MQTT network thread and the listener that stores the messages.
+Without it a slow listener, e.g. while SQLite is locked, holds up the Paho thread: the messages
+pile up in the receive buffers and the broker can drop the connection. OverloadGuard puts the
+messages on a queue that a delivery thread hands to the listener in order. When the queue
+reaches the high watermark the overload policy decides what happens to the messages that
+arrive, until it is back down to the low watermark:
+
+- pause: the network thread waits, so the broker is held back by TCP, for up to
+  max_pause_seconds at a time so the keep alive is still sent
+- drop-supervisory: Supervisory, Link Quality and other messages that are not measurements are
+  dropped; measurements are only dropped when the queue is full
+- spill: the messages are written to a journal on the local disk (see sensors.journal) and are
+  handed over from there once the queue has drained, in the order they arrived. What is left
+  in the journal when the program stops is handed over when it is next started.
+
+The counts of the messages dropped, spilled and so on are kept in OverloadStats, and the
+crossing of each watermark is logged, so an overload can be seen.
+"""
+import logging
+import threading
+from collections import deque
+from pathlib import Path
+from time import monotonic
+from typing import Deque, NamedTuple, Optional, Tuple
+
+from sensors.journal import MessageJournal
+from sensors.message_protocol import THSensorMsgType
+from sensors.mqtt_comms import SensorListener
+from sensors.uplink_decoder import decode_uplink
+
+POLICIES = ("pause", "drop-supervisory", "spill")
+
+# How many spilled messages are read back at a time
+SPILL_BATCH_SIZE = 100
+
+# The topic is not kept in the spill journal, the listeners only look at the payload
+SPILL_TOPIC = ""
+
+
+class OverloadStats(NamedTuple):
+    """
+    The state of the hand-off and what it has done so far
+    """
+    # Messages waiting on the queue now, and the most there have been
+    depth: int
+    max_depth: int
+    received: int
+    delivered: int
+    # Messages not stored because of an overload
+    dropped_supervisory: int
+    dropped_measurements: int
+    # Messages written to the spill journal, and the bytes of them still to be handed over
+    spilled: int
+    spill_pending_bytes: int
+    # Times the high watermark was reached, and the seconds the network thread has waited
+    overloads: int
+    paused_seconds: float
+    # True from reaching the high watermark until back down to the low watermark
+    overloaded: bool
+
+
+def is_measurement(payload: bytes) -> bool:
+    """
+    :param payload: The JSON message from TTN
+    :return: True if the message is a temperature and humidity measurement
+    """
+    try:
+        return decode_uplink(payload).payload_fields.msgtype == THSensorMsgType.UPLINK.value
+    except Exception:
+        # Not dropped for being something else, the listener deals with it
+        return True
+
+
+class OverloadGuard(SensorListener):
+    """
+    A SensorListener that hands the messages to another one on a thread of its own, through
+    a bounded queue with an overload policy
+    """
+
+    def __init__(self,
+                 listener: SensorListener,
+                 policy: str = "pause",
+                 high_watermark: int = 5000,
+                 low_watermark: int = 1000,
+                 max_size: int = None,
+                 spill_folder: Path = None,
+                 max_pause_seconds: float = 60.0):
+        """
+        :param listener: Where the messages go
+        :param policy: What happens at the high watermark, one of POLICIES
+        :param high_watermark: The queue depth at which the policy starts
+        :param low_watermark: The queue depth at which it stops again
+        :param max_size: With drop-supervisory, the queue depth at which measurements are dropped
+        too, by default four times the high watermark
+        :param spill_folder: With spill, the folder of the journal
+        :param max_pause_seconds: With pause, the longest the network thread waits for one message;
+        after that the message is queued anyway. Keep it below the keep alive.
+        """
+        if max_size is None:
+            max_size = 4 * high_watermark
+        if policy not in POLICIES:
+            raise ValueError(f"The policy must be one of {', '.join(POLICIES)}")
+        if not 0 <= low_watermark < high_watermark <= max_size:
+            raise ValueError("The watermarks must be 0 <= low < high <= max size")
+        if policy == "spill" and spill_folder is None:
+            raise ValueError("The spill policy needs a folder")
+        self.listener = listener
+        self.policy = policy
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_size = max_size
+        self.max_pause_seconds = max_pause_seconds
+        self.logger = logging.getLogger("lora.mqtt")
+        self._queue = deque()  # type: Deque[Tuple[bytes, bytes]]
+        # Notified when a message is queued or delivered
+        self._condition = threading.Condition()
+        self._overloaded = False
+        self._closed = False
+        self._busy = False
+        self._max_depth = 0
+        self._received = 0
+        self._delivered = 0
+        self._dropped_supervisory = 0
+        self._dropped_measurements = 0
+        self._spilled = 0
+        self._overloads = 0
+        self._paused_seconds = 0.0
+        self.spill = None  # type: Optional[MessageJournal]
+        # While spilling, every message goes to the journal so they are handed over in order
+        self._spilling = False
+        # What was left in the journal when it was closed
+        self._spill_closed_pending = None  # type: Optional[int]
+        if policy == "spill":
+            self.spill = MessageJournal(spill_folder)
+            self._spilling = self.spill.pending_bytes() > 0
+        self._thread = threading.Thread(target=self._run, name="overload-guard", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> OverloadStats:
+        """
+        :return: The state of the queue and the counts so far
+        """
+        with self._condition:
+            return OverloadStats(depth=len(self._queue),
+                                 max_depth=self._max_depth,
+                                 received=self._received,
+                                 delivered=self._delivered,
+                                 dropped_supervisory=self._dropped_supervisory,
+                                 dropped_measurements=self._dropped_measurements,
+                                 spilled=self._spilled,
+                                 spill_pending_bytes=self._spill_pending_bytes(),
+                                 overloads=self._overloads,
+                                 paused_seconds=self._paused_seconds,
+                                 overloaded=self._overloaded)
+
+    def _spill_pending_bytes(self) -> int:
+        if self.spill is None:
+            return 0
+        if self._spill_closed_pending is not None:
+            return self._spill_closed_pending
+        return self.spill.pending_bytes()
+
+    def on_message(self, topic: bytes, payload: bytes):
+        with self._condition:
+            self._received += 1
+            if len(self._queue) >= self.high_watermark and not self._overloaded:
+                self._overloaded = True
+                self._overloads += 1
+                self.logger.warning(f"{len(self._queue)} messages waiting to be stored, overload policy "
+                                    f"{self.policy} until there are {self.low_watermark}")
+            if self._spilling or (self._overloaded and self.policy == "spill"):
+                self._spill(payload)
+                return
+            if self._overloaded and self.policy == "pause":
+                self._pause()
+            elif self._overloaded and self.policy == "drop-supervisory":
+                if not is_measurement(payload):
+                    self._dropped_supervisory += 1
+                    return
+                if len(self._queue) >= self.max_size:
+                    self._dropped_measurements += 1
+                    self.logger.error(f"Dropped payload: {payload.decode()}")
+                    return
+            self._queue.append((topic, payload))
+            self._max_depth = max(self._max_depth, len(self._queue))
+            self._condition.notify_all()
+
+    def _spill(self, payload: bytes) -> None:
+        try:
+            self.spill.append(payload)
+        except Exception as e:
+            self._dropped_measurements += 1
+            self.logger.error(f"Exception spilling message {str(e)}")
+            self.logger.error(f"Dropped payload: {payload.decode()}")
+            return
+        self._spilled += 1
+        self._spilling = True
+        self._condition.notify_all()
+
+    def _pause(self) -> None:
+        # Called holding the condition, which the wait lets go of
+        start = monotonic()
+        if not self._condition.wait_for(lambda: not self._overloaded or self._closed, self.max_pause_seconds):
+            self.logger.warning(f"Waited {self.max_pause_seconds} seconds to queue a message, queueing it anyway")
+        self._paused_seconds += monotonic() - start
+
+    def _check_drained(self) -> None:
+        # Called holding the condition
+        if self._overloaded and len(self._queue) <= self.low_watermark:
+            self._overloaded = False
+            self.logger.warning(f"Overload over, {len(self._queue)} messages waiting; "
+                                f"{self._dropped_supervisory + self._dropped_measurements} dropped, "
+                                f"{self._spilled} spilled and {self._paused_seconds:.1f} seconds paused so far")
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        position = self.spill.checkpoint if self.spill is not None else None
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._spilling or self._closed)
+                if self._queue:
+                    topic, payload = self._queue.popleft()
+                    self._busy = True
+                elif self._spilling and not self._closed:
+                    # The queue has drained, hand over what was spilled
+                    payloads, after = self.spill.read(position, SPILL_BATCH_SIZE)
+                    if not payloads and after == self.spill.end:
+                        self.spill.commit(after)
+                        position = after
+                        self._spilling = False
+                        self._check_drained()
+                        self._condition.notify_all()
+                        continue
+                    self._busy = True
+                    topic, payload = None, None
+                else:
+                    return
+            if payload is not None:
+                self._deliver(topic, payload)
+            else:
+                for payload in payloads:
+                    self._deliver(SPILL_TOPIC, payload)
+                self.spill.commit(after)
+                position = after
+            with self._condition:
+                self._busy = False
+                self._check_drained()
+                self._condition.notify_all()
+
+    def _deliver(self, topic: bytes, payload: bytes) -> None:
+        try:
+            self.listener.on_message(topic, payload)
+        except Exception as e:
+            self.logger.error(f"Exception handling message {str(e)}")
+        with self._condition:
+            self._delivered += 1
+
+    def flush(self) -> None:
+        """
+        Wait until the messages received so far, spilled ones included, have been handed over,
+        and then flush the listener if it can be
+        :return: None
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: not (self._queue or self._spilling or self._busy)
+                                     or not self._thread.is_alive())
+        flush = getattr(self.listener, "flush", None)
+        if flush is not None:
+            flush()
+
+    def close(self) -> None:
+        """
+        Hand over what is on the queue, leave what was spilled for the next start, and close
+        the listener. Safe to call more than once.
+        :return: None
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        stats = self.stats()
+        self.logger.info(f"Hand-off closed: {stats}")
+        if self.spill is not None:
+            if stats.spill_pending_bytes:
+                self.logger.warning(f"{stats.spill_pending_bytes} bytes of spilled messages are left for the next start")
+            with self._condition:
+                self._spill_closed_pending = stats.spill_pending_bytes
+            self.spill.close()
+        self.listener.close()
+
+    def on_disconnect(self, reason: str):
+        self.listener.on_disconnect(reason)
+
+    def on_connection_event(self, reason: str, level: int = logging.INFO) -> None:
+        self.listener.on_connection_event(reason, level)
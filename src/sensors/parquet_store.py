@@ -0,0 +1,373 @@
+"""
+Exports the events to Parquet files for offline analysis, so that years of data can be scanned
+without going through the database. There is a folder for each type of event, sensor and month,
+named hive style, e.g. type=measurement/sensor_id=CCC0790000EE4ED9/month=2020-10/, and in it a
+file for each export that had events for it. The readings are numeric columns: temp_c and
+humidity_percent for measurements, and for Supervisory messages the error codes, sensor state
+and battery level decoded from the payload. The type, sensor and month are read back from the
+folder names, so the sensor ids are not repeated in the files, and are loaded as a pandas
+categorical column.
+
+Exports are incremental: the highest event id exported is kept in _export_state.json in the
+folder and the next export only reads the events stored after it. Events changed after they
+were exported, e.g. by folding in another copy of a confirmed uplink, are not exported again.
+
+The loaders give the same data frames as sensors.measurement_loader, and find_gaps the same
+reports as sensors.gap_analysis, from the files. This requires pyarrow, numpy and pandas.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import select, and_, func, type_coerce, Float
+from sqlalchemy.engine import Engine, Connection
+
+from models.models import LoraEvent, Sensor, TempHumidityMeasurement, Supervisory, LinkQ
+from sensors.gap_analysis import CounterGap, SensorGapReport, make_reports
+from sensors.payload_decoder import decode_payloads_bulk
+from sensors.uplink_decoder import payloads_from_messages
+from utils.date_time_utils import get_utc_now, formatiso8601
+
+MEASUREMENT_TYPE = TempHumidityMeasurement.__mapper_args__['polymorphic_identity']
+SUPERVISORY_TYPE = Supervisory.__mapper_args__['polymorphic_identity']
+LINKQ_TYPE = LinkQ.__mapper_args__['polymorphic_identity']
+EVENT_TYPES = [MEASUREMENT_TYPE, SUPERVISORY_TYPE, LINKQ_TYPE]
+
+# Files starting with _ are not taken as part of the data by pyarrow.dataset
+STATE_FILE = "_export_state.json"
+SENSORS_FILE = "_sensors.parquet"
+
+# Rows fetched from the cursor, and written as a row group, at a time
+CHUNK_SIZE = 100000
+
+TIMESTAMP = pa.timestamp('us', tz='UTC')
+
+PARTITIONING = ds.partitioning(pa.schema([('type', pa.string()),
+                                          ('sensor_id', pa.string()),
+                                          ('month', pa.string())]), flavor='hive')
+
+# The columns of the files of every type of event
+EVENT_SCHEMA = pa.schema([('id', pa.int64()),
+                          ('timestamp', TIMESTAMP),
+                          ('counter', pa.int64()),
+                          ('retry_count', pa.int32()),
+                          ('best_rssi', pa.float64()),
+                          ('best_snr', pa.float64())])
+
+# The columns added for each type of event
+TYPE_COLUMNS = {MEASUREMENT_TYPE: [('temp_c', pa.float64()),
+                                   ('humidity_percent', pa.float64())],
+                SUPERVISORY_TYPE: [('errorcodes', pa.int16()),
+                                   ('sensor_state', pa.int16()),
+                                   ('batlevel', pa.float64())],
+                LINKQ_TYPE: []}
+
+
+class ExportReport(NamedTuple):
+    """
+    What an export did
+    """
+    events: int
+    files: int
+    # The highest event id exported so far, the next export starts after it
+    last_event_id: int
+
+
+def file_schema(event_type: str) -> pa.Schema:
+    """
+    :param event_type: The type of event, one of EVENT_TYPES
+    :return: The columns of the files of that type
+    """
+    schema = EVENT_SCHEMA
+    for name, data_type in TYPE_COLUMNS[event_type]:
+        schema = schema.append(pa.field(name, data_type))
+    return schema
+
+
+def export_events(bind: Union[Engine, Connection], root: Path, chunk_size: int = CHUNK_SIZE) -> ExportReport:
+    """
+    Export the events stored since the last export
+    :param bind: The engine or connection to query
+    :param root: The folder of the Parquet files, made if it does not exist
+    :param chunk_size: The number of rows read and written at a time
+    :return: What was exported
+    """
+    logger = logging.getLogger("lora.mqtt")
+    root = Path(root)
+    os.makedirs(root, exist_ok=True)
+    after = read_state(root).get('last_event_id', 0)
+    events = LoraEvent.__table__
+    # Events stored while this runs are left for the next export
+    last = bind.execute(select([func.max(events.c.id)])).scalar() or 0
+    count = files = 0
+    if last > after:
+        for event_type in EVENT_TYPES:
+            type_count, type_files = _export_type(bind, root, event_type, after, last, chunk_size)
+            logger.info(f"Exported {type_count} {event_type} events to {type_files} files")
+            count += type_count
+            files += type_files
+    _write_sensors(bind, root)
+    # Written last, if the export is interrupted the next one writes the same files again
+    _write_state(root, {'last_event_id': max(last, after), 'exported': formatiso8601(get_utc_now())})
+    return ExportReport(events=count, files=files, last_event_id=max(last, after))
+
+
+def _export_type(bind, root: Path, event_type: str, after: int, last: int, chunk_size: int):
+    events = LoraEvent.__table__
+    columns = [events.c.id,
+               events.c.sensor_id,
+               type_coerce(events.c.timestamp, Float).label('timestamp'),
+               events.c.counter,
+               events.c.retry_count,
+               events.c.best_rssi,
+               events.c.best_snr]
+    if event_type == MEASUREMENT_TYPE:
+        columns += [events.c.temp_c, events.c.humidity_percent]
+    elif event_type == SUPERVISORY_TYPE:
+        columns.append(events.c.raw_message)
+    # In sensor and time order each folder is written in one go, with one file open at a time
+    query = select(columns) \
+        .where(and_(events.c.type == event_type,
+                    events.c.sensor_id.isnot(None),
+                    events.c.id > after,
+                    events.c.id <= last)) \
+        .order_by(events.c.sensor_id, events.c.timestamp, events.c.id) \
+        .execution_options(stream_results=True)
+    schema = file_schema(event_type)
+    count = files = 0
+    key, writer = None, None
+    result = bind.execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            sensor_ids, table = _chunk_table(event_type, schema, rows)
+            months = table['timestamp'].to_numpy().astype('datetime64[M]').astype(str)
+            start = 0
+            while start < len(rows):
+                end = start + 1
+                while end < len(rows) and sensor_ids[end] == sensor_ids[start] and months[end] == months[start]:
+                    end += 1
+                if key != (sensor_ids[start], months[start]):
+                    if writer is not None:
+                        writer.close()
+                    key = (sensor_ids[start], months[start])
+                    folder = root / f"type={event_type}" / f"sensor_id={key[0]}" / f"month={key[1]}"
+                    os.makedirs(folder, exist_ok=True)
+                    # Named after where the export started, so a repeated export replaces it
+                    writer = pq.ParquetWriter(folder / f"part-{after + 1:012d}.parquet", schema,
+                                              compression='zstd')
+                    files += 1
+                writer.write_table(table.slice(start, end - start))
+                start = end
+            count += len(rows)
+    finally:
+        result.close()
+        if writer is not None:
+            writer.close()
+    return count, files
+
+
+def _chunk_table(event_type: str, schema: pa.Schema, rows) -> Tuple[tuple, pa.Table]:
+    columns = list(zip(*rows))
+    sensor_ids = columns[1]
+    seconds = np.array(columns[2], dtype=np.float64)
+    # Rounded to the microsecond, which is all that is stored, as measurement_loader does
+    arrays = [pa.array(columns[0], pa.int64()),
+              pa.array(np.rint(seconds * 1e6).astype(np.int64), TIMESTAMP),
+              pa.array(columns[3], pa.int64()),
+              pa.array(columns[4], pa.int32()),
+              pa.array(columns[5], pa.float64()),
+              pa.array(columns[6], pa.float64())]
+    if event_type == MEASUREMENT_TYPE:
+        arrays += [pa.array(columns[7], pa.float64()), pa.array(columns[8], pa.float64())]
+    elif event_type == SUPERVISORY_TYPE:
+        decoded = decode_payloads_bulk(payloads_from_messages(columns[7]))
+        # The bulk decoder gives -1 and NaN for fields it could not decode, these are nulls
+        arrays += [pa.array(decoded['errorcodes'], pa.int16(), mask=decoded['errorcodes'] < 0),
+                   pa.array(decoded['sensor_state'], pa.int16(), mask=decoded['sensor_state'] < 0),
+                   pa.array(decoded['batlevel'], pa.float64(), mask=np.isnan(decoded['batlevel']))]
+    return sensor_ids, pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _write_sensors(bind, root: Path) -> None:
+    sensors = Sensor.__table__
+    rows = bind.execute(select([sensors.c.device_id, sensors.c.device_name])
+                        .order_by(sensors.c.device_id)).fetchall()
+    table = pa.table({'device_id': pa.array([x.device_id for x in rows], pa.string()),
+                      'device_name': pa.array([x.device_name for x in rows], pa.string())})
+    temp_path = root / (SENSORS_FILE + ".tmp")
+    pq.write_table(table, temp_path)
+    os.replace(temp_path, root / SENSORS_FILE)
+
+
+def read_state(root: Path) -> dict:
+    """
+    :param root: The folder of the Parquet files
+    :return: How far the exports have got, empty if nothing has been exported
+    """
+    path = Path(root) / STATE_FILE
+    if not path.exists():
+        return {}
+    with open(path, "r") as reader:
+        return json.load(reader)
+
+
+def _write_state(root: Path, state: dict) -> None:
+    temp_path = root / (STATE_FILE + ".tmp")
+    with open(temp_path, "w") as writer:
+        json.dump(state, writer, indent=2)
+    os.replace(temp_path, root / STATE_FILE)
+
+
+def load_sensors(root: Path) -> List[Sensor]:
+    """
+    :param root: The folder of the Parquet files
+    :return: The sensors as they were at the last export, in device id order; they are not
+    in a session
+    """
+    table = pq.read_table(Path(root) / SENSORS_FILE)
+    return [Sensor(device_id=x, device_name=y)
+            for x, y in zip(table['device_id'].to_pylist(), table['device_name'].to_pylist())]
+
+
+def _load(root: Path, types: List[str], schema: pa.Schema, columns: List[str],
+          sensor_ids: Iterable[str] = None, start: datetime = None, end: datetime = None) -> pd.DataFrame:
+    for field in PARTITIONING.schema:
+        schema = schema.append(field)
+    dataset = ds.dataset(root, format="parquet", partitioning=PARTITIONING, schema=schema)
+    condition = ds.field('type').isin(types)
+    if sensor_ids is not None:
+        condition = condition & ds.field('sensor_id').isin(list(sensor_ids))
+    # The month is compared as well as the time so that only the folders needed are read
+    if start is not None:
+        condition = condition & (ds.field('month') >= start.strftime("%Y-%m")) & \
+                    (ds.field('timestamp') >= pa.scalar(start, TIMESTAMP))
+    if end is not None:
+        condition = condition & (ds.field('month') <= end.strftime("%Y-%m")) & \
+                    (ds.field('timestamp') < pa.scalar(end, TIMESTAMP))
+    table = dataset.to_table(columns=['sensor_id'] + columns, filter=condition)
+    table = table.set_column(0, 'sensor_id', pc.dictionary_encode(table['sensor_id']))
+    df = table.to_pandas()
+    # Sorted categories, as pd.Categorical makes them, so that sorting is by device id
+    df['sensor_id'] = df['sensor_id'].cat.set_categories(sorted(df['sensor_id'].cat.categories))
+    return df
+
+
+def load_measurements(root: Path,
+                      sensor_ids: Iterable[str] = None,
+                      start: datetime = None,
+                      end: datetime = None) -> pd.DataFrame:
+    """
+    Load the measurements from the Parquet files into a data frame
+    :param root: The folder of the Parquet files
+    :param sensor_ids: Only these sensors, default is all
+    :param start: Only measurements at or after this time (UTC)
+    :param end: Only measurements before this time (UTC)
+    :return: A data frame as measurement_loader.load_measurements gives, with columns
+    sensor_id (categorical), timestamp (UTC), temp_c and humidity_percent, in sensor and time order
+    """
+    df = _load(root, [MEASUREMENT_TYPE], file_schema(MEASUREMENT_TYPE),
+               ['timestamp', 'temp_c', 'humidity_percent'], sensor_ids, start, end)
+    return df.sort_values(['sensor_id', 'timestamp'], kind='stable').reset_index(drop=True)
+
+
+def measurement_time_range(root: Path, sensor_ids: Iterable[str] = None):
+    """
+    :param root: The folder of the Parquet files
+    :param sensor_ids: Only these sensors, default is all
+    :return: The times of the first and last measurements (UTC), both None if there are none
+    """
+    df = _load(root, [MEASUREMENT_TYPE], EVENT_SCHEMA, ['timestamp'], sensor_ids)
+    if len(df) == 0:
+        return None, None
+    return df['timestamp'].min().to_pydatetime(), df['timestamp'].max().to_pydatetime()
+
+
+def summarise_measurements(measurements: pd.DataFrame, resolution: int) -> pd.DataFrame:
+    """
+    Summarise measurements over fixed periods, as the rollups in the database do
+    :param measurements: The measurements as load_measurements gives them
+    :param resolution: The length of the periods in seconds
+    :return: A data frame as measurement_loader.load_rollups gives, with columns sensor_id
+    (categorical), timestamp (UTC, the start of the period), count, temp_min, temp_mean,
+    temp_max, humidity_min, humidity_mean and humidity_max, in sensor and time order
+    """
+    bucket = measurements['timestamp'].dt.floor(f"{resolution}s")
+    grouped = measurements.groupby([measurements['sensor_id'], bucket.rename('bucket')], observed=True, sort=True)
+    df = grouped.agg(count=('temp_c', 'size'),
+                     temp_min=('temp_c', 'min'),
+                     temp_mean=('temp_c', 'mean'),
+                     temp_max=('temp_c', 'max'),
+                     humidity_min=('humidity_percent', 'min'),
+                     humidity_mean=('humidity_percent', 'mean'),
+                     humidity_max=('humidity_percent', 'max')).reset_index()
+    return df.rename(columns={'bucket': 'timestamp'})
+
+
+def load_events(root: Path,
+                sensor_ids: Iterable[str] = None,
+                start: datetime = None,
+                end: datetime = None) -> pd.DataFrame:
+    """
+    Load the events of every type from the Parquet files into a data frame
+    :param root: The folder of the Parquet files
+    :param sensor_ids: Only these sensors, default is all
+    :param start: Only events at or after this time (UTC)
+    :param end: Only events before this time (UTC)
+    :return: A data frame with columns sensor_id (categorical), id, type, counter and
+    timestamp (UTC), in sensor and counter order
+    """
+    df = _load(root, EVENT_TYPES, EVENT_SCHEMA, ['id', 'type', 'counter', 'timestamp'], sensor_ids, start, end)
+    # The id keeps retries, which share a counter, in the order received
+    return df.sort_values(['sensor_id', 'counter', 'id'], kind='stable').reset_index(drop=True)
+
+
+def find_gaps(root: Path,
+              sensor_ids: Iterable[str] = None,
+              exclude_supervisory: bool = False) -> List[SensorGapReport]:
+    """
+    Find the gaps in the counters of each sensor, as gap_analysis.find_gaps does in the database
+    :param root: The folder of the Parquet files
+    :param sensor_ids: Only look at these sensors, default is all the sensors with events
+    :param exclude_supervisory: Leave out gaps next to a Supervisory message
+    :return: A report per sensor, in sensor_id order
+    """
+    df = load_events(root, sensor_ids)
+    sensor = df['sensor_id'].to_numpy(dtype=object)
+    counter = df['counter'].to_numpy()
+    is_gap = (sensor[1:] == sensor[:-1]) & (counter[1:] > counter[:-1] + 1)
+    if exclude_supervisory:
+        is_supervisory = df['type'].to_numpy(dtype=object) == SUPERVISORY_TYPE
+        is_gap &= ~is_supervisory[1:] & ~is_supervisory[:-1]
+    timestamps = df['timestamp']
+    gaps = {}
+    for i in np.nonzero(is_gap)[0]:
+        gaps.setdefault(sensor[i + 1], []).append(
+            CounterGap(sensor[i + 1], int(counter[i]), timestamps.iloc[i].to_pydatetime(),
+                       int(counter[i + 1]), timestamps.iloc[i + 1].to_pydatetime(), run_length=0))
+    summaries = df.groupby('sensor_id', observed=True, sort=True) \
+        .agg(event_count=('counter', 'size'),
+             first_counter=('counter', 'min'),
+             last_counter=('counter', 'max'),
+             first_timestamp=('timestamp', 'min'),
+             last_timestamp=('timestamp', 'max')) \
+        .reset_index()
+    rows = [row._replace(sensor_id=str(row.sensor_id),
+                         event_count=int(row.event_count),
+                         first_counter=int(row.first_counter),
+                         last_counter=int(row.last_counter),
+                         first_timestamp=row.first_timestamp.to_pydatetime(),
+                         last_timestamp=row.last_timestamp.to_pydatetime())
+            for row in summaries.itertuples(index=False, name='Summary')]
+    return make_reports(rows, gaps)
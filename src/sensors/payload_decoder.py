@@ -0,0 +1,145 @@
+"""
+Decodes the RadioBridge temperature and humidity sensor payload (payload_raw) in Python.
+This is a port of the Decoder in javascript/payload_format.js that runs in TTN, so it gives
+the same payload_fields; with it the payload formatting in TTN can be turned off and readings
+can be re-derived from the raw messages stored in the database (see
+uplink_decoder.payloads_from_messages and decode_payloads_bulk).
+
+Byte layout, see https://radiobridge.com/documents/Common%20Sensor%20Messages.pdf
+
+| Byte | Content |
+| -----|---------|
+| 0 | Protocol version (upper 4 bits) and packet counter (lower 4 bits) |
+| 1 | Message type, see THSensorMsgType |
+| 2 | Supervisory: error codes. Uplink: sensor event type, see THSensorEventType |
+| 3 | Supervisory: sensor state. Uplink: temperature whole degrees C, bit 7 is the sign |
+| 4 | Supervisory: battery level, volts (upper 4 bits) and tenths (lower 4 bits). Uplink: the temperature decimal (upper 4 bits) |
+| 5 | Uplink: humidity whole percent |
+"""
+import base64
+import binascii
+from typing import Dict, Sequence
+
+from sensors.message_protocol import THSensorMsgType
+
+# The names used by the TTN decoder for each sensor event type, indexed by the event type
+EVENT_TYPE_NAMES = ["Periodic Report", "Temp above upper threshold", "Temp below lower threshold",
+                    "Temp report on change increase", "Temp report on change decrease",
+                    "Humidity above upper threshold", "Humidity below lower threshold",
+                    "Humidity report on change increase", "Humidity report on change decrease"]
+
+# The width that payloads are padded or cut to for the bulk decoder, the longest known
+# message (Supervisory) is 11 bytes
+BULK_WIDTH = 11
+
+# The bytes each message type needs, the others only have the two header bytes
+HEADER_LENGTH = 2
+MIN_LENGTHS = {THSensorMsgType.SUPERVISORY.value: 5, THSensorMsgType.UPLINK.value: 6}
+
+
+def decode_payload(data: bytes) -> dict:
+    """
+    Decode an uplink payload into the same fields as the TTN decoder
+    :param data: The payload bytes
+    :return: A dictionary of the fields. A payload too short for its message type has only
+    msgdesc UNKNOWN and an event_type that gives its length
+    """
+    if len(data) < HEADER_LENGTH or len(data) < MIN_LENGTHS.get(data[1], HEADER_LENGTH):
+        return {'msgdesc': "UNKNOWN",
+                'event_type': f"Short payload of {len(data)} bytes"}
+    decoded = {'version': data[0] >> 4,
+               'pktcnt': data[0] & 0x0F,
+               'msgtype': data[1]}
+    msgtype = data[1]
+    if msgtype == THSensorMsgType.RESET.value:
+        # Device has reset
+        decoded['msgdesc'] = "RESET"
+        decoded['event_type'] = "Reset"
+    elif msgtype == THSensorMsgType.SUPERVISORY.value:
+        decoded['event_type'] = "Supervisory"
+        decoded['msgdesc'] = "SUPERVISORY"
+        decoded['errorcodes'] = data[2]
+        decoded['sensor_state'] = data[3]
+        decoded['batlevel'] = (data[4] >> 4) + (data[4] & 0x0F) / 10.0
+    elif msgtype == THSensorMsgType.TAMPER.value:
+        decoded['msgdesc'] = "TAMPER"
+        decoded['event_type'] = "Tamper"
+    elif msgtype == THSensorMsgType.UPLINK.value:
+        decoded['msgdesc'] = "SENSOR"
+        sensor_event_type = data[2]
+        if sensor_event_type >= len(EVENT_TYPE_NAMES):
+            decoded['event_type'] = f"OOB_{sensor_event_type}"
+        else:
+            decoded['event_type'] = EVENT_TYPE_NAMES[sensor_event_type]
+        decoded['sensor_event_type'] = sensor_event_type
+        # The same decimal is used for both the temperature and the humidity, as the TTN
+        # decoder does, so the values match the payload_fields already stored
+        decimal = (data[4] >> 4) / 10.0
+        temp_c = (data[3] & 0x7F) + decimal
+        if data[3] & 0x80:
+            temp_c = -temp_c
+        decoded['temp_c'] = temp_c
+        decoded['temp_f'] = (temp_c * 9 / 5) + 32.0
+        decoded['humidity_percent'] = data[5] + decimal
+    elif msgtype == THSensorMsgType.LINK_QUALITY.value:
+        decoded['msgdesc'] = "LINKQ"
+        decoded['event_type'] = "Link Quality"
+    else:
+        decoded['msgdesc'] = "UNKNOWN"
+        decoded['event_type'] = "Unknown"
+    return decoded
+
+
+def decode_payload_raw(payload_raw: str) -> dict:
+    """
+    Decode the payload_raw field of an uplink message
+    :param payload_raw: The payload, base64 encoded
+    :return: A dictionary of the fields
+    """
+    return decode_payload(base64.b64decode(payload_raw))
+
+
+def decode_payloads_bulk(payloads_raw: Sequence[str]) -> Dict[str, "numpy.ndarray"]:
+    """
+    Decode many payloads at once with numpy. Fields that do not apply to a message
+    are NaN for the float columns and -1 for the integer columns, a payload too short
+    for its message type is -1 or NaN in every column.
+    :param payloads_raw: The payload_raw fields, base64 encoded
+    :return: A dictionary of columns: version, pktcnt, msgtype, sensor_event_type, temp_c,
+    humidity_percent, errorcodes, sensor_state and batlevel
+    """
+    import numpy as np
+
+    count = len(payloads_raw)
+    a2b = binascii.a2b_base64
+    padding = bytes(BULK_WIDTH)
+    # Every payload is padded to the same width so that they make one 2D array of bytes
+    payloads = [a2b(x) for x in payloads_raw]
+    joined = b"".join([(x + padding)[:BULK_WIDTH] for x in payloads])
+    data = np.frombuffer(joined, dtype=np.uint8).reshape(count, BULK_WIDTH).astype(np.int16)
+    lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=count)
+
+    needed = np.full(count, HEADER_LENGTH)
+    for msgtype_value, length in MIN_LENGTHS.items():
+        needed[data[:, 1] == msgtype_value] = length
+    short = lengths < needed
+    msgtype = np.where(short, -1, data[:, 1])
+    is_uplink = msgtype == THSensorMsgType.UPLINK.value
+    is_supervisory = msgtype == THSensorMsgType.SUPERVISORY.value
+
+    decimal = (data[:, 4] >> 4) / 10.0
+    temp_c = (data[:, 3] & 0x7F) + decimal
+    temp_c = np.where(data[:, 3] & 0x80, -temp_c, temp_c)
+    humidity_percent = data[:, 5] + decimal
+    batlevel = (data[:, 4] >> 4) + (data[:, 4] & 0x0F) / 10.0
+
+    return {'version': np.where(short, -1, data[:, 0] >> 4),
+            'pktcnt': np.where(short, -1, data[:, 0] & 0x0F),
+            'msgtype': msgtype,
+            'sensor_event_type': np.where(is_uplink, data[:, 2], -1),
+            'temp_c': np.where(is_uplink, temp_c, np.nan),
+            'humidity_percent': np.where(is_uplink, humidity_percent, np.nan),
+            'errorcodes': np.where(is_supervisory, data[:, 2], -1),
+            'sensor_state': np.where(is_supervisory, data[:, 3], -1),
+            'batlevel': np.where(is_supervisory, batlevel, np.nan)}
+
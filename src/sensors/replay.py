@@ -0,0 +1,276 @@
+"""
+Replays archives of messages, one JSON message per line as written by th_save_messages.py or
+exported from TTN, into a database. The archive is read a chunk of lines at a time, the chunks
+are parsed by a pool of worker processes and each chunk is stored with one executemany insert
+in one transaction. The copies of confirmed uplinks are folded in the same way as by the
+Streamer (see sensors.dedup).
+
+How far each archive has got is kept in the replay_progress table and updated in the same
+transaction as the events, so an interrupted replay carries on from where it stopped and
+nothing is stored twice. A message that is already stored, when an archive is replayed
+again, is skipped without touching its row; only a copy sent again by the device counts
+as a retry.
+"""
+import gzip
+import logging
+import multiprocessing
+import threading
+from collections import deque
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, NamedTuple, Tuple
+
+from sqlalchemy import select, and_
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.orm import sessionmaker
+
+from models.models import LoraEvent, ReplayProgress, TempHumidityMeasurement
+from sensors.db_streamer import EventRecord, parse_message, suppress_duplicate, fold_copies
+from sensors.dedup import DedupWindow
+from sensors.rollups import add_measurements
+from sensors.sensor_registry import SensorRegistry
+from utils.date_time_utils import get_utc_now
+
+
+class ReplayReport(NamedTuple):
+    """
+    What a replay of one archive did
+    """
+    archive: str
+    # Lines skipped because an earlier run had stored them
+    resumed_at: int
+    lines: int
+    events: int
+    # Copies of messages folded into another
+    duplicates: int
+    # Lines that could not be parsed
+    bad_lines: int
+    # Messages skipped because they were stored before
+    already_stored: int
+
+
+def open_archive(path: Path) -> BinaryIO:
+    """
+    Open an archive for reading, uncompressing it if the name ends in .gz or .zst
+    :param path: The archive
+    :return: The binary stream of the messages
+    """
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    if path.suffix == ".zst":
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def read_chunks(reader: BinaryIO, chunk_lines: int) -> Iterator[Tuple[List[bytes], int]]:
+    """
+    Read the lines of an archive a chunk at a time
+    :param reader: The stream of the messages
+    :param chunk_lines: The number of lines in a chunk
+    :return: The lines of each chunk and the number of bytes they took up
+    """
+    lines = []
+    size = 0
+    for line in reader:
+        lines.append(line)
+        size += len(line)
+        if len(lines) >= chunk_lines:
+            yield lines, size
+            lines = []
+            size = 0
+    if lines:
+        yield lines, size
+
+
+def parse_lines(lines: List[bytes]) -> Tuple[List[EventRecord], int]:
+    """
+    Parse a chunk of lines, this is what the worker processes do
+    :param lines: The lines
+    :return: The records to store and the number of lines that could not be parsed
+    """
+    records = []
+    bad_lines = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = parse_message(line)
+        except Exception:
+            bad_lines += 1
+            continue
+        if record is not None:
+            # The radio metadata is not stored by the replay, so is not sent back
+            record.metadata = None
+            records.append(record)
+    return records, bad_lines
+
+
+class Replayer:
+    """
+    Replays message archives into a database
+    """
+
+    def __init__(self, engine: Engine,
+                 workers: int = None,
+                 chunk_lines: int = 5000,
+                 dedup_window: int = 32,
+                 maintain_rollups: bool = False):
+        """
+        :param engine: The database engine
+        :param workers: The number of parse processes, default is one per CPU; 0 or 1 parses
+        in this process
+        :param chunk_lines: The number of lines parsed and stored at a time
+        :param dedup_window: The number of recent counters of each device remembered to
+        recognise the copies of a message; 0 stores every copy
+        :param maintain_rollups: Add the measurements to the measurement rollups
+        """
+        self.engine = engine
+        self.workers = multiprocessing.cpu_count() if workers is None else workers
+        self.chunk_lines = chunk_lines
+        self.dedup = DedupWindow(per_device=dedup_window) if dedup_window > 0 else None
+        self.maintain_rollups = maintain_rollups
+        self.Session = sessionmaker(bind=engine)
+        self.registry = SensorRegistry(self.Session)
+        self.registry.warm()
+        self.logger = logging.getLogger("lora.mqtt")
+        # Nothing else looks at the records, suppress_duplicate needs a lock all the same
+        self._fold_lock = threading.Lock()
+
+    def replay(self, path: Path, restart: bool = False) -> ReplayReport:
+        """
+        Store the messages of an archive, carrying on from where an earlier run stopped
+        :param path: The archive
+        :param restart: Start from the beginning, ignoring any earlier progress
+        :return: What was done
+        """
+        path = Path(path)
+        archive = str(path.resolve())
+        offset, lines, events = 0, 0, 0
+        progress = self._load_progress(archive)
+        if progress is not None and not restart:
+            offset, lines, events = progress.offset, progress.lines, progress.events
+            self.logger.info(f"Resuming {archive} at line {lines}")
+        resumed_at, events_before = lines, events
+        duplicates = bad_lines = already_stored = 0
+        with open_archive(path) as reader:
+            if offset:
+                reader.seek(offset)
+            for (records, bad), line_count, size in self._parse(read_chunks(reader, self.chunk_lines)):
+                stored, folded, skipped = self._store(records, archive, offset + size, lines + line_count, events)
+                offset += size
+                lines += line_count
+                events += stored
+                duplicates += folded
+                already_stored += skipped
+                bad_lines += bad
+                self.logger.info(f"{archive}: {lines} lines, {events} events")
+        return ReplayReport(archive=archive, resumed_at=resumed_at, lines=lines - resumed_at,
+                            events=events - events_before,
+                            duplicates=duplicates, bad_lines=bad_lines, already_stored=already_stored)
+
+    def _parse(self, chunks: Iterator[Tuple[List[bytes], int]]):
+        if self.workers <= 1:
+            for lines, size in chunks:
+                yield parse_lines(lines), len(lines), size
+            return
+        with multiprocessing.Pool(self.workers) as pool:
+            # A few chunks are parsed ahead of the one being stored, but no more, so
+            # memory does not grow with the size of the archive
+            pending = deque()
+            for lines, size in chunks:
+                pending.append((pool.apply_async(parse_lines, (lines,)), len(lines), size))
+                if len(pending) >= 2 * self.workers:
+                    result, line_count, chunk_size = pending.popleft()
+                    yield result.get(), line_count, chunk_size
+            while pending:
+                result, line_count, chunk_size = pending.popleft()
+                yield result.get(), line_count, chunk_size
+
+    def _store(self, records: List[EventRecord], archive: str, offset: int, lines: int, events: int):
+        folded = 0
+        kept = []
+        for record in records:
+            if self.dedup is not None and suppress_duplicate(self.dedup, record, self._fold_lock):
+                folded += 1
+            else:
+                kept.append(record)
+        with self._fold_lock:
+            for record in kept:
+                record.taken = True
+        # Sensors are resolved before the transaction is opened, the registry uses its own session
+        sensor_ids = [self.registry.ensure(x.device_id, x.device_name) for x in kept]
+        skipped = 0
+        with self.engine.begin() as connection:
+            if self.dedup is not None:
+                kept, sensor_ids, skipped = self._check_stored(connection, kept, sensor_ids)
+            folded += fold_copies(connection, kept, sensor_ids)
+            new = [(x, y) for x, y in zip(kept, sensor_ids) if not x.is_duplicate]
+            if new:
+                connection.execute(LoraEvent.__table__.insert(), [x.to_row(y) for x, y in new])
+            if self.maintain_rollups:
+                session = self.Session(bind=connection)
+                try:
+                    add_measurements(session, [(y, x.timestamp, x.temp_c, x.humidity_percent)
+                                               for x, y in new
+                                               if x.event_class is TempHumidityMeasurement])
+                    # Joins the transaction of the connection, which commits it
+                    session.commit()
+                finally:
+                    session.close()
+            self._save_progress(connection, archive, offset, lines, events + len(new))
+        return len(new), folded, skipped
+
+    @staticmethod
+    def _check_stored(connection: Connection, records: List[EventRecord],
+                      sensor_ids: List[str]) -> Tuple[List[EventRecord], List[str], int]:
+        """
+        Look for the records that are already stored, by an earlier replay or the live feed.
+        The same message is dropped, a copy of it is marked as a duplicate.
+        :return: The records still to store, their sensors and the number dropped
+        """
+        events = LoraEvent.__table__
+        counters = {}
+        for record, sensor_id in zip(records, sensor_ids):
+            if record.time_bucket is not None and not record.is_duplicate:
+                low, high = counters.get(sensor_id, (record.counter, record.counter))
+                counters[sensor_id] = (min(low, record.counter), max(high, record.counter))
+        stored = {}
+        for sensor_id, (low, high) in counters.items():
+            query = select([events.c.counter, events.c.time_bucket, events.c.raw_message]) \
+                .where(and_(events.c.sensor_id == sensor_id,
+                            events.c.counter.between(low, high),
+                            events.c.time_bucket.isnot(None)))
+            stored.update(((sensor_id, x.counter, x.time_bucket), x.raw_message) for x in connection.execute(query))
+        kept, kept_sensor_ids = [], []
+        for record, sensor_id in zip(records, sensor_ids):
+            raw_message = None if record.is_duplicate else stored.get((sensor_id, record.counter, record.time_bucket))
+            if raw_message == record.raw_message:
+                # The archive is being replayed again. Not handed to the database after all, so
+                # the copies that follow are folded into it and go no further
+                record.taken = False
+                continue
+            if raw_message is not None:
+                # A copy of a message stored by an earlier run or the live feed
+                record.is_duplicate = True
+            kept.append(record)
+            kept_sensor_ids.append(sensor_id)
+        return kept, kept_sensor_ids, len(records) - len(kept)
+
+    def _load_progress(self, archive: str):
+        session = self.Session()
+        try:
+            progress = session.query(ReplayProgress).get(archive)
+            if progress is not None:
+                session.expunge(progress)
+            return progress
+        finally:
+            session.close()
+
+    @staticmethod
+    def _save_progress(connection: Connection, archive: str, offset: int, lines: int, events: int) -> None:
+        table = ReplayProgress.__table__
+        values = {'offset': offset, 'lines': lines, 'events': events, 'updated': get_utc_now()}
+        result = connection.execute(table.update().where(table.c.archive == archive).values(**values))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(archive=archive, **values))
@@ -0,0 +1,156 @@
+"""
+Maintains the measurement_rollup table: the min, max, sum and count of the temperature and
+humidity of each sensor over 5 minute, hourly and daily buckets. The Streamer adds each batch
+of measurements to the rollups as it stores them, and rebuild_rollups makes them again from
+the event table, e.g. for an existing database.
+"""
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select, and_, cast, func, literal, Integer
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from models.models import LoraEvent, MeasurementRollup, TempHumidityMeasurement
+
+# The resolutions kept, in seconds, finest first
+RESOLUTIONS = (5 * 60, 60 * 60, 24 * 60 * 60)
+
+MEASUREMENT_TYPE = TempHumidityMeasurement.__mapper_args__['polymorphic_identity']
+
+
+class _Summary:
+    """
+    Accumulates the measurements that fall into one bucket
+    """
+    __slots__ = ('count', 'temp_min', 'temp_max', 'temp_sum',
+                 'humidity_min', 'humidity_max', 'humidity_sum')
+
+    def __init__(self, temp_c: float, humidity_percent: float):
+        self.count = 1
+        self.temp_min = self.temp_max = self.temp_sum = temp_c
+        self.humidity_min = self.humidity_max = self.humidity_sum = humidity_percent
+
+    def add(self, temp_c: float, humidity_percent: float) -> None:
+        self.count += 1
+        self.temp_min = min(self.temp_min, temp_c)
+        self.temp_max = max(self.temp_max, temp_c)
+        self.temp_sum += temp_c
+        self.humidity_min = min(self.humidity_min, humidity_percent)
+        self.humidity_max = max(self.humidity_max, humidity_percent)
+        self.humidity_sum += humidity_percent
+
+
+def bucket_of(timestamp: datetime, resolution: int) -> int:
+    """
+    :param timestamp: The time of a measurement
+    :param resolution: The resolution in seconds
+    :return: The start of the bucket the time falls in, seconds since the epoch
+    """
+    return int(timestamp.timestamp()) // resolution * resolution
+
+
+def add_measurements(session: Session,
+                     measurements: Iterable[Tuple[str, datetime, float, float]]) -> None:
+    """
+    Add measurements to the rollups at every resolution. The measurements are summarised here
+    first so each bucket is read and written once however many of them fall into it.
+    Does not commit, so the rollups are updated in the same transaction as the measurements.
+    :param session: The session to use
+    :param measurements: Tuples of sensor_id, timestamp, temp_c, humidity_percent
+    :return: None
+    """
+    summaries = {}  # type: Dict[Tuple[str, int, int], _Summary]
+    for sensor_id, timestamp, temp_c, humidity_percent in measurements:
+        if temp_c is None or humidity_percent is None:
+            continue
+        for resolution in RESOLUTIONS:
+            key = (sensor_id, resolution, bucket_of(timestamp, resolution))
+            summary = summaries.get(key)
+            if summary is None:
+                summaries[key] = _Summary(temp_c, humidity_percent)
+            else:
+                summary.add(temp_c, humidity_percent)
+    for key, summary in summaries.items():
+        rollup = session.query(MeasurementRollup).get(key)
+        if rollup is None:
+            sensor_id, resolution, bucket = key
+            session.add(MeasurementRollup(sensor_id=sensor_id, resolution=resolution, bucket=bucket,
+                                          count=summary.count,
+                                          temp_min=summary.temp_min,
+                                          temp_max=summary.temp_max,
+                                          temp_sum=summary.temp_sum,
+                                          humidity_min=summary.humidity_min,
+                                          humidity_max=summary.humidity_max,
+                                          humidity_sum=summary.humidity_sum))
+        else:
+            rollup.count += summary.count
+            rollup.temp_min = min(rollup.temp_min, summary.temp_min)
+            rollup.temp_max = max(rollup.temp_max, summary.temp_max)
+            rollup.temp_sum += summary.temp_sum
+            rollup.humidity_min = min(rollup.humidity_min, summary.humidity_min)
+            rollup.humidity_max = max(rollup.humidity_max, summary.humidity_max)
+            rollup.humidity_sum += summary.humidity_sum
+
+
+def rebuild_rollups(engine: Engine, sensor_ids: Iterable[str] = None) -> int:
+    """
+    Make the rollups again from the measurements in the event table. The work is done by
+    the database with one INSERT ... SELECT ... GROUP BY per resolution, in one transaction.
+    :param engine: The database engine
+    :param sensor_ids: Only rebuild these sensors, default is all
+    :return: The number of rollup rows made
+    """
+    logger = logging.getLogger("lora.mqtt")
+    events = LoraEvent.__table__
+    rollups = MeasurementRollup.__table__
+    sensor_ids = list(sensor_ids) if sensor_ids is not None else None
+    # The timestamp is stored as a number of seconds; it is made an integer first so that
+    # the division is an integer division in all databases
+    seconds = cast(events.c.timestamp, Integer)
+    conditions = [events.c.type == MEASUREMENT_TYPE,
+                  events.c.temp_c.isnot(None),
+                  events.c.humidity_percent.isnot(None)]
+    delete = rollups.delete()
+    if sensor_ids is not None:
+        conditions.append(events.c.sensor_id.in_(sensor_ids))
+        delete = delete.where(rollups.c.sensor_id.in_(sensor_ids))
+    total = 0
+    with engine.begin() as connection:
+        connection.execute(delete)
+        for resolution in RESOLUTIONS:
+            bucket = (cast(seconds / resolution, Integer) * resolution).label('bucket')
+            query = select([events.c.sensor_id,
+                            literal(resolution, Integer).label('resolution'),
+                            bucket,
+                            func.count().label('count'),
+                            func.min(events.c.temp_c),
+                            func.max(events.c.temp_c),
+                            func.sum(events.c.temp_c),
+                            func.min(events.c.humidity_percent),
+                            func.max(events.c.humidity_percent),
+                            func.sum(events.c.humidity_percent)]) \
+                .where(and_(*conditions)) \
+                .group_by(events.c.sensor_id, bucket)
+            result = connection.execute(rollups.insert().from_select(
+                ['sensor_id', 'resolution', 'bucket', 'count', 'temp_min', 'temp_max', 'temp_sum',
+                 'humidity_min', 'humidity_max', 'humidity_sum'], query))
+            logger.info(f"Rebuilt {result.rowcount} rollups at {resolution} seconds")
+            total += result.rowcount
+    return total
+
+
+def choose_resolution(start: datetime, end: datetime, pixels: int) -> Optional[int]:
+    """
+    Pick the coarsest resolution that still gives at least one point per pixel across
+    the width of the plot
+    :param start: The start of the time shown
+    :param end: The end of the time shown
+    :param pixels: The width of the plot in pixels
+    :return: The resolution in seconds, or None if even the finest is too coarse and the
+    measurements themselves should be plotted
+    """
+    seconds_per_pixel = (end - start).total_seconds() / max(pixels, 1)
+    usable = [x for x in RESOLUTIONS if x <= seconds_per_pixel]
+    return max(usable) if usable else None
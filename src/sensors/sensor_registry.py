@@ -0,0 +1,177 @@
+"""
+In-memory registries of the sensors and gateways that are known to the database, so that
+storing a message does not need a query just to find the sensor that sent it or the
+gateways that received it.
+"""
+import logging
+import threading
+from typing import Dict, Optional
+
+from sqlalchemy.exc import IntegrityError
+
+from models.models import Sensor, Gateway
+from utils.date_time_utils import get_utc_now
+
+
+class SensorRegistry:
+    """
+    Maps device_id (the hardware serial, which is also the primary key of the sensor table)
+    to device_name. It is warmed from the sensor table and after that the database is only
+    touched when a new device shows up or when a device's name changes. It is safe to use
+    from several threads.
+    """
+
+    def __init__(self, Session):
+        """
+        :param Session: The session factory, the registry uses its own sessions
+        """
+        self.Session = Session
+        self.logger = logging.getLogger("lora.mqtt")
+        self._names = {}  # type: Dict[str, str]
+        self._lock = threading.Lock()
+
+    def warm(self) -> int:
+        """
+        Load all the known sensors from the database
+        :return: The number of sensors loaded
+        """
+        session = self.Session()
+        try:
+            rows = session.query(Sensor.device_id, Sensor.device_name).all()
+        finally:
+            session.close()
+        with self._lock:
+            self._names.update(rows)
+        return len(rows)
+
+    def get_name(self, device_id: str) -> Optional[str]:
+        """
+        :param device_id: The hardware serial of the device
+        :return: The name of the device, or None if it is not known
+        """
+        return self._names.get(device_id)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, device_id: str):
+        return device_id in self._names
+
+    def ensure(self, device_id: str, device_name: str) -> str:
+        """
+        Make sure the sensor exists in the database with the given name. Only goes to
+        the database if the sensor is new or its name has changed.
+        :param device_id: The hardware serial of the device
+        :param device_name: The dev_id of the device as named in TTN
+        :return: The primary key of the sensor, to use as the sensor_id of its events
+        """
+        # A dict lookup is atomic so the common case needs no lock
+        if self._names.get(device_id) == device_name:
+            return device_id
+        with self._lock:
+            # Another thread might have got here first
+            if self._names.get(device_id) != device_name:
+                self._upsert(device_id, device_name)
+                self._names[device_id] = device_name
+        return device_id
+
+    def _upsert(self, device_id: str, device_name: str) -> None:
+        # Two attempts because another process could insert the same sensor between
+        # the get() and the commit(), in which case the second attempt is an update
+        for attempt in range(2):
+            session = self.Session()
+            try:
+                sensor = session.query(Sensor).get(device_id)
+                if sensor is None:
+                    self.logger.info(f"New sensor {device_id} {device_name}")
+                    session.add(Sensor(device_id=device_id, device_name=device_name))
+                elif sensor.device_name != device_name:
+                    self.logger.info(f"Sensor {device_id} renamed from {sensor.device_name} to {device_name}")
+                    sensor.device_name = device_name
+                session.commit()
+                return
+            except IntegrityError:
+                session.rollback()
+                if attempt > 0:
+                    raise
+            finally:
+                session.close()
+
+
+class GatewayRegistry:
+    """
+    Maps gtw_id to the integer primary key of the gateway table. It is warmed from the table
+    and after that the database is only touched when a new gateway shows up. It is safe to
+    use from several threads.
+    """
+
+    def __init__(self, Session):
+        """
+        :param Session: The session factory, the registry uses its own sessions
+        """
+        self.Session = Session
+        self.logger = logging.getLogger("lora.mqtt")
+        self._ids = {}  # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def warm(self) -> int:
+        """
+        Load all the known gateways from the database
+        :return: The number of gateways loaded
+        """
+        session = self.Session()
+        try:
+            rows = session.query(Gateway.gtw_id, Gateway.id).all()
+        finally:
+            session.close()
+        with self._lock:
+            self._ids.update(rows)
+        return len(rows)
+
+    def get_id(self, gtw_id: str) -> Optional[int]:
+        """
+        :param gtw_id: The id of the gateway in TTN
+        :return: The primary key of the gateway, or None if it is not known
+        """
+        return self._ids.get(gtw_id)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def ensure(self, gtw_id: str) -> int:
+        """
+        Make sure the gateway exists in the database. Only goes to the database if it is new.
+        :param gtw_id: The id of the gateway in TTN
+        :return: The primary key of the gateway
+        """
+        gateway_id = self._ids.get(gtw_id)
+        if gateway_id is not None:
+            return gateway_id
+        with self._lock:
+            gateway_id = self._ids.get(gtw_id)
+            if gateway_id is None:
+                gateway_id = self._insert(gtw_id)
+                self._ids[gtw_id] = gateway_id
+        return gateway_id
+
+    def _insert(self, gtw_id: str) -> int:
+        # Two attempts because another process could insert the same gateway between
+        # the query and the commit, in which case the second attempt finds it
+        for attempt in range(2):
+            session = self.Session()
+            try:
+                gateway = session.query(Gateway).filter(Gateway.gtw_id == gtw_id).one_or_none()
+                if gateway is None:
+                    self.logger.info(f"New gateway {gtw_id}")
+                    gateway = Gateway(gtw_id=gtw_id, first_seen=get_utc_now())
+                    session.add(gateway)
+                    session.flush()
+                gateway_id = gateway.id
+                session.commit()
+                return gateway_id
+            except IntegrityError:
+                session.rollback()
+                if attempt > 0:
+                    raise
+            finally:
+                session.close()
@@ -0,0 +1,226 @@
+"""
+Stores the messages with a pool of worker processes, so that parsing, dedup and the database
+writes are spread over several cores and one slow commit does not hold up every device. The
+MQTT network thread only puts the topic and message on the queue of a worker. The worker is
+chosen by the hardware serial of the device, so all the messages of a device go to the same
+worker, in the order they arrived, and its dedup window sees all of them.
+
+Each worker runs a Streamer of its own, with its own engine and sessions, on the database
+given by URL. The sensor and gateway registries already allow for another process adding the
+same row. Connection events are stored by the main process, as they come from the network
+thread. The log records of the workers are handled by the logging of the main process.
+"""
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import signal
+import threading
+import zlib
+from typing import List
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from sensors.connection_events import ConnectionEventRecorder
+from sensors.db_streamer import Streamer
+from sensors.mqtt_comms import SensorListener
+
+# Placed on the queue of a worker to control it, the messages are (topic, payload) tuples
+_STOP = None
+_FLUSH = "flush"
+
+# How long to wait on a full queue before checking the worker is still running
+_PUT_TIMEOUT_SECONDS = 1.0
+
+_SERIAL_KEY = b'"hardware_serial"'
+
+
+def shard_key(topic: str, payload: bytes) -> bytes:
+    """
+    Find the hardware serial in the message without decoding all of it
+    :param topic: The topic of the message, used if there is no hardware serial
+    :param payload: The JSON message from TTN
+    :return: The key that decides the worker
+    """
+    start = payload.find(_SERIAL_KEY)
+    if start >= 0:
+        colon = payload.find(b':', start + len(_SERIAL_KEY))
+        start = payload.find(b'"', colon) + 1 if colon >= 0 else 0
+        end = payload.find(b'"', start) if start > 0 else -1
+        if end >= start:
+            return payload[start:end]
+    return topic.encode() if isinstance(topic, str) else topic
+
+
+def shard_of(key: bytes, shards: int) -> int:
+    """
+    :param key: The key from shard_key
+    :param shards: The number of workers
+    :return: The worker the key goes to, the same in every process and every run
+    """
+    return zlib.crc32(key) % shards
+
+
+class _ForwardToLogger(logging.Handler):
+    """
+    Hands the log records of the workers to the logger of the same name in this process
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+def _run_worker(shard: int, db_url: str, echo: bool, messages, done, log_queue, log_level: int,
+                streamer_options: dict) -> None:
+    """
+    The main function of a worker process
+    """
+    # The main process decides when to stop, so what is buffered is written
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(log_level)
+    engine = create_engine(db_url, echo=echo)
+    streamer = Streamer(sessionmaker(bind=engine), **streamer_options)
+    try:
+        while True:
+            item = messages.get()
+            if item is _STOP:
+                break
+            if item == _FLUSH:
+                streamer.flush()
+                done.put(shard)
+                continue
+            streamer.on_message(*item)
+    finally:
+        streamer.close()
+        engine.dispose()
+
+
+class ShardedStreamer(SensorListener):
+    """
+    A SensorListener that hands the messages to worker processes by device
+    """
+
+    def __init__(self, db_url: str,
+                 workers: int = 2,
+                 queue_size: int = 10000,
+                 connection_log_level: int = logging.INFO,
+                 coalesce_seconds: float = 300.0,
+                 echo: bool = False,
+                 **streamer_options):
+        """
+        :param db_url: The database connection URL, each worker connects to it. The schema
+        should already be up to date.
+        :param workers: The number of worker processes
+        :param queue_size: The most messages waiting for each worker; on_message blocks when
+        the queue of the worker is full
+        :param connection_log_level: Connection events logged below this level are not stored
+        :param coalesce_seconds: How often the counts of routine connection events are stored
+        :param echo: Log the SQL of the workers
+        :param streamer_options: Passed to the Streamer of each worker, e.g. batch_size,
+        max_latency_seconds, dedup_window, capture_receptions and maintain_rollups
+        """
+        if workers < 1:
+            raise ValueError("There must be at least one worker")
+        if ":memory:" in db_url or db_url.rstrip("/") == "sqlite:":
+            raise ValueError("The workers cannot share an in-memory database")
+        if streamer_options.get("journal_folder") is not None:
+            raise ValueError("The workers do not support a journal")
+        self.logger = logging.getLogger("lora.mqtt")
+        self.engine = create_engine(db_url, echo=echo)
+        self.connection_events = ConnectionEventRecorder(sessionmaker(bind=self.engine),
+                                                         level=connection_log_level,
+                                                         coalesce_seconds=coalesce_seconds)
+        # Counts of the messages handed to each worker
+        self.shard_counts = [0] * workers
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        # Spawned rather than forked, this process has threads of its own
+        context = multiprocessing.get_context("spawn")
+        self._log_queue = context.Queue()
+        self._log_listener = logging.handlers.QueueListener(self._log_queue, _ForwardToLogger())
+        self._log_listener.start()
+        self._done = context.Queue()
+        self._queues = [context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._processes = []  # type: List[multiprocessing.Process]
+        log_level = self.logger.getEffectiveLevel()
+        for shard, messages in enumerate(self._queues):
+            process = context.Process(target=_run_worker,
+                                      args=(shard, db_url, echo, messages, self._done, self._log_queue,
+                                            log_level, streamer_options),
+                                      name=f"streamer-shard-{shard}",
+                                      daemon=True)
+            process.start()
+            self._processes.append(process)
+        self.logger.info(f"Started {workers} streamer workers")
+
+    @property
+    def workers(self) -> int:
+        return len(self._processes)
+
+    def _put(self, shard: int, item) -> bool:
+        while True:
+            try:
+                self._queues[shard].put(item, timeout=_PUT_TIMEOUT_SECONDS)
+                return True
+            except queue.Full:
+                if not self._processes[shard].is_alive():
+                    self.logger.error(f"Streamer worker {shard} has stopped")
+                    return False
+
+    def on_message(self, topic: bytes, payload: bytes):
+        shard = shard_of(shard_key(topic, payload), len(self._queues))
+        if self._put(shard, (topic, payload)):
+            self.shard_counts[shard] += 1
+        else:
+            self.logger.error(f"Lost payload: {payload.decode()}")
+
+    def flush(self) -> None:
+        """
+        Wait until the workers have written everything received so far
+        :return: None
+        """
+        with self._flush_lock:
+            waiting = set()
+            for shard in range(len(self._queues)):
+                if self._processes[shard].is_alive() and self._put(shard, _FLUSH):
+                    waiting.add(shard)
+            while waiting:
+                try:
+                    waiting.discard(self._done.get(timeout=_PUT_TIMEOUT_SECONDS))
+                except queue.Empty:
+                    for shard in [x for x in waiting if not self._processes[x].is_alive()]:
+                        self.logger.error(f"Streamer worker {shard} stopped before flushing")
+                        waiting.discard(shard)
+        self.connection_events.flush()
+
+    def close(self) -> None:
+        """
+        Have the workers write what they have and stop. Safe to call more than once.
+        :return: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for shard, process in enumerate(self._processes):
+            if process.is_alive():
+                self._put(shard, _STOP)
+        for process in self._processes:
+            process.join()
+        self._log_listener.stop()
+        self.connection_events.close()
+        self.engine.dispose()
+
+    def on_disconnect(self, reason: str):
+        self.logger.error(f"Upstream disconnected - {reason}")
+
+    def on_connection_event(self, reason: str, level: int = logging.INFO) -> None:
+        """
+        Pass the event to the background recorder, this does not wait for the database
+        :param reason: The text of the event
+        :param level: The logging level of the event
+        :return: None
+        """
+        self.connection_events.record(reason, level)
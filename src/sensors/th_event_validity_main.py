@@ -1,20 +1,26 @@
 """
-This pulls events from the database, sorts them by device id and counter and then looks for gaps
-the sequence which could indicate missing messages. Not working, this finds small gaps periodically
-which are due to the Supervisory messages.
+This looks for gaps in the counter sequence of the events from each device which could indicate
+missing messages. The counter often jumps around Supervisory messages, use --exclude-supervisory
+to leave those gaps out. The gaps are found by the database, see sensors.gap_analysis, and can be
+written to a JSON report file as well as the log. With --incremental only the events stored since
+the last incremental run are looked at, which is what a nightly job should use. With --parquet
+the events are read from the Parquet files written by th_export_parquet.py instead.
 
 """
 import argparse
 import configparser
+import json
 import logging
 import logging.config
 import os
-from typing import List
+from pathlib import Path
+from typing import List, Optional
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from models.models import Base, Sensor, LoraEvent, ConnectionEvent
+from models.migrations import upgrade_schema
+from sensors.gap_analysis import find_gaps, update_checkpoints, SensorGapReport
 from utils.date_time_utils import formatiso8601
 
 
@@ -34,11 +40,27 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("-l", "--log-config", required=True, help="Path to logging configuration file")
     parser.add_argument("-i", "--ini-file", required=True,
                         help="Path to the INI file for configuration the application")
-    parser.add_argument("-db", "--db-url", required=True, help="Database connection URL, e.g. sqlite:///:memory:")
+    parser.add_argument("-db", "--db-url", required=False, help="Database connection URL, e.g. sqlite:///:memory:")
     parser.add_argument("-v", "--verbose", required=False, help="SQL logging on or off, default is off",
                         type=str2bool,
                         default=False)
+    parser.add_argument("-s", "--sensor", required=False, action="append",
+                        help="Only check this sensor (device id), can be given more than once")
+    parser.add_argument("-x", "--exclude-supervisory", required=False, type=str2bool, default=False,
+                        help="Leave out gaps next to Supervisory messages, default is false")
+    parser.add_argument("-r", "--report-file", required=False,
+                        help="Write the gap report to this file as JSON")
+    parser.add_argument("--incremental", required=False, type=str2bool, default=False,
+                        help="Only look at events stored since the last incremental run, and report "
+                             "only the new gaps, default is false")
+    parser.add_argument("--parquet", required=False,
+                        help="Read the events from the Parquet files in this folder, written by "
+                             "th_export_parquet.py, instead of the database; this requires pyarrow")
     args = parser.parse_args()
+    if args.db_url is None and args.parquet is None:
+        parser.error("One of --db-url or --parquet is required")
+    if args.parquet is not None and args.incremental:
+        parser.error("--incremental needs the database, it cannot be used with --parquet")
     return args
 
 
@@ -61,46 +83,90 @@ def main():
     config = configparser.ConfigParser()
     config.read(ini_file_path)
 
+    if args.parquet is not None:
+        # Only imported when it is used, it needs pyarrow
+        from sensors import parquet_store
+        logger.info(f"Reading the Parquet files in {args.parquet}")
+        reports = parquet_store.find_gaps(Path(args.parquet), sensor_ids=args.sensor,
+                                          exclude_supervisory=args.exclude_supervisory)
+        write_reports(logger, reports, args.report_file)
+        return
+
     # Set this true to see all the SQL
     sql_logging_on = args.verbose
     db_url = args.db_url
     logger.info(f"Database URL for the ORM {db_url}")
     engine = create_engine(db_url, echo=sql_logging_on)
-    Base.metadata.create_all(engine)
-    session_factory = sessionmaker(bind=engine)
-
-    # Single-threaded batch operation
-    # Need to look at both Temperature and Supervisory messages
-    session = session_factory()
-    try:
-        all_sensors = session.query(Sensor).all()
-        for sensor in all_sensors:
-            logger.info(sensor)
-            all_th_events = sensor.events.order_by(
-                LoraEvent.counter).all()  # type: List[LoraEvent]
-            logger.info(f"  There are {len(all_th_events)} events")
-            logger.info(f"  Lowest Counter {all_th_events[0].counter} Latest Counter {all_th_events[-1].counter}")
-            logger.info(f"  First time {formatiso8601(all_th_events[0].timestamp)}" \
-                        f"  Last time {formatiso8601(all_th_events[-1].timestamp)}")
-            # Look for gaps
-            mru_event = all_th_events[0]
-            start_good_run = mru_event
-            for event in all_th_events:
-                if event.counter > mru_event.counter + 1:
-                    gap = event.counter - mru_event.counter
-                    good_run = mru_event.counter - start_good_run.counter
-                    logger.warning(
-                        f"Gap {gap} > 1 Run before this gap {good_run}, "\
-                        f"{mru_event.counter} / {formatiso8601(mru_event.timestamp)}" \
-                        f" {event.counter} / {formatiso8601(event.timestamp)}")
-                    start_good_run = event
-                mru_event = event
-        all_connection_events = session.query(ConnectionEvent).all()
-    #    for con_event in all_connection_events:
-    #        logger.info(con_event)
-
-    finally:
-        session.close()
+    upgrade_schema(engine)
+
+    if args.incremental:
+        session = sessionmaker(bind=engine)()
+        try:
+            reports = update_checkpoints(session, sensor_ids=args.sensor,
+                                         exclude_supervisory=args.exclude_supervisory)
+        finally:
+            session.close()
+    else:
+        reports = find_gaps(engine, sensor_ids=args.sensor, exclude_supervisory=args.exclude_supervisory)
+    write_reports(logger, reports, args.report_file)
+
+
+def write_reports(logger: logging.Logger, reports: List[SensorGapReport], report_file: Optional[str]) -> None:
+    """
+    Log the gaps of each sensor and write them to the report file if there is one
+    :param logger: Where to log the reports
+    :param reports: The gaps of each sensor
+    :param report_file: The JSON file to write, None to only log them
+    :return: None
+    """
+    for report in reports:
+        log_report(logger, report)
+    if report_file is not None:
+        report_path = Path(report_file)
+        os.makedirs(report_path.parent, exist_ok=True)
+        with open(report_path, "w") as writer:
+            json.dump([report_to_dict(x) for x in reports], writer, indent=2)
+        logger.info(f"Gap report written to {report_path}")
+
+
+def log_report(logger: logging.Logger, report: SensorGapReport) -> None:
+    """
+    Log the counters and times seen for a sensor, with a warning for each gap
+    :param logger: Where to log the report
+    :param report: The gaps for one sensor
+    :return: None
+    """
+    logger.info(f"Sensor {report.sensor_id}")
+    logger.info(f"  There are {report.event_count} events")
+    logger.info(f"  Lowest Counter {report.first_counter} Latest Counter {report.last_counter}")
+    logger.info(f"  First time {formatiso8601(report.first_timestamp)}" \
+                f"  Last time {formatiso8601(report.last_timestamp)}")
+    for gap in report.gaps:
+        logger.warning(
+            f"Gap {gap.counter - gap.prev_counter} > 1 Run before this gap {gap.run_length}, " \
+            f"{gap.prev_counter} / {formatiso8601(gap.prev_timestamp)}" \
+            f" {gap.counter} / {formatiso8601(gap.timestamp)}")
+    logger.info(f"  {len(report.gaps)} gaps, {report.missing_total} counters missing")
+
+
+def report_to_dict(report: SensorGapReport) -> dict:
+    """
+    :param report: The gaps for one sensor
+    :return: The report as a dictionary that can be written as JSON
+    """
+    return {'sensor_id': report.sensor_id,
+            'event_count': report.event_count,
+            'first_counter': report.first_counter,
+            'last_counter': report.last_counter,
+            'first_timestamp': formatiso8601(report.first_timestamp),
+            'last_timestamp': formatiso8601(report.last_timestamp),
+            'missing_total': report.missing_total,
+            'gaps': [{'prev_counter': x.prev_counter,
+                      'prev_timestamp': formatiso8601(x.prev_timestamp),
+                      'counter': x.counter,
+                      'timestamp': formatiso8601(x.timestamp),
+                      'missing': x.missing,
+                      'run_length': x.run_length} for x in report.gaps]}
 
 
 if __name__ == "__main__":
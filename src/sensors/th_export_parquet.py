@@ -0,0 +1,80 @@
+"""
+Exports the events stored in the database to Parquet files, partitioned by type of event,
+sensor and month, see sensors.parquet_store. Each run only exports the events stored since the
+last one. th_visualize.py and th_event_validity_main.py can read the files with --parquet.
+This requires pyarrow.
+"""
+import argparse
+import configparser
+import logging
+import logging.config
+import os
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from models.migrations import upgrade_schema
+from sensors.parquet_store import export_events, CHUNK_SIZE
+
+
+def str2bool(v):
+    if isinstance(v, bool):
+        return v
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export the events to Parquet files")
+    parser.add_argument("-l", "--log-config", required=True, help="Path to logging configuration file")
+    parser.add_argument("-i", "--ini-file", required=True,
+                        help="Path to the INI file for configuration the application")
+    parser.add_argument("-db", "--db-url", required=True, help="Database connection URL, e.g. sqlite:///:memory:")
+    parser.add_argument("-v", "--verbose", required=False, help="SQL logging on or off, default is off",
+                        type=str2bool,
+                        default=False)
+    parser.add_argument("-o", "--output-folder", required=True,
+                        help="The events are exported to Parquet files in this folder")
+    parser.add_argument("-b", "--batch-size", required=False, type=int, default=CHUNK_SIZE,
+                        help=f"The number of events read and written at a time, default {CHUNK_SIZE}")
+    args = parser.parse_args()
+    return args
+
+
+#
+def main():
+    args = parse_arguments()
+    logging_configuration = args.log_config
+    if not os.path.exists(logging_configuration):
+        print("Path to logging configuration not found: ", logging_configuration)
+        return
+
+    log_folder = "target/logs"
+    os.makedirs(log_folder, exist_ok=True)
+
+    logging.config.fileConfig(logging_configuration, disable_existing_loggers=False)
+    logger = logging.getLogger("lora.mqtt")
+
+    ini_file_path = args.ini_file
+    # The configuration file path will become a command-line argument
+    config = configparser.ConfigParser()
+    config.read(ini_file_path)
+
+    # Set this true to see all the SQL
+    sql_logging_on = args.verbose
+    db_url = args.db_url
+    logger.info(f"Database URL for the ORM {db_url}")
+    engine = create_engine(db_url, echo=sql_logging_on)
+    upgrade_schema(engine)
+
+    report = export_events(engine, Path(args.output_folder), chunk_size=args.batch_size)
+    logger.info(f"Exported {report.events} events to {report.files} files, "
+                f"up to event {report.last_event_id}")
+
+
+if __name__ == "__main__":
+    main()
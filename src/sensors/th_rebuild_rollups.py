@@ -0,0 +1,75 @@
+"""
+Makes the measurement rollups (5 minute, hourly and daily summaries of each sensor) again from
+the measurements stored in the database. Use this for a database that was filled before the
+rollups were kept up to date by the feed (lolevel_mqtt_2.py --rollups), or to repair them.
+"""
+import argparse
+import configparser
+import logging
+import logging.config
+import os
+
+from sqlalchemy import create_engine
+
+from models.migrations import upgrade_schema
+from sensors.rollups import rebuild_rollups
+
+
+def str2bool(v):
+    if isinstance(v, bool):
+        return v
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Rebuild the measurement rollups")
+    parser.add_argument("-l", "--log-config", required=True, help="Path to logging configuration file")
+    parser.add_argument("-i", "--ini-file", required=True,
+                        help="Path to the INI file for configuration the application")
+    parser.add_argument("-db", "--db-url", required=True, help="Database connection URL, e.g. sqlite:///:memory:")
+    parser.add_argument("-v", "--verbose", required=False, help="SQL logging on or off, default is off",
+                        type=str2bool,
+                        default=False)
+    parser.add_argument("-s", "--sensor", required=False, action="append",
+                        help="Only rebuild this sensor (device id), can be given more than once")
+    args = parser.parse_args()
+    return args
+
+
+#
+def main():
+    args = parse_arguments()
+    logging_configuration = args.log_config
+    if not os.path.exists(logging_configuration):
+        print("Path to logging configuration not found: ", logging_configuration)
+        return
+
+    log_folder = "target/logs"
+    os.makedirs(log_folder, exist_ok=True)
+
+    logging.config.fileConfig(logging_configuration, disable_existing_loggers=False)
+    logger = logging.getLogger("lora.mqtt")
+
+    ini_file_path = args.ini_file
+    # The configuration file path will become a command-line argument
+    config = configparser.ConfigParser()
+    config.read(ini_file_path)
+
+    # Set this true to see all the SQL
+    sql_logging_on = args.verbose
+    db_url = args.db_url
+    logger.info(f"Database URL for the ORM {db_url}")
+    engine = create_engine(db_url, echo=sql_logging_on)
+    upgrade_schema(engine)
+
+    total = rebuild_rollups(engine, sensor_ids=args.sensor)
+    logger.info(f"Rebuilt {total} rollups")
+
+
+if __name__ == "__main__":
+    main()
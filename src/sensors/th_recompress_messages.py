@@ -0,0 +1,86 @@
+"""
+Rewrites the raw messages stored in the event table in the current compressed format (see
+models.compression). Use this for a database filled before the messages were compressed, to
+switch between zlib and zstd, or to move to a new dictionary. It can be stopped and run again.
+"""
+import argparse
+import configparser
+import logging
+import logging.config
+import os
+
+from sqlalchemy import create_engine
+
+from models.compression import CODEC_NAMES, default_codec
+from models.migrations import upgrade_schema, recompress_messages
+
+
+def str2bool(v):
+    if isinstance(v, bool):
+        return v
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Recompress the stored raw messages")
+    parser.add_argument("-l", "--log-config", required=True, help="Path to logging configuration file")
+    parser.add_argument("-i", "--ini-file", required=True,
+                        help="Path to the INI file for configuration the application")
+    parser.add_argument("-db", "--db-url", required=True, help="Database connection URL, e.g. sqlite:///:memory:")
+    parser.add_argument("-v", "--verbose", required=False, help="SQL logging on or off, default is off",
+                        type=str2bool,
+                        default=False)
+    parser.add_argument("-c", "--codec", required=False, choices=list(CODEC_NAMES.values()),
+                        default=CODEC_NAMES[default_codec()],
+                        help="The compression to use, default is zstd if the zstandard package is installed "
+                             "otherwise zlib; none stores the messages uncompressed")
+    parser.add_argument("-b", "--batch-size", required=False, type=int, default=1000,
+                        help="Rows rewritten in one transaction, default 1000")
+    parser.add_argument("--vacuum", required=False, type=str2bool, default=False,
+                        help="Run VACUUM afterwards so an SQLite database file shrinks, default is false")
+    args = parser.parse_args()
+    return args
+
+
+#
+def main():
+    args = parse_arguments()
+    logging_configuration = args.log_config
+    if not os.path.exists(logging_configuration):
+        print("Path to logging configuration not found: ", logging_configuration)
+        return
+
+    log_folder = "target/logs"
+    os.makedirs(log_folder, exist_ok=True)
+
+    logging.config.fileConfig(logging_configuration, disable_existing_loggers=False)
+    logger = logging.getLogger("lora.mqtt")
+
+    ini_file_path = args.ini_file
+    # The configuration file path will become a command-line argument
+    config = configparser.ConfigParser()
+    config.read(ini_file_path)
+
+    # Set this true to see all the SQL
+    sql_logging_on = args.verbose
+    db_url = args.db_url
+    logger.info(f"Database URL for the ORM {db_url}")
+    engine = create_engine(db_url, echo=sql_logging_on)
+    upgrade_schema(engine)
+
+    codec = {v: k for k, v in CODEC_NAMES.items()}[args.codec]
+    report = recompress_messages(engine, codec=codec, batch_size=args.batch_size)
+    logger.info(f"Rewrote {report.rows_rewritten} of {report.rows_read} messages, "
+                f"{report.bytes_before} bytes before, {report.bytes_after} after")
+    if args.vacuum:
+        logger.info("Vacuuming the database")
+        engine.execute("VACUUM")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Replays archives of messages (one JSON message per line, as written by th_save_messages.py or
+exported from TTN, optionally gzip or zstd compressed) into a database, e.g. to backfill a new
+database. An interrupted replay carries on from where it stopped when it is run again.
+"""
+import argparse
+import configparser
+import logging
+import logging.config
+import os
+
+from sqlalchemy import create_engine
+
+from models.migrations import upgrade_schema
+from sensors.replay import Replayer
+
+
+def str2bool(v):
+    if isinstance(v, bool):
+        return v
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay message archives into a database")
+    parser.add_argument("-l", "--log-config", required=True, help="Path to logging configuration file")
+    parser.add_argument("-i", "--ini-file", required=True,
+                        help="Path to the INI file for configuration the application")
+    parser.add_argument("-db", "--db-url", required=True, help="Database connection URL, e.g. sqlite:///:memory:")
+    parser.add_argument("-v", "--verbose", required=False, help="SQL logging on or off, default is off",
+                        type=str2bool,
+                        default=False)
+    parser.add_argument("-a", "--archive", required=True, action="append",
+                        help="The archive to replay, can be given more than once")
+    parser.add_argument("-w", "--workers", required=False, type=int, default=None,
+                        help="Number of processes parsing the messages, default is one per CPU")
+    parser.add_argument("-b", "--batch-size", required=False, type=int, default=5000,
+                        help="Lines parsed and stored in one transaction, default 5000")
+    parser.add_argument("-d", "--dedup-window", required=False, type=int, default=32,
+                        help="Fold the copies of confirmed uplinks as the feed does, remembering this many "
+                             "recent counters for each device, default 32; 0 stores every copy")
+    parser.add_argument("-r", "--rollups", required=False, type=str2bool, default=False,
+                        help="Add the measurements to the rollups used for long-range charts, default is false")
+    parser.add_argument("--restart", required=False, type=str2bool, default=False,
+                        help="Start each archive from the beginning rather than where the last run stopped")
+    args = parser.parse_args()
+    return args
+
+
+#
+def main():
+    args = parse_arguments()
+    logging_configuration = args.log_config
+    if not os.path.exists(logging_configuration):
+        print("Path to logging configuration not found: ", logging_configuration)
+        return
+
+    log_folder = "target/logs"
+    os.makedirs(log_folder, exist_ok=True)
+
+    logging.config.fileConfig(logging_configuration, disable_existing_loggers=False)
+    logger = logging.getLogger("lora.mqtt")
+
+    ini_file_path = args.ini_file
+    # The configuration file path will become a command-line argument
+    config = configparser.ConfigParser()
+    config.read(ini_file_path)
+
+    # Set this true to see all the SQL
+    sql_logging_on = args.verbose
+    db_url = args.db_url
+    logger.info(f"Database URL for the ORM {db_url}")
+    engine = create_engine(db_url, echo=sql_logging_on)
+    upgrade_schema(engine)
+
+    replayer = Replayer(engine,
+                        workers=args.workers,
+                        chunk_lines=args.batch_size,
+                        dedup_window=args.dedup_window,
+                        maintain_rollups=args.rollups)
+    for archive in args.archive:
+        report = replayer.replay(archive, restart=args.restart)
+        logger.info(f"Replayed {report.archive}: {report.lines} lines from line {report.resumed_at}, "
+                    f"{report.events} events stored, {report.duplicates} copies folded, "
+                    f"{report.bad_lines} bad lines, {report.already_stored} already stored")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 """
-This pulls events from the database, and writes the wrong messages to a file for
-subsequent use in testing.
+This pulls events from the database, and writes the raw messages to a file for
+subsequent use in testing, or to replay into another database with th_replay_messages.py.
+The messages are streamed from the database and written as they are read.
 """
 import argparse
 import configparser
@@ -8,12 +9,15 @@ import logging
 import logging.config
 import os
 from pathlib import Path
-from typing import List
 
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
-from models.models import Base, LoraEvent
+from models.migrations import upgrade_schema
+from models.models import TempHumidityMeasurement, Supervisory, LinkQ
+from sensors.message_export import export_messages, open_output
+from utils.date_time_utils import parseiso8601
+
+EVENT_TYPES = [x.__mapper_args__['polymorphic_identity'] for x in (TempHumidityMeasurement, Supervisory, LinkQ)]
 
 
 def str2bool(v):
@@ -33,10 +37,19 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("-i", "--ini-file", required=True,
                         help="Path to the INI file for configuration the application")
     parser.add_argument("-db", "--db-url", required=True, help="Database connection URL, e.g. sqlite:///:memory:")
-    parser.add_argument("-o", "--output-file", required=True, help="Raw messages will be written to this file")
+    parser.add_argument("-o", "--output-file", required=True,
+                        help="Raw messages will be written to this file, compressed if it ends in .gz or .zst")
     parser.add_argument("-v", "--verbose", required=False, help="SQL logging on or off, default is off",
                         type=str2bool,
                         default=False)
+    parser.add_argument("-s", "--sensor", required=False, action="append",
+                        help="Only write the messages of this sensor (device id), can be given more than once")
+    parser.add_argument("-t", "--type", required=False, action="append", choices=EVENT_TYPES,
+                        help="Only write this kind of message, can be given more than once")
+    parser.add_argument("--start", required=False, type=parseiso8601,
+                        help="Only write messages received from this time on, ISO8601 e.g. 2020-10-01T00:00:00Z")
+    parser.add_argument("--end", required=False, type=parseiso8601,
+                        help="Only write messages received before this time, ISO8601")
     args = parser.parse_args()
     return args
 
@@ -69,21 +82,16 @@ def main():
     db_url = args.db_url
     logger.info(f"Database URL for the ORM {db_url}")
     engine = create_engine(db_url, echo=sql_logging_on)
-    Base.metadata.create_all(engine)
-    session_factory = sessionmaker(bind=engine)
-
-    # Single-threaded batch operation
-    # Need to look at both Temperature and Supervisory messages
-    session = session_factory()
-    try:
-        with open(out_file_path, "w") as writer:
-            measurements = session.query(LoraEvent). \
-                order_by(LoraEvent.counter).all()  # type: List[LoraEvent]
-            messages = [x.raw_message.decode("utf-8") + '\n' for x in measurements]
-            writer.writelines(messages)
-
-    finally:
-        session.close()
+    upgrade_schema(engine)
+
+    # Single-threaded batch operation, in sensor and counter order
+    with open_output(out_file_path) as writer:
+        count = export_messages(engine, writer,
+                                sensor_ids=args.sensor,
+                                types=args.type,
+                                start=args.start,
+                                end=args.end)
+    logger.info(f"Wrote {count} messages to {out_file_path}")
 
 
 if __name__ == "__main__":
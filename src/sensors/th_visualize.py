@@ -1,21 +1,24 @@
 """
-Visualize the temperature data
+Visualize the temperature data, from the database or from the Parquet files written by
+th_export_parquet.py
 """
 import argparse
 import configparser
 import logging
 import logging.config
 import os
-from collections import defaultdict
-from time import sleep
+from pathlib import Path
 
-import pandas as pd
 import matplotlib.pyplot as plt
 
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from models.models import Base, Sensor
+from models.migrations import upgrade_schema
+from models.models import Sensor
+from sensors.measurement_loader import load_measurements, load_rollups, measurement_time_range
+from sensors.rollups import choose_resolution
+from utils.date_time_utils import parseiso8601
 
 
 def str2bool(v):
@@ -34,34 +37,28 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("-l", "--log-config", required=True, help="Path to logging configuration file")
     parser.add_argument("-i", "--ini-file", required=True,
                         help="Path to the INI file for configuration the application")
-    parser.add_argument("-db", "--db-url", required=True, help="Database connection URL, e.g. sqlite:///:memory:")
+    parser.add_argument("-db", "--db-url", required=False, help="Database connection URL, e.g. sqlite:///:memory:")
     parser.add_argument("-v", "--verbose", required=False, help="SQL logging on or off, default is off",
                         type=str2bool,
                         default=False)
+    parser.add_argument("--start", required=False, type=parseiso8601,
+                        help="Only plot measurements from this time on, ISO8601 e.g. 2020-10-01T00:00:00Z")
+    parser.add_argument("--end", required=False, type=parseiso8601,
+                        help="Only plot measurements before this time, ISO8601")
+    parser.add_argument("-r", "--rollups", required=False, type=str2bool, default=False,
+                        help="Plot the 5 minute, hourly or daily summaries, whichever is the coarsest that "
+                             "still fills the width of the plot, instead of every measurement; default is false")
+    parser.add_argument("-p", "--pixels", required=False, type=int, default=1600,
+                        help="The width of the plot in pixels, used to choose the rollups, default 1600")
+    parser.add_argument("--parquet", required=False,
+                        help="Read the measurements from the Parquet files in this folder, written by "
+                             "th_export_parquet.py, instead of the database; this requires pyarrow")
     args = parser.parse_args()
+    if args.db_url is None and args.parquet is None:
+        parser.error("One of --db-url or --parquet is required")
     return args
 
 
-def query_to_list(rset):
-    """List of result
-    Return: columns name, list of result
-    """
-    result = []
-    for obj in rset:
-        instance = inspect(obj)
-        items = instance.attrs.items()
-        result.append([x.value for _,x in items])
-    return instance.attrs.keys(), result
-
-def query_to_dict(rset):
-    result = defaultdict(list)
-    for obj in rset:
-        instance = inspect(obj)
-        for key, x in instance.attrs.items():
-            result[key].append(x.value)
-    return result
-
-
 #
 def main():
     args = parse_arguments()
@@ -81,36 +78,98 @@ def main():
     config = configparser.ConfigParser()
     config.read(ini_file_path)
 
+    if args.parquet is not None:
+        all_sensors, measurements, resolution = load_from_parquet(args, logger)
+    else:
+        all_sensors, measurements, resolution = load_from_database(args, logger)
+    value_column = 'temp_mean' if resolution is not None else 'temp_c'
+
+    plt.figure()
+    by_sensor = dict(tuple(measurements.groupby('sensor_id', observed=True)))
+    for sensor in all_sensors:
+        logger.info(sensor)
+        if sensor.device_id not in by_sensor:
+            continue
+        df2 = by_sensor[sensor.device_id]
+        x = df2['timestamp']
+        y1 = df2[value_column]
+        lines = plt.plot(x,y1,label=f"{sensor.device_name} ({sensor.device_id})")
+        if resolution is not None:
+            # Shade the range of the measurements in each bucket
+            plt.fill_between(x, df2['temp_min'], df2['temp_max'], color=lines[0].get_color(), alpha=0.2)
+    # Need to call plt.show() to cause the plots to display
+    # In PyCharm a window will open to show them
+    plt.xlabel('Date/Time')
+    plt.ylabel('Temp Deg C')
+    plt.xticks(rotation=90)
+    plt.legend()
+    plt.show()
+
+
+def log_resolution(logger: logging.Logger, resolution) -> None:
+    """
+    Log whether rollups or every measurement will be plotted
+    :param logger: The logger to use
+    :param resolution: The resolution of the rollups in seconds, None for every measurement
+    :return: None
+    """
+    logger.info(f"Plotting rollups at {resolution} seconds" if resolution is not None
+                else "Time range is too short for the rollups, plotting every measurement")
+
+
+def load_from_database(args: argparse.Namespace, logger: logging.Logger):
+    """
+    :return: The sensors, the measurements or rollups to plot, and the resolution of the
+    rollups, None for every measurement
+    """
     # Set this true to see all the SQL
     sql_logging_on = args.verbose
     db_url = args.db_url
     logger.info(f"Database URL for the ORM {db_url}")
     engine = create_engine(db_url, echo=sql_logging_on)
-    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
     session_factory = sessionmaker(bind=engine)
 
     # Single-threaded batch operation
-    # Need to look at both Temperature and Supervisory messages
     session = session_factory()
     try:
-        plt.figure()
         all_sensors = session.query(Sensor).all()
-        for sensor in all_sensors:
-            logger.info(sensor)
-            names, data = query_to_list(sensor.measurements.all())
-            df2 = pd.DataFrame.from_records(data, columns=names)
-            x = df2['timestamp']
-            y1 = df2['temp_c']
-            plt.plot(x,y1,label=f"{sensor.device_name} ({sensor.device_id})")
-        # Need to call plt.show() to cause the plots to display
-        # In PyCharm a window will open to show them
-        plt.xlabel('Date/Time')
-        plt.ylabel('Temp Deg C')
-        plt.xticks(rotation=90)
-        plt.legend()
-        plt.show()
     finally:
         session.close()
+    resolution = None
+    if args.rollups:
+        first, last = measurement_time_range(engine)
+        if first is not None:
+            resolution = choose_resolution(args.start or first, args.end or last, args.pixels)
+        log_resolution(logger, resolution)
+    if resolution is not None:
+        measurements = load_rollups(engine, resolution, start=args.start, end=args.end)
+    else:
+        measurements = load_measurements(engine, start=args.start, end=args.end)
+    return all_sensors, measurements, resolution
+
+
+def load_from_parquet(args: argparse.Namespace, logger: logging.Logger):
+    """
+    As load_from_database, the rollups are made from the measurements in the files
+    """
+    # Only imported when it is used, it needs pyarrow
+    from sensors import parquet_store
+
+    root = Path(args.parquet)
+    logger.info(f"Reading the Parquet files in {root}")
+    all_sensors = parquet_store.load_sensors(root)
+    measurements = parquet_store.load_measurements(root, start=args.start, end=args.end)
+    resolution = None
+    if args.rollups:
+        if len(measurements) > 0:
+            resolution = choose_resolution(args.start or measurements['timestamp'].min().to_pydatetime(),
+                                           args.end or measurements['timestamp'].max().to_pydatetime(),
+                                           args.pixels)
+        log_resolution(logger, resolution)
+    if resolution is not None:
+        measurements = parquet_store.summarise_measurements(measurements, resolution)
+    return all_sensors, measurements, resolution
 
 
 if __name__ == "__main__":
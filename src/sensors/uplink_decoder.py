@@ -0,0 +1,145 @@
+"""
+Decoder for TTN v2 uplink messages. The message is parsed into a small set of fixed classes
+with __slots__ instead of making a new namedtuple class for every JSON object. orjson or
+ujson are used for the JSON parsing when installed, otherwise the standard json module.
+
+If the message has no payload_fields, because payload formatting is turned off in TTN,
+they are decoded from payload_raw by sensors.payload_decoder.
+
+The message format is described here: https://www.thethingsnetwork.org/docs/applications/mqtt/api.html
+"""
+import json
+from typing import Iterable, List, Optional, Union
+
+from sensors.payload_decoder import decode_payload_raw
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:  # pragma: no cover - depends on what is installed
+    try:
+        import ujson
+
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
+
+class Gateway:
+    """
+    One of the gateways that received the uplink, from metadata.gateways
+    """
+    __slots__ = ('gtw_id', 'timestamp', 'time', 'channel', 'rssi', 'snr', 'rf_chain')
+
+    def __init__(self, d: dict):
+        get = d.get
+        self.gtw_id = get('gtw_id')  # type: str
+        self.timestamp = get('timestamp')  # type: int
+        self.time = get('time')  # type: str
+        self.channel = get('channel')  # type: int
+        self.rssi = get('rssi')  # type: float
+        self.snr = get('snr')  # type: float
+        self.rf_chain = get('rf_chain')  # type: int
+
+    def __repr__(self):
+        return f"Gateway(gtw_id={self.gtw_id}, rssi={self.rssi}, snr={self.snr})"
+
+
+class Metadata:
+    """
+    The metadata of the uplink, the reception time is in here
+    """
+    __slots__ = ('time', 'frequency', 'modulation', 'data_rate', 'airtime', 'coding_rate',
+                 'gateways', 'latitude', 'longitude', 'location_source')
+
+    def __init__(self, d: dict):
+        get = d.get
+        self.time = get('time')  # type: str
+        self.frequency = get('frequency')  # type: float
+        self.modulation = get('modulation')  # type: str
+        self.data_rate = get('data_rate')  # type: str
+        self.airtime = get('airtime')  # type: int
+        self.coding_rate = get('coding_rate')  # type: str
+        self.gateways = [Gateway(x) for x in get('gateways') or ()]  # type: List[Gateway]
+        self.latitude = get('latitude')  # type: float
+        self.longitude = get('longitude')  # type: float
+        self.location_source = get('location_source')  # type: str
+
+    def __repr__(self):
+        return f"Metadata(time={self.time}, data_rate={self.data_rate}, gateways={self.gateways})"
+
+
+class PayloadFields:
+    """
+    The fields made by the payload format decoder in TTN (javascript/payload_format.js).
+    Fields that do not apply to the kind of message are None.
+    """
+    __slots__ = ('version', 'pktcnt', 'msgtype', 'msgdesc', 'event_type',
+                 'sensor_event_type', 'temp_c', 'temp_f', 'humidity_percent',
+                 'errorcodes', 'sensor_state', 'batlevel')
+
+    def __init__(self, d: dict):
+        get = d.get
+        self.version = get('version')  # type: int
+        self.pktcnt = get('pktcnt')  # type: int
+        self.msgtype = get('msgtype')  # type: int
+        self.msgdesc = get('msgdesc')  # type: str
+        self.event_type = get('event_type')  # type: str
+        self.sensor_event_type = get('sensor_event_type')  # type: int
+        self.temp_c = get('temp_c')  # type: float
+        self.temp_f = get('temp_f')  # type: float
+        self.humidity_percent = get('humidity_percent')  # type: float
+        self.errorcodes = get('errorcodes')  # type: int
+        self.sensor_state = get('sensor_state')  # type: int
+        self.batlevel = get('batlevel')  # type: float
+
+    def __repr__(self):
+        return f"PayloadFields(msgtype={self.msgtype}, event_type={self.event_type})"
+
+
+class Uplink:
+    """
+    A TTN v2 uplink message
+    """
+    __slots__ = ('app_id', 'dev_id', 'hardware_serial', 'port', 'counter', 'confirmed',
+                 'is_retry', 'payload_raw', 'payload_fields', 'metadata')
+
+    def __init__(self, d: dict):
+        get = d.get
+        self.app_id = get('app_id')  # type: str
+        self.dev_id = get('dev_id')  # type: str
+        self.hardware_serial = get('hardware_serial')  # type: str
+        self.port = get('port')  # type: int
+        self.counter = get('counter')  # type: int
+        self.confirmed = get('confirmed', False)  # type: bool
+        self.is_retry = get('is_retry', False)  # type: bool
+        self.payload_raw = get('payload_raw')  # type: str
+        fields = get('payload_fields')
+        if fields is None and self.payload_raw:
+            fields = decode_payload_raw(self.payload_raw)
+        self.payload_fields = PayloadFields(fields) if fields is not None else None  # type: Optional[PayloadFields]
+        self.metadata = Metadata(get('metadata') or {})  # type: Metadata
+
+    def __repr__(self):
+        return f"Uplink(dev_id={self.dev_id}, hardware_serial={self.hardware_serial}, " \
+               f"counter={self.counter}, payload_fields={self.payload_fields})"
+
+
+def decode_uplink(payload: Union[bytes, str]) -> Uplink:
+    """
+    Decode an uplink message
+    :param payload: The JSON message as received from the broker
+    :return: The message; fields missing from the JSON are None
+    """
+    return Uplink(json_loads(payload))
+
+
+def payloads_from_messages(raw_messages: Iterable[bytes]) -> List[str]:
+    """
+    Pull the payload_raw field out of stored messages (LoraEvent.raw_message), to hand
+    to payload_decoder.decode_payloads_bulk
+    :param raw_messages: The JSON messages
+    :return: The payload_raw of each message
+    """
+    return [json_loads(x)['payload_raw'] for x in raw_messages]
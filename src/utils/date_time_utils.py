@@ -1,7 +1,13 @@
+import re
 from datetime import datetime, timezone
+from typing import Iterable, Tuple
 
 from dateutil import parser as dp
 
+# The format TTN uses for metadata.time, UTC with up to nanosecond resolution,
+# e.g. 2020-10-04T18:57:51.159517049Z
+_TTN_TIME_FORMAT = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,9}))?Z$")
+
 
 def get_utc_now() -> datetime:
     """
@@ -26,13 +32,61 @@ def formatiso8601(timestamp: datetime, timespec: str = 'milliseconds') -> str:
     return datetime.isoformat(timestamp, timespec=timespec).replace('+00:00', 'Z')
 
 
+def parseiso8601_ns(timestamp_str: str) -> Tuple[datetime, int]:
+    """
+    Parses a string in ISO8601 format keeping the nanoseconds that a datetime cannot hold.
+    The TTN format (UTC, Z suffix, up to 9 places of decimals) is parsed directly, anything
+    else is handed to dateutil.
+    :param timestamp_str: eg. 2020-10-04T18:57:51.159517049Z
+    :return: The datetime object with timezone UTC, truncated to microseconds, and the
+    nanoseconds left over (0-999), 49 in the example
+    """
+    match = _TTN_TIME_FORMAT.match(timestamp_str)
+    if match is None:
+        return dp.parse(timestamp_str).astimezone(timezone.utc), 0
+    year, month, day, hour, minute, second, fraction = match.groups()
+    if fraction is None:
+        nanoseconds = 0
+    else:
+        nanoseconds = int(fraction.ljust(9, '0'))
+    timestamp = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                         nanoseconds // 1000, tzinfo=timezone.utc)
+    return timestamp, nanoseconds % 1000
+
+
 def parseiso8601(timestamp_str: str) -> datetime:
     """
     Parses a string in ISO8601 format with or without milliseconds.
-    This requires the dateutil package
+    The TTN format is parsed directly, other formats need the dateutil package
     :param timestamp_str: eg. 2020-10-04T18:57:51.159517049Z. Note: this
-    shows the time to nanosecond resolution but is TBD on whether the datetime
-    holds the value to nanosecond resolution.
+    shows the time to nanosecond resolution but the datetime only holds microseconds,
+    the rest is dropped; use parseiso8601_ns to keep it.
     :return: datetime object with timezone
     """
-    return dp.parse(timestamp_str).astimezone(timezone.utc)
+    return parseiso8601_ns(timestamp_str)[0]
+
+
+def parseiso8601_array(timestamp_strs: Iterable[str]):
+    """
+    Parses a whole column of ISO8601 strings at once, for the batch tools.
+    This requires numpy.
+    :param timestamp_strs: The strings, normally in the TTN format
+    :return: A numpy array of datetime64[ns] holding the UTC times, to full nanosecond resolution
+    """
+    import numpy as np
+
+    values = list(timestamp_strs)
+    fast = [x is not None and _TTN_TIME_FORMAT.match(x) is not None for x in values]
+    if all(fast):
+        # numpy parses the ISO format itself but does not want the zone
+        return np.array([x[:-1] for x in values], dtype='datetime64[ns]')
+    result = np.empty(len(values), dtype='datetime64[ns]')
+    for index, (value, is_fast) in enumerate(zip(values, fast)):
+        if is_fast:
+            result[index] = np.datetime64(value[:-1], 'ns')
+        elif value is None:
+            result[index] = np.datetime64('NaT')
+        else:
+            timestamp = dp.parse(value).astimezone(timezone.utc).replace(tzinfo=None)
+            result[index] = np.datetime64(timestamp, 'ns')
+    return result
@@ -0,0 +1,58 @@
+"""
+Helpers for the tests that make the test databases and check what was stored in them
+"""
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models.migrations import upgrade_schema
+from models.models import Base, LoraEvent
+
+
+def make_engine(tmp_path=None, upgrade: bool = False, **kwargs):
+    """
+    Makes a SQLite database with the tables of the models
+    :param tmp_path: the folder for the database file, in memory when None. A test with a writer thread
+    needs a file because the thread has its own connection
+    :param upgrade: make the tables with upgrade_schema as the tools do, rather than create_all
+    :param kwargs: passed on to create_engine
+    :return: the engine
+    """
+    db_url = f"sqlite:///{tmp_path / 'lora.db'}" if tmp_path else "sqlite:///:memory:"
+    engine = create_engine(db_url, **kwargs)
+    if upgrade:
+        upgrade_schema(engine)
+    else:
+        Base.metadata.create_all(engine)
+    return engine
+
+
+def make_session_factory(tmp_path=None, upgrade: bool = False, **kwargs):
+    """
+    Makes a SQLite database as make_engine does
+    :return: the engine and a session factory bound to it
+    """
+    engine = make_engine(tmp_path, upgrade=upgrade, **kwargs)
+    return engine, sessionmaker(bind=engine)
+
+
+def count_rows(Session, entity=LoraEvent) -> int:
+    session = Session()
+    try:
+        return session.query(entity).count()
+    finally:
+        session.close()
+
+
+def query_plan(engine, query) -> str:
+    statement = getattr(query, 'statement', query)
+    sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+    rows = engine.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    return "\n".join(row[-1] for row in rows)
+
+
+def assert_uses_index(plan: str, index_name: str):
+    assert f"USING INDEX {index_name}" in plan or f"USING COVERING INDEX {index_name}" in plan, plan
+    # A full scan of the table shows up as SCAN event (or SCAN TABLE event in older SQLite)
+    # with no index, scanning the whole of an index is fine when all rows are wanted
+    for line in plan.splitlines():
+        assert not (line.startswith("SCAN") and " event" in line and "INDEX" not in line), plan
@@ -0,0 +1,97 @@
+"""
+Tests for the asyncio front end
+"""
+import asyncio
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+
+from sensors.async_comms import AsyncMqttComms, AsyncSensorListener, AsyncStreamer
+from sensors.db_streamer import Streamer
+from tests.db_helpers import make_session_factory, count_rows
+
+test_data_path = Path("./testdata/messages.txt")
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+
+def test_async_streamer(tmp_path):
+    # A file, the writes are done on the threads of the pool
+    _, Session = make_session_factory(tmp_path)
+
+    async def store():
+        streamer = AsyncStreamer(Session, batch_size=25, max_latency_seconds=0.05, queue_size=50)
+        with open(test_data_path, "rb") as reader:
+            for line in reader:
+                await streamer.on_message(topic, line)
+        await streamer.flush()
+        assert count_rows(Session) == 309
+        await streamer.close()
+
+    asyncio.run(store())
+
+
+def test_async_streamer_dedup(tmp_path):
+    _, Session = make_session_factory(tmp_path)
+    lines = test_data_path.read_bytes().splitlines()
+
+    async def store():
+        streamer = AsyncStreamer(Session, batch_size=10, max_latency_seconds=0.01, dedup_window=32)
+        for line in lines:
+            await streamer.on_message(topic, line)
+            # Let some batches go before their copies arrive
+            await asyncio.sleep(0)
+        await streamer.close()
+
+    asyncio.run(store())
+    (tmp_path / "expected").mkdir()
+    _, expected_Session = make_session_factory(tmp_path / "expected")
+    expected = Streamer(expected_Session, dedup_window=32)
+    for line in lines:
+        expected.on_message(topic, line)
+    assert count_rows(Session) == count_rows(expected_Session)
+
+
+class SlowListener(AsyncSensorListener):
+
+    def __init__(self):
+        self.received = []
+        self.go = asyncio.Event()
+        self.closed = False
+
+    async def on_message(self, topic: str, payload: bytes):
+        await self.go.wait()
+        self.received.append(payload)
+
+    def on_disconnect(self, reason: str):
+        pass
+
+    def on_connection_event(self, reason: str, level: int = 0) -> None:
+        pass
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+def make_message(number: int) -> mqtt.MQTTMessage:
+    message = mqtt.MQTTMessage(topic=topic.encode())
+    message.payload = str(number).encode()
+    return message
+
+
+def test_comms_backpressure():
+    async def receive():
+        listener = SlowListener()
+        comms = AsyncMqttComms(cert_path=None, username="app", password="key", hostname="localhost", port=0,
+                               msg_listener=listener, client_id="test-async", queue_size=10)
+        comms._start()
+        deliver = asyncio.create_task(comms._deliver())
+        for number in range(12):
+            comms.on_message(comms.client, None, make_message(number))
+        assert comms.paused
+        listener.go.set()
+        await comms._messages.join()
+        assert not comms.paused
+        assert listener.received == [str(x).encode() for x in range(12)]
+        deliver.cancel()
+
+    asyncio.run(receive())
@@ -0,0 +1,101 @@
+"""
+Tests for the compressed storage of the raw messages
+"""
+import logging
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine, select, type_coerce, LargeBinary
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import table, column
+
+from models.compression import CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD, RECOMPRESS_LEVEL, compress_message, \
+    decompress_message, stored_format, zstandard
+from models.migrations import upgrade_schema, recompress_messages
+from models.models import LoraEvent, Sensor, Supervisory
+from sensors.load_generator import TrafficGenerator
+from utils.date_time_utils import get_utc_now
+
+test_messages = Path("./testdata/messages.txt").read_bytes().splitlines()
+
+# The dictionary was made from test_messages, so how much they shrink is a best case; these it has not seen
+held_out_messages = [payload for _, payload in TrafficGenerator(devices=50, seed=1).messages(500)]
+
+
+@pytest.mark.parametrize("codec", [CODEC_ZLIB, CODEC_ZSTD])
+def test_round_trip(codec):
+    if codec == CODEC_ZSTD and zstandard is None:
+        pytest.skip("zstandard is not installed")
+    stored = [compress_message(x, codec) for x in test_messages]
+    assert [decompress_message(x) for x in stored] == test_messages
+    assert stored_format(stored[0]) == (codec, 1)
+    # About 4.7 times smaller with zlib
+    stored = [compress_message(x, codec) for x in held_out_messages]
+    assert [decompress_message(x) for x in stored] == held_out_messages
+    assert sum(len(x) for x in stored) * 4 < sum(len(x) for x in held_out_messages)
+
+
+@pytest.mark.parametrize("codec", [CODEC_ZLIB, CODEC_ZSTD])
+def test_recompress_level(codec):
+    if codec == CODEC_ZSTD and zstandard is None:
+        pytest.skip("zstandard is not installed")
+    live = [compress_message(x, codec) for x in held_out_messages]
+    best = [compress_message(x, codec, level=RECOMPRESS_LEVEL) for x in held_out_messages]
+    assert [decompress_message(x) for x in best] == held_out_messages
+    assert sum(len(x) for x in best) < sum(len(x) for x in live)
+
+
+def test_uncompressed_values_are_read_as_they_are():
+    assert decompress_message(test_messages[0]) == test_messages[0]
+    assert stored_format(test_messages[0]) is None
+    assert compress_message(test_messages[0], CODEC_NONE) == test_messages[0]
+
+
+def test_uncompressed_with_leading_bytes(caplog):
+    # Leading whitespace or a byte order mark is not a codec
+    for value in [b"  " + test_messages[0], b"\xef\xbb\xbf" + test_messages[0], b"\n"]:
+        caplog.clear()
+        with caplog.at_level(logging.WARNING, logger="lora.mqtt"):
+            assert decompress_message(value) == value
+        assert "reading it as not compressed" in caplog.text
+        assert stored_format(value) is None
+    assert decompress_message(b"") == b""
+
+
+def test_column_compresses_and_recompress_migrates():
+    engine = create_engine('sqlite:///:memory:')
+    upgrade_schema(engine)
+    session = sessionmaker(bind=engine)()
+    events = LoraEvent.__table__
+    stored = type_coerce(events.c.raw_message, LargeBinary)
+    try:
+        session.add(Sensor(device_id="CCC0790000EE4ED9", device_name="sky-bar-main-room-temp"))
+        session.add(Supervisory(sensor_id="CCC0790000EE4ED9", counter=1, timestamp=get_utc_now(),
+                                raw_message=test_messages[0]))
+        session.commit()
+        # Rows as they were stored before compression, bypassing the column types
+        plain_events = table('event', *[column(x) for x in ('sensor_id', 'counter', 'type', 'timestamp',
+                                                            'raw_message')])
+        engine.execute(plain_events.insert(),
+                       [{'sensor_id': "CCC0790000EE4ED9", 'counter': i + 2, 'type': 'supervisory',
+                         'timestamp': get_utc_now().timestamp(), 'raw_message': x}
+                        for i, x in enumerate(test_messages[1:10])])
+        values = [bytes(x) for x, in engine.execute(select([stored]).order_by(events.c.id))]
+        assert stored_format(values[0]) is not None
+        assert all(stored_format(x) is None for x in values[1:])
+        # Both kinds read back the same
+        assert [x.raw_message for x in session.query(LoraEvent).order_by(LoraEvent.id)] == test_messages[:10]
+
+        report = recompress_messages(engine, codec=CODEC_ZLIB, batch_size=4)
+        assert report.rows_read == 10
+        assert report.rows_rewritten == 9
+        assert report.bytes_after < report.bytes_before
+        values = [bytes(x) for x, in engine.execute(select([stored]).order_by(events.c.id))]
+        assert all(stored_format(x) == (CODEC_ZLIB, 1) for x in values)
+        assert values[1:] == [compress_message(x, CODEC_ZLIB, level=RECOMPRESS_LEVEL) for x in test_messages[1:10]]
+        session.expire_all()
+        assert [x.raw_message for x in session.query(LoraEvent).order_by(LoraEvent.id)] == test_messages[:10]
+        # Nothing left to do
+        assert recompress_messages(engine, codec=CODEC_ZLIB).rows_rewritten == 0
+    finally:
+        session.close()
@@ -0,0 +1,114 @@
+"""
+Tests for the background recording of connection events
+"""
+import logging
+import threading
+from time import monotonic, sleep
+
+from models.models import ConnectionEvent, ConnectEnum
+from sensors.connection_events import ConnectionEventRecorder, classify
+from sensors.db_streamer import Streamer
+from tests.db_helpers import make_session_factory
+
+
+def test_classify():
+    assert classify("Subscribed to messages for all devices") == ConnectEnum.CONNECTED
+    assert classify("Received CONNACK (0, 0)") == ConnectEnum.CONNECTED
+    assert classify("Connection failed 5 Connection Refused: not authorised.") == ConnectEnum.SOCKET_ERROR
+    assert classify("The connection was lost.") == ConnectEnum.SOCKET_ERROR
+    assert classify("Sending SUBSCRIBE (d0, m1) [(b'+/devices/+/up', 0)]") == ConnectEnum.GENERIC
+
+
+def test_filters_coalesces_and_writes(tmp_path):
+    # The writer thread has its own connection, so this needs a database file
+    _, Session = make_session_factory(tmp_path)
+    recorder = ConnectionEventRecorder(Session, level=logging.DEBUG, coalesce_seconds=3600)
+    recorder.record("Received CONNACK (0, 0)", logging.DEBUG)
+    for _ in range(20):
+        recorder.record("Sending PINGREQ", logging.DEBUG)
+        recorder.record("Received PINGRESP", logging.DEBUG)
+    recorder.record("Received PUBLISH (d0, q0, r0, m0), 'skybar-sensors/devices/x/up', ...  (700 bytes)",
+                    logging.DEBUG)
+    recorder.close()
+
+    session = Session()
+    try:
+        events = session.query(ConnectionEvent).order_by(ConnectionEvent.id).all()
+        assert [x.kind for x in events] == [ConnectEnum.CONNECTED] + [ConnectEnum.GENERIC] * 3
+        counts = sorted(x.desc.split(" in ")[0] for x in events[1:])
+        assert counts == ["Received PINGRESP x20", "Received PUBLISH x1", "Sending PINGREQ x20"]
+    finally:
+        session.close()
+
+
+def test_counts_written_on_timer(tmp_path):
+    _, Session = make_session_factory(tmp_path)
+    recorder = ConnectionEventRecorder(Session, level=logging.DEBUG, coalesce_seconds=0.05,
+                                       max_latency_seconds=0.05)
+    for _ in range(5):
+        recorder.record("Sending PINGREQ", logging.DEBUG)
+    # Nothing else is recorded, the counts go out on the timer of the writer
+    session = Session()
+    try:
+        deadline = monotonic() + 5
+        while session.query(ConnectionEvent).count() == 0 and monotonic() < deadline:
+            sleep(0.02)
+            session.rollback()
+        assert [x.desc.split(" in ")[0] for x in session.query(ConnectionEvent)] == ["Sending PINGREQ x5"]
+    finally:
+        session.close()
+    recorder.close()
+
+
+def test_level_filter(tmp_path):
+    _, Session = make_session_factory(tmp_path)
+    recorder = ConnectionEventRecorder(Session, level=logging.INFO)
+    recorder.record("Sending PINGREQ", logging.DEBUG)
+    recorder.record("Disconnected status The connection was lost.", logging.WARNING)
+    recorder.close()
+
+    session = Session()
+    try:
+        events = session.query(ConnectionEvent).all()
+        assert len(events) == 1
+        assert events[0].kind == ConnectEnum.SOCKET_ERROR
+    finally:
+        session.close()
+
+
+def test_record_after_close(tmp_path):
+    _, Session = make_session_factory(tmp_path)
+    recorder = ConnectionEventRecorder(Session, level=logging.INFO)
+    recorder.close()
+    recorder.record("Connection failed 5 Connection Refused: not authorised.", logging.ERROR)
+    assert recorder.dropped == 1
+
+    session = Session()
+    try:
+        assert session.query(ConnectionEvent).count() == 0
+    finally:
+        session.close()
+
+
+def test_streamer_does_not_wait_for_database(tmp_path):
+    _, Session = make_session_factory(tmp_path)
+    streamer = Streamer(Session)
+    released = threading.Event()
+    write = streamer.connection_events.writer.flush_function
+
+    def slow_write(events):
+        released.wait(5)
+        write(events)
+
+    # Hold up the writer thread as a slow database would
+    streamer.connection_events.writer.flush_function = slow_write
+    for _ in range(100):
+        streamer.on_connection_event("Subscribed to messages for all devices", logging.INFO)
+    released.set()
+    streamer.close()
+
+    session = Session()
+    try:
+        assert session.query(ConnectionEvent).count() == 100
+    finally:
+        session.close()
@@ -0,0 +1,137 @@
+"""
+Tests for running several connections from one process
+"""
+import asyncio
+import configparser
+import socket
+
+import pytest
+
+from sensors import async_comms
+from sensors.async_comms import AsyncSensorListener
+from sensors.connections import ConnectionSettings, SubscriptionManager, read_connections
+from sensors.mqtt_comms import DEFAULT_CLIENT_ID
+
+INI = """
+[DEFAULT]
+sslport = 8883
+keep_alive_seconds = 300
+
+[ttn-explore.mqtt.connection]
+username = skybar-sensors
+password = key-one
+region = us-west
+
+[ttn-explore.mqtt.connection.warehouse]
+username = warehouse-sensors
+password = key-two
+region = eu
+keep_alive_seconds = 60
+
+[ttn-explore.mqtt.connection.lab]
+username = lab-sensors
+password = key-three
+region = us-west
+client_id = lab-feed
+
+[ttn-explore.mqtt.connection.local]
+username = local-sensors
+password = key-four
+hostname = broker.example.com
+
+[something.else]
+username = not-a-connection
+"""
+
+
+def make_config(text: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read_string(text)
+    return config
+
+
+def test_read_connections():
+    connections = read_connections(make_config(INI))
+    assert [x.name for x in connections] == ["default", "warehouse", "lab", "local"]
+    default, warehouse, lab, local = connections
+    assert default == ConnectionSettings(name="default", username="skybar-sensors", password="key-one",
+                                         hostname="us-west.thethings.network", port=8883, keep_alive_seconds=300,
+                                         client_id=DEFAULT_CLIENT_ID)
+    assert warehouse.hostname == "eu.thethings.network"
+    assert warehouse.keep_alive_seconds == 60
+    assert warehouse.client_id == f"{DEFAULT_CLIENT_ID}-warehouse"
+    assert lab.client_id == "lab-feed"
+    # A host name of its own, with no region
+    assert local.hostname == "broker.example.com"
+
+
+def test_unnamed_connection_first():
+    # Even when a named section comes before it in the file
+    text = INI.replace("[ttn-explore.mqtt.connection]\n", "[ttn-explore.mqtt.connection.first]\n", 1) \
+        .replace("[ttn-explore.mqtt.connection.lab]", "[ttn-explore.mqtt.connection]")
+    connections = read_connections(make_config(text))
+    assert [x.name for x in connections] == ["default", "first", "warehouse", "local"]
+    assert connections[0].client_id == "lab-feed"
+
+
+def test_read_connections_errors():
+    with pytest.raises(ValueError):
+        read_connections(make_config("[something.else]\nusername = x\n"))
+    with pytest.raises(ValueError):
+        read_connections(make_config(INI.replace("client_id = lab-feed", f"client_id = {DEFAULT_CLIENT_ID}")))
+
+
+class RecordingListener(AsyncSensorListener):
+
+    def __init__(self):
+        self.events = []
+        self.closed = 0
+
+    async def on_message(self, topic: str, payload: bytes):
+        pass
+
+    def on_disconnect(self, reason: str):
+        pass
+
+    def on_connection_event(self, reason: str, level: int = 0) -> None:
+        self.events.append(reason)
+
+    async def close(self) -> None:
+        self.closed += 1
+
+
+def unused_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def test_manager_backoff(monkeypatch):
+    monkeypatch.setattr(async_comms, "RECONNECT_SECONDS", 0.05)
+    port = unused_port()
+    connections = [ConnectionSettings(name=name, username=name, password="key", hostname="localhost", port=port,
+                                      keep_alive_seconds=60, client_id=f"test-{name}")
+                   for name in ("one", "two")]
+    listener = RecordingListener()
+
+    async def run():
+        manager = SubscriptionManager(connections, listener, cert_path=None, health_log_seconds=0)
+        task = asyncio.create_task(manager.run())
+        await asyncio.sleep(0.5)
+        health = manager.health()
+        manager.log_health()
+        manager.stop()
+        await asyncio.wait_for(task, 5)
+        return health
+
+    health = asyncio.run(run())
+    for name in ("one", "two"):
+        assert health[name].state == "stopped"
+        assert health[name].connects == 0
+        assert health[name].last_error
+        # Waited longer each time
+        assert health[name].retry_seconds >= 0.2
+    # The shared listener is closed once, and knows which connection an event came from
+    assert listener.closed == 1
+    assert any(x.startswith("Connection failed") and x.endswith("(one)") for x in listener.events)
+    assert any(x.endswith("(two)") for x in listener.events)
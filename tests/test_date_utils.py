@@ -3,7 +3,10 @@ Tests for the datetime parsing
 """
 from datetime import timezone
 
-from utils.date_time_utils import parseiso8601, formatiso8601
+import pytest
+from dateutil import parser as dp
+
+from utils.date_time_utils import parseiso8601, formatiso8601, parseiso8601_ns, parseiso8601_array
 
 
 def test_iso_to_datetime():
@@ -11,4 +14,32 @@ def test_iso_to_datetime():
     tstamp_value = parseiso8601(timestamp_str)
     assert formatiso8601(tstamp_value, timespec='microseconds') == timestamp_str
     assert tstamp_value.tzinfo is not None
-    assert tstamp_value.tzinfo == timezone.utc
\ No newline at end of file
+    assert tstamp_value.tzinfo == timezone.utc
+
+
+def test_ttn_nanoseconds():
+    timestamp_str = "2020-10-04T18:57:51.159517049Z"
+    tstamp_value, nanoseconds = parseiso8601_ns(timestamp_str)
+    assert formatiso8601(tstamp_value, timespec='microseconds') == "2020-10-04T18:57:51.159517Z"
+    assert nanoseconds == 49
+    assert tstamp_value.tzinfo == timezone.utc
+    # The fast path has to agree with dateutil
+    assert parseiso8601(timestamp_str) == dp.parse(timestamp_str)
+    assert parseiso8601("2020-10-24T00:33:17.8450756Z") == dp.parse("2020-10-24T00:33:17.8450756Z")
+    assert parseiso8601("2020-10-24T00:33:17Z") == dp.parse("2020-10-24T00:33:17Z")
+
+
+def test_other_formats_fall_back():
+    tstamp_value, nanoseconds = parseiso8601_ns("2020-10-04T14:57:51.5-04:00")
+    assert formatiso8601(tstamp_value) == "2020-10-04T18:57:51.500Z"
+    assert nanoseconds == 0
+
+
+def test_parse_array():
+    np = pytest.importorskip("numpy")
+    values = parseiso8601_array(["2020-10-04T18:57:51.159517049Z", "2020-10-24T00:33:17Z"])
+    assert values.dtype == np.dtype('datetime64[ns]')
+    assert str(values[0]) == "2020-10-04T18:57:51.159517049"
+    mixed = parseiso8601_array(["2020-10-04T14:57:51.5-04:00", "2020-10-24T00:33:17Z"])
+    assert str(mixed[0]) == "2020-10-04T18:57:51.500000000"
+    assert str(mixed[1]) == "2020-10-24T00:33:17.000000000"
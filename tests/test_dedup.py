@@ -0,0 +1,101 @@
+"""
+Tests for the suppression of the copies of confirmed uplinks
+"""
+from pathlib import Path
+
+from sqlalchemy import func
+
+from models.models import LoraEvent, Sensor
+from sensors.db_streamer import Streamer
+from sensors.dedup import DedupWindow
+from tests.db_helpers import make_session_factory
+
+TOPIC = "skybar-sensors/devices/sky-bar-chill-room/up"
+# The test data has 309 messages, 79 of them copies of another with the same counter
+EXPECTED_UNIQUE_COUNT = 230
+EXPECTED_COPY_COUNT = 79
+
+
+def feed_test_data(streamer: Streamer):
+    with open(Path("./testdata/messages.txt"), "r") as reader:
+        for msg in reader:
+            streamer.on_message(TOPIC, msg.encode("utf-8"))
+    streamer.close()
+
+
+def test_window_is_bounded_and_lru():
+    window = DedupWindow(per_device=2, max_devices=2)
+    assert window.check("a", 1, "a1") is None
+    assert window.check("a", 2, "a2") is None
+    # Seeing 1 again makes 2 the least recently used
+    assert window.check("a", 1, "copy") == "a1"
+    assert window.check("a", 3, "a3") is None
+    assert window.check("a", 2, "a2 again") is None
+    assert window.check("a", 1, "copy") is None
+    assert window.duplicates == 1
+    window.check("b", 1, "b1")
+    window.check("c", 1, "c1")
+    # a was the least recently used device
+    assert window.check("a", 1, "a1") is None
+    assert window.check("c", 1, "copy") == "c1"
+
+
+def check_stored(Session, expected_copies: int, expected_990_copies: int = 5):
+    session = Session()
+    try:
+        assert session.query(LoraEvent).count() == EXPECTED_UNIQUE_COUNT
+        assert session.query(Sensor).count() == 3
+        assert session.query(func.sum(LoraEvent.retry_count)).scalar() == expected_copies
+        # Sent six times in all
+        event = session.query(LoraEvent).filter_by(sensor_id="CCC0790000EE4ED9", counter=990).one()
+        assert event.retry_count == expected_990_copies
+        assert event.best_rssi is not None and event.best_snr is not None
+    finally:
+        session.close()
+
+
+def test_copies_folded_as_they_are_written(tmp_path):
+    _, Session = make_session_factory(tmp_path, upgrade=True)
+    feed_test_data(Streamer(Session, dedup_window=32))
+    check_stored(Session, EXPECTED_COPY_COUNT)
+
+
+def test_copies_folded_in_write_behind_mode(tmp_path):
+    _, Session = make_session_factory(tmp_path, upgrade=True)
+    feed_test_data(Streamer(Session, batch_size=50, max_latency_seconds=0.5, dedup_window=32))
+    check_stored(Session, EXPECTED_COPY_COUNT)
+
+
+def test_copies_caught_after_restart(tmp_path):
+    _, Session = make_session_factory(tmp_path, upgrade=True)
+    feed_test_data(Streamer(Session, dedup_window=32))
+    # A new streamer has an empty window, the unique index catches everything again
+    feed_test_data(Streamer(Session, batch_size=50, dedup_window=32))
+    check_stored(Session, EXPECTED_UNIQUE_COUNT + 2 * EXPECTED_COPY_COUNT, expected_990_copies=11)
+
+
+def test_copy_stored_when_first_write_failed(tmp_path):
+    _, Session = make_session_factory(tmp_path, upgrade=True)
+    streamer = Streamer(Session, dedup_window=32)
+    write = streamer._write
+    calls = []
+
+    def failing_write(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("database is gone")
+        return write(*args, **kwargs)
+
+    streamer._write = failing_write
+    with open(Path("./testdata/messages.txt"), "rb") as reader:
+        copies = [x for x in reader if b'"hardware_serial":"CCC0790000EE4ED9","port":2,"counter":990,' in x]
+    for msg in copies:
+        streamer.on_message(TOPIC, msg)
+    streamer.close()
+    # The first copy was lost, the second is stored in its place and the others counted into it
+    session = Session()
+    try:
+        event = session.query(LoraEvent).filter_by(sensor_id="CCC0790000EE4ED9", counter=990).one()
+        assert event.retry_count == len(copies) - 2
+    finally:
+        session.close()
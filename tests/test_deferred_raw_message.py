@@ -0,0 +1,55 @@
+"""
+Checks that the raw messages are only read from the database when they are asked for
+"""
+from pathlib import Path
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, undefer
+
+from models.migrations import upgrade_schema
+from models.models import LoraEvent, TempHumidityMeasurement
+from sensors.db_streamer import Streamer
+
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+
+def load_test_data():
+    engine = create_engine('sqlite:///:memory:')
+    upgrade_schema(engine)
+    Session = sessionmaker(bind=engine)
+    streamer = Streamer(Session)
+    for msg in Path("./testdata/messages.txt").read_bytes().splitlines()[:20]:
+        streamer.on_message(topic, msg)
+    streamer.close()
+    statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    return Session, statements
+
+
+def test_queries_leave_out_raw_message():
+    Session, statements = load_test_data()
+    session = Session()
+    try:
+        measurements = session.query(TempHumidityMeasurement).all()
+        assert measurements
+        assert all(x.temp_c is not None for x in measurements)
+        assert len(statements) == 1
+        assert "raw_message" not in statements[0]
+        # Asking for it loads it
+        assert measurements[0].raw_message.startswith(b'{')
+        assert "raw_message" in statements[-1]
+    finally:
+        session.close()
+
+
+def test_undefer_loads_raw_message_up_front():
+    Session, statements = load_test_data()
+    session = Session()
+    try:
+        events = session.query(LoraEvent).options(undefer(LoraEvent.raw_message)).all()
+        assert all(x.raw_message.startswith(b'{') for x in events)
+        assert len(statements) == 1
+        assert "raw_message" in statements[0]
+    finally:
+        session.close()
@@ -0,0 +1,161 @@
+"""
+Tests for finding gaps in the event counters
+"""
+from datetime import timedelta
+from pathlib import Path
+
+from models.models import LoraEvent, Sensor, GapCheckpoint, TempHumidityMeasurement
+from sensors.db_streamer import Streamer
+from sensors.gap_analysis import find_gaps, update_checkpoints, SUPERVISORY_TYPE
+from tests.db_helpers import make_session_factory
+
+
+def load_test_data():
+    test_data_path = Path("./testdata/messages.txt")
+    topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+    engine, Session = make_session_factory()
+    streamer = Streamer(Session)
+    with open(test_data_path, "r") as reader:
+        for msg in reader:
+            streamer.on_message(topic, msg.encode("utf-8"))
+    return engine, Session
+
+
+def expected_gaps(Session, exclude_supervisory=False):
+    # The way th_event_validity_main used to do it, every event loaded into a list
+    session = Session()
+    try:
+        result = {}
+        for sensor in session.query(Sensor).order_by(Sensor.device_id):
+            events = sensor.events.order_by(LoraEvent.counter, LoraEvent.id).all()
+            gaps = []
+            for prev, event in zip(events, events[1:]):
+                if event.counter > prev.counter + 1:
+                    if not exclude_supervisory or SUPERVISORY_TYPE not in (prev.type, event.type):
+                        gaps.append((prev.counter, event.counter))
+            result[sensor.device_id] = gaps
+        return result
+    finally:
+        session.close()
+
+
+def test_window_and_streaming_agree():
+    engine, Session = load_test_data()
+    for exclude_supervisory in [False, True]:
+        expected = expected_gaps(Session, exclude_supervisory)
+        by_window = find_gaps(engine, exclude_supervisory=exclude_supervisory)
+        by_streaming = find_gaps(engine, exclude_supervisory=exclude_supervisory, use_window_functions=False)
+        assert by_window == by_streaming
+        assert len(by_window) == 3
+        for report in by_window:
+            assert [(x.prev_counter, x.counter) for x in report.gaps] == expected[report.sensor_id]
+    # There are gaps in the test data, and some are next to Supervisory messages
+    assert sum(len(x.gaps) for x in find_gaps(engine)) > \
+           sum(len(x.gaps) for x in find_gaps(engine, exclude_supervisory=True)) > 0
+
+
+def test_report_summary_and_runs():
+    engine, Session = load_test_data()
+    report = find_gaps(engine, sensor_ids=["CCC0790000EE4ED9"])[0]
+    session = Session()
+    try:
+        events = session.query(LoraEvent).filter(LoraEvent.sensor_id == "CCC0790000EE4ED9").all()
+        assert report.event_count == len(events)
+        assert report.first_counter == min(x.counter for x in events)
+        assert report.last_counter == max(x.counter for x in events)
+    finally:
+        session.close()
+    run_start = report.first_counter
+    for gap in report.gaps:
+        assert gap.run_length == gap.prev_counter - run_start
+        assert gap.missing == gap.counter - gap.prev_counter - 1
+        run_start = gap.counter
+    assert report.missing_total == sum(x.missing for x in report.gaps)
+
+
+def test_incremental_same_as_full():
+    engine, Session = load_test_data()
+    full = {x.sensor_id: x for x in find_gaps(engine)}
+    session = Session()
+    try:
+        incremental = {x.sensor_id: x for x in update_checkpoints(session)}
+        for sensor_id, report in full.items():
+            assert incremental[sensor_id].gaps == report.gaps
+            assert incremental[sensor_id].event_count == report.event_count
+            assert incremental[sensor_id].last_counter == report.last_counter
+        # Nothing new, nothing to read and no new gaps
+        again = update_checkpoints(session)
+        assert [x.gaps for x in again] == [[], [], []]
+        checkpoint = session.query(GapCheckpoint).get(("CCC0790000EE4ED9", False))
+        assert checkpoint.gap_count == len(full["CCC0790000EE4ED9"].gaps)
+        assert checkpoint.missing_total == full["CCC0790000EE4ED9"].missing_total
+    finally:
+        session.close()
+
+
+def test_incremental_picks_up_new_events():
+    engine, Session = load_test_data()
+    session = Session()
+    try:
+        update_checkpoints(session, sensor_ids=["CCC0790000EE4ED9"])
+        checkpoint = session.query(GapCheckpoint).get(("CCC0790000EE4ED9", False))
+        last_counter = checkpoint.last_counter
+        event_count = checkpoint.event_count
+        timestamp = checkpoint.last_timestamp
+        for counter in [last_counter + 1, last_counter + 5]:
+            session.add(TempHumidityMeasurement(sensor_id="CCC0790000EE4ED9", counter=counter,
+                                                timestamp=timestamp, raw_message=b"{}",
+                                                temp_c=20.0, humidity_percent=40.0))
+        session.commit()
+        report = update_checkpoints(session, sensor_ids=["CCC0790000EE4ED9"])[0]
+        assert [(x.prev_counter, x.counter, x.missing) for x in report.gaps] == \
+               [(last_counter + 1, last_counter + 5, 3)]
+        assert report.event_count == event_count + 2
+        assert report.last_counter == last_counter + 5
+        # One that arrived late is skipped, and not counted
+        session.add(TempHumidityMeasurement(sensor_id="CCC0790000EE4ED9", counter=last_counter + 3,
+                                            timestamp=timestamp, raw_message=b"{}",
+                                            temp_c=20.0, humidity_percent=40.0))
+        session.commit()
+        report = update_checkpoints(session, sensor_ids=["CCC0790000EE4ED9"])[0]
+        assert report.gaps == []
+        assert report.event_count == event_count + 2
+        assert report.last_counter == last_counter + 5
+    finally:
+        session.close()
+
+
+def test_incremental_reset_in_one_batch():
+    engine, Session = load_test_data()
+    session = Session()
+    try:
+        update_checkpoints(session, sensor_ids=["CCC0790000EE4ED9"])
+        checkpoint = session.query(GapCheckpoint).get(("CCC0790000EE4ED9", False))
+        last_counter = checkpoint.last_counter
+        event_count = checkpoint.event_count
+        start = checkpoint.last_timestamp
+        # Three more, then the device resets and counts from 0 again
+        counters = [last_counter + 1, last_counter + 2, last_counter + 3, 0, 1, 2]
+        for minutes, counter in enumerate(counters, 1):
+            session.add(TempHumidityMeasurement(sensor_id="CCC0790000EE4ED9", counter=counter,
+                                                timestamp=start + timedelta(minutes=minutes), raw_message=b"{}",
+                                                temp_c=20.0, humidity_percent=40.0))
+        session.commit()
+        report = update_checkpoints(session, sensor_ids=["CCC0790000EE4ED9"])[0]
+        assert report.gaps == []
+        assert report.event_count == event_count + 6
+        assert report.last_counter == 2
+        assert report.last_timestamp == start + timedelta(minutes=6)
+
+        # The next run carries on from after the reset
+        session.add(TempHumidityMeasurement(sensor_id="CCC0790000EE4ED9", counter=3,
+                                            timestamp=start + timedelta(minutes=7), raw_message=b"{}",
+                                            temp_c=20.0, humidity_percent=40.0))
+        session.commit()
+        report = update_checkpoints(session, sensor_ids=["CCC0790000EE4ED9"])[0]
+        assert report.gaps == []
+        assert report.event_count == event_count + 7
+        checkpoint = session.query(GapCheckpoint).get(("CCC0790000EE4ED9", False))
+        assert (checkpoint.last_counter, checkpoint.run_start_counter) == (3, 0)
+    finally:
+        session.close()
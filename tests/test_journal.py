@@ -0,0 +1,159 @@
+"""
+Tests for the message journal and storing messages through it
+"""
+from pathlib import Path
+
+from sensors import db_streamer
+from sensors.db_streamer import Streamer
+from sensors.journal import MessageJournal, JournalApplier, JournalPosition, HEADER, CHECKPOINT_FILE
+from tests.db_helpers import make_session_factory, count_rows
+
+test_data_path = Path("./testdata/messages.txt")
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+
+def test_append_and_read(tmp_path):
+    journal = MessageJournal(tmp_path / "journal", segment_size=256)
+    messages = [f"message {x}".encode() * (x % 7 + 1) for x in range(50)]
+    for message in messages:
+        journal.append(message)
+    assert journal.end.segment > 0
+    read, after = journal.read(journal.checkpoint, 1000)
+    assert read == messages
+    assert after == journal.end
+
+    part, after = journal.read(journal.checkpoint, 20)
+    assert part == messages[:20]
+    journal.commit(after)
+    assert len(list((tmp_path / "journal").glob("*.journal"))) == journal.end.segment - after.segment + 1
+    journal.close()
+
+    # Only what was not applied is read again
+    journal = MessageJournal(tmp_path / "journal", segment_size=256)
+    assert journal.checkpoint == after
+    read, _ = journal.read(journal.checkpoint, 1000)
+    assert read == messages[20:]
+    journal.append(b"one more")
+    read, _ = journal.read(journal.checkpoint, 1000)
+    assert read == messages[20:] + [b"one more"]
+    journal.close()
+
+
+def test_partly_written_message(tmp_path):
+    journal = MessageJournal(tmp_path / "journal")
+    journal.append(b"first")
+    position = journal.append(b"second")
+    journal.append(b"third")
+    journal.close()
+    # Damage the last message, as if the program stopped while writing it
+    path = tmp_path / "journal" / "00000000.journal"
+    data = bytearray(path.read_bytes())
+    data[position.offset + HEADER.size] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+    journal = MessageJournal(tmp_path / "journal")
+    assert journal.end == position
+    journal.append(b"fourth")
+    read, _ = journal.read(JournalPosition(0, 0), 10)
+    assert read == [b"first", b"second", b"fourth"]
+    journal.close()
+
+
+def test_applier(tmp_path):
+    journal = MessageJournal(tmp_path / "journal")
+    applied = []
+    applier = JournalApplier(journal, applied.extend, batch_size=3)
+    for x in range(10):
+        journal.append(str(x).encode())
+    assert applier.flush(timeout=5)
+    assert applied == [str(x).encode() for x in range(10)]
+    assert journal.checkpoint == journal.end
+    applier.close(timeout=5)
+    journal.close()
+
+
+def make_engine(tmp_path):
+    # A short busy timeout so a locked database fails quickly
+    return make_session_factory(tmp_path, connect_args={'timeout': 0.1})
+
+
+def test_streamer_with_journal(tmp_path):
+    engine, Session = make_engine(tmp_path)
+    streamer = Streamer(Session, journal_folder=tmp_path / "journal")
+    with open(test_data_path, "rb") as reader:
+        for line in reader:
+            streamer.on_message(topic, line)
+    streamer.flush()
+    assert count_rows(Session) == 309
+    streamer.close()
+
+
+def test_database_not_available(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_streamer, "JOURNAL_RETRY_SECONDS", 0.1)
+    engine, Session = make_engine(tmp_path)
+    streamer = Streamer(Session, batch_size=50, journal_folder=tmp_path / "journal", dedup_window=32)
+    lines = test_data_path.read_bytes().splitlines()
+    lock = engine.raw_connection()
+    lock.execute("BEGIN EXCLUSIVE")
+    try:
+        for line in lines[:100]:
+            streamer.on_message(topic, line)
+        assert not streamer.applier.flush(timeout=0.5)
+    finally:
+        lock.rollback()
+        lock.close()
+    for line in lines[100:]:
+        streamer.on_message(topic, line)
+    streamer.flush()
+    streamer.close()
+    # As many as without the journal
+    _, expected_Session = make_session_factory()
+    expected = Streamer(expected_Session, dedup_window=32)
+    for line in lines:
+        expected.on_message(topic, line)
+    assert count_rows(Session) == count_rows(expected_Session)
+
+
+def test_applied_after_restart(tmp_path):
+    engine, Session = make_engine(tmp_path)
+    streamer = Streamer(Session, journal_folder=tmp_path / "journal")
+    lock = engine.raw_connection()
+    lock.execute("BEGIN EXCLUSIVE")
+    try:
+        with open(test_data_path, "rb") as reader:
+            for line in reader:
+                streamer.on_message(topic, line)
+        streamer.close()
+    finally:
+        lock.rollback()
+        lock.close()
+    assert count_rows(Session) == 0
+
+    streamer = Streamer(Session, journal_folder=tmp_path / "journal")
+    streamer.flush()
+    assert count_rows(Session) == 309
+    streamer.close()
+    assert MessageJournal(tmp_path / "journal").pending_bytes() == 0
+
+
+def test_stale_checkpoint(tmp_path):
+    for dedup_window in (0, 32):
+        folder = tmp_path / f"dedup-{dedup_window}"
+        folder.mkdir()
+        engine, Session = make_engine(folder)
+        streamer = Streamer(Session, journal_folder=folder / "journal", dedup_window=dedup_window)
+        with open(test_data_path, "rb") as reader:
+            for line in reader:
+                streamer.on_message(topic, line)
+        streamer.close()
+        events = count_rows(Session)
+        retries = engine.execute("SELECT SUM(retry_count) FROM event").scalar()
+        # As if it crashed after the events were committed but before the checkpoint file was written
+        (folder / "journal" / CHECKPOINT_FILE).write_text('{"segment": 0, "offset": 0}')
+
+        streamer = Streamer(Session, journal_folder=folder / "journal", dedup_window=dedup_window)
+        streamer.flush()
+        streamer.close()
+        assert count_rows(Session) == events
+        assert engine.execute("SELECT SUM(retry_count) FROM event").scalar() == retries
+        assert MessageJournal(folder / "journal").pending_bytes() == 0
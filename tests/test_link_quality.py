@@ -0,0 +1,96 @@
+"""
+Tests for the capture of the gateways and radio metadata of each message
+"""
+import json
+from pathlib import Path
+
+import pytest
+from sqlalchemy import func
+
+from models.models import Gateway, Reception, LoraEvent, Modulation
+from sensors.db_streamer import Streamer
+from sensors.link_quality import encode_data_rate, encode_modulation, rssi_trend, rssi_trend_query
+from tests.db_helpers import make_engine, make_session_factory, query_plan
+
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+
+def test_encoding():
+    assert encode_data_rate("SF7BW125") == (7, 125)
+    assert encode_data_rate("SF12BW500") == (12, 500)
+    assert encode_data_rate("50000") == (None, None)
+    assert encode_data_rate(None) == (None, None)
+    assert encode_modulation("LORA") == Modulation.LORA
+    assert encode_modulation("FSK") == Modulation.FSK
+    assert encode_modulation(None) == Modulation.UNKNOWN
+
+
+def store_test_data(tmp_path, **kwargs):
+    engine, Session = make_session_factory(tmp_path, upgrade=True)
+    streamer = Streamer(Session, capture_receptions=True, **kwargs)
+    for msg in Path("./testdata/messages.txt").read_bytes().splitlines():
+        streamer.on_message(topic, msg)
+    streamer.close()
+    return engine, Session
+
+
+def test_receptions_stored(tmp_path):
+    engine, Session = store_test_data(tmp_path, batch_size=50)
+    session = Session()
+    try:
+        gateways = session.query(Gateway).all()
+        assert len(gateways) >= 1
+        event_count = session.query(LoraEvent).count()
+        # Every event was received by at least one gateway
+        assert session.query(func.count(func.distinct(Reception.event_id))).scalar() == event_count
+        reception = session.query(Reception).order_by(Reception.event_id).first()
+        assert reception.spreading_factor == 7
+        assert reception.bandwidth_khz == 125
+        assert reception.modulation == Modulation.LORA
+        assert reception.frequency_khz == 905100
+        assert reception.airtime_us == 56576
+        assert reception.rssi == -13
+        assert reception.snr == 10.25
+    finally:
+        session.close()
+
+    rows = rssi_trend(engine, resolution=24 * 60 * 60)
+    assert sum(x.count for x in rows) == event_count
+    for row in rows:
+        assert row.rssi_min <= row.rssi_mean <= row.rssi_max
+
+
+def test_receptions_with_dedup(tmp_path):
+    # Copies are folded before they are stored, so they add no receptions
+    engine, Session = store_test_data(tmp_path, dedup_window=32)
+    session = Session()
+    try:
+        assert session.query(Reception).count() == session.query(LoraEvent).count()
+    finally:
+        session.close()
+
+
+@pytest.mark.parametrize("batch_size", [0, 10])
+def test_gateway_without_id(tmp_path, batch_size):
+    # A gateway with no gtw_id can't be stored, the message and its other receptions still are
+    engine, Session = make_session_factory(tmp_path, upgrade=True)
+    streamer = Streamer(Session, capture_receptions=True, batch_size=batch_size)
+    for line in Path("./testdata/messages.txt").read_bytes().splitlines()[:2]:
+        msg = json.loads(line)
+        gateways = msg['metadata']['gateways']
+        gateways.append({k: v for k, v in gateways[0].items() if k != 'gtw_id'})
+        streamer.on_message(topic, json.dumps(msg).encode())
+    streamer.close()
+    session = Session()
+    try:
+        assert session.query(LoraEvent).count() == 2
+        assert session.query(Reception).count() == 2
+        assert [x.gtw_id for x in session.query(Gateway)] == ["eui-58a0cbfffe802461"]
+    finally:
+        session.close()
+
+
+def test_trend_query_uses_index():
+    engine = make_engine(upgrade=True)
+    plan = query_plan(engine, rssi_trend_query(3600, sensor_ids=["CCC0790000EE4ED9"]))
+    assert "ix_reception_sensor_gateway_timestamp" in plan, plan
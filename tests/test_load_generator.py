@@ -0,0 +1,69 @@
+"""
+Tests for the synthetic traffic used to benchmark the feed
+"""
+from models.models import LinkQ, Supervisory, TempHumidityMeasurement
+from sensors.db_streamer import Streamer, parse_message
+from sensors.load_generator import TrafficGenerator, LocalBroker, run_load
+from sensors.mqtt_comms import MqttComms
+from sensors.uplink_decoder import decode_uplink
+from tests.db_helpers import make_session_factory, count_rows
+
+
+def test_messages():
+    messages = list(TrafficGenerator(devices=20, seed=3).messages(500))
+    assert len(messages) == 500
+    assert messages == list(TrafficGenerator(devices=20, seed=3).messages(500))
+    records = [parse_message(x) for _, x in messages]
+    assert all(x is not None for x in records)
+    assert {TempHumidityMeasurement, Supervisory} <= {x.event_class for x in records} <= \
+           {TempHumidityMeasurement, Supervisory, LinkQ}
+    assert len({x.device_id for x in records}) == 20
+    uplinks = [decode_uplink(x) for _, x in messages]
+    retries = [x for x in uplinks if x.is_retry]
+    assert retries
+    # A copy follows the message it is a copy of
+    for previous, uplink in zip(uplinks, uplinks[1:]):
+        if uplink.is_retry:
+            assert (previous.hardware_serial, previous.counter) == (uplink.hardware_serial, uplink.counter)
+    for topic, message in messages[:10]:
+        assert topic == f"load-test/devices/{decode_uplink(message).dev_id}/up"
+
+
+def test_payload_fields_match_payload():
+    with_fields = list(TrafficGenerator(devices=5, seed=1).messages(100))
+    without_fields = list(TrafficGenerator(devices=5, seed=1, payload_fields=False).messages(100))
+    for (_, a), (_, b) in zip(with_fields, without_fields):
+        assert b"payload_fields" not in b
+        record_a, record_b = parse_message(a), parse_message(b)
+        assert (record_a.event_class, record_a.temp_c, record_a.humidity_percent) == \
+               (record_b.event_class, record_b.temp_c, record_b.humidity_percent)
+
+
+def make_streamer(tmp_path):
+    # A file, the broker hands the messages over on its own thread
+    _, Session = make_session_factory(tmp_path)
+    return Streamer(Session), Session
+
+
+def test_run_load_direct(tmp_path):
+    streamer, Session = make_streamer(tmp_path)
+    messages = list(TrafficGenerator(devices=10).messages(200))
+    report = run_load(streamer, messages)
+    assert report.messages == 200
+    assert 0 < report.latency_p50 <= report.latency_p99 <= report.latency_max
+    assert report.messages_per_second > 0
+    assert count_rows(Session) == 200
+
+
+def test_run_load_through_broker(tmp_path):
+    streamer, Session = make_streamer(tmp_path)
+    comms = MqttComms(cert_path=None, username="load", password="load", hostname="localhost", port=0,
+                      msg_listener=streamer)
+    broker = LocalBroker(comms)
+    broker.connect()
+    assert broker.subscriptions == ['+/devices/+/up']
+    messages = list(TrafficGenerator(devices=10).messages(200))
+    report = run_load(streamer, messages, rate=2000, broker=broker)
+    assert report.messages == 200
+    assert report.seconds >= 0.1
+    assert count_rows(Session) == 200
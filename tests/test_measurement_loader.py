@@ -0,0 +1,51 @@
+"""
+Tests for loading measurements into pandas
+"""
+from pathlib import Path
+
+import pytest
+
+from models.models import TempHumidityMeasurement
+from sensors.db_streamer import Streamer
+from tests.db_helpers import make_session_factory
+from utils.date_time_utils import parseiso8601
+
+pd = pytest.importorskip("pandas")
+from sensors.measurement_loader import load_measurements  # noqa: E402
+
+
+def test_load_measurements():
+    test_data_path = Path("./testdata/messages.txt")
+    topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+    engine, Session = make_session_factory()
+    streamer = Streamer(Session)
+    with open(test_data_path, "r") as reader:
+        for msg in reader:
+            streamer.on_message(topic, msg.encode("utf-8"))
+
+    df = load_measurements(engine)
+    assert list(df.columns) == ['sensor_id', 'timestamp', 'temp_c', 'humidity_percent']
+    assert len(df) == 256
+    assert str(df['timestamp'].dt.tz) == 'UTC'
+
+    session = Session()
+    try:
+        expected = session.query(TempHumidityMeasurement) \
+            .filter(TempHumidityMeasurement.sensor_id == "CCC0790000EE4ED9") \
+            .order_by(TempHumidityMeasurement.timestamp).all()
+    finally:
+        session.close()
+    one = load_measurements(engine, sensor_ids=["CCC0790000EE4ED9"])
+    assert len(one) == len(expected)
+    assert list(one['temp_c']) == [x.temp_c for x in expected]
+    assert list(one['humidity_percent']) == [x.humidity_percent for x in expected]
+    assert one['timestamp'].iloc[0].to_pydatetime() == expected[0].timestamp
+
+    start = parseiso8601("2020-10-25T00:00:00Z")
+    end = parseiso8601("2020-10-26T00:00:00Z")
+    window = load_measurements(engine, start=start, end=end)
+    assert 0 < len(window) < len(df)
+    assert window['timestamp'].min() >= start and window['timestamp'].max() < end
+
+    empty = load_measurements(engine, sensor_ids=["nothing"])
+    assert len(empty) == 0
@@ -0,0 +1,58 @@
+"""
+Tests for the streaming export of the raw messages
+"""
+import gzip
+from pathlib import Path
+
+from sensors.db_streamer import Streamer
+from sensors.message_export import export_messages, export_query, open_output
+from sensors.uplink_decoder import decode_uplink
+from tests.db_helpers import make_engine, make_session_factory, query_plan, assert_uses_index
+from utils.date_time_utils import parseiso8601
+
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+test_messages = Path("./testdata/messages.txt").read_bytes().splitlines()
+
+
+def store_test_data():
+    engine, Session = make_session_factory(upgrade=True)
+    streamer = Streamer(Session)
+    for msg in test_messages:
+        streamer.on_message(topic, msg)
+    streamer.close()
+    return engine
+
+
+def test_export_all(tmp_path):
+    engine = store_test_data()
+    path = tmp_path / "messages.txt.gz"
+    with open_output(path) as writer:
+        # A small chunk size so several chunks are fetched
+        assert export_messages(engine, writer, chunk_size=7) == len(test_messages)
+    with gzip.open(path, "rb") as reader:
+        exported = reader.read().splitlines()
+    assert sorted(exported) == sorted(test_messages)
+    keys = [(x.hardware_serial, x.counter) for x in map(decode_uplink, exported)]
+    assert keys == sorted(keys)
+
+
+def test_export_filters(tmp_path):
+    engine = store_test_data()
+    start = parseiso8601("2020-10-25T00:00:00Z")
+    path = tmp_path / "messages.txt"
+    with open_output(path) as writer:
+        count = export_messages(engine, writer, sensor_ids=["CCC0790000EE4ED9"], types=["supervisory"], start=start)
+    exported = [decode_uplink(x) for x in path.read_bytes().splitlines()]
+    assert len(exported) == count
+    expected = [x for x in map(decode_uplink, test_messages)
+                if x.hardware_serial == "CCC0790000EE4ED9" and x.payload_fields.msgtype == 1
+                and parseiso8601(x.metadata.time) >= start]
+    assert count == len(expected) > 0
+
+
+def test_export_query_is_in_index_order():
+    engine = make_engine(upgrade=True)
+    for query in [export_query(), export_query(["CCC0790000EE4ED9"])]:
+        plan = query_plan(engine, query)
+        assert_uses_index(plan, "ix_event_sensor_counter")
+        assert "TEMP B-TREE" not in plan, plan
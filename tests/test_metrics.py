@@ -0,0 +1,148 @@
+"""
+Tests for the metrics of the ingest pipeline and their sinks
+"""
+import logging
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from sensors.db_streamer import Streamer
+from sensors.metrics import (Histogram, IngestMetrics, LogSummarySink, MetricsRegistry, PrometheusHttpSink,
+                             watch_connections, watch_overload)
+from sensors.mqtt_comms import MqttComms
+from sensors.overload import OverloadStats
+from tests.db_helpers import make_session_factory
+
+test_data_path = Path("./testdata/messages.txt")
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+
+def test_render():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests\nby path", ("path",))
+    requests.labels("/a").inc()
+    requests.labels('say "hi"').inc(2)
+    # Asking again gets the same one
+    assert registry.counter("requests_total", "Requests", ("path",)) is requests
+    with pytest.raises(ValueError):
+        registry.histogram("requests_total", "Not a counter")
+    with pytest.raises(ValueError):
+        requests.labels("/a", "extra")
+    seconds = registry.histogram("seconds", "Time taken", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        seconds.labels().observe(value)
+    registry.function("depth", "Queue depth", lambda: 3)
+    text = registry.render()
+    assert "# HELP requests_total Requests\\nby path\n# TYPE requests_total counter\n" in text
+    assert 'requests_total{path="/a"} 1\n' in text
+    assert 'requests_total{path="say \\"hi\\""} 2\n' in text
+    # The buckets are cumulative
+    assert 'seconds_bucket{le="0.1"} 1\nseconds_bucket{le="1"} 3\nseconds_bucket{le="+Inf"} 4\n' in text
+    assert "seconds_sum 6.05\nseconds_count 4\n" in text
+    assert "# TYPE depth gauge\ndepth 3\n" in text
+
+
+def test_histogram_quantile():
+    histogram = Histogram((1, 2, 3))
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 2.5):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == 3
+    histogram.observe(10)
+    assert histogram.quantile(0.99) == float("inf")
+
+
+@pytest.mark.parametrize("batch_size", [0, 25])
+def test_streamer_metrics(tmp_path, batch_size):
+    # A file, the batches are written on the writer thread
+    _, Session = make_session_factory(tmp_path)
+    registry = MetricsRegistry()
+    metrics = IngestMetrics(registry, sample_every=1)
+    streamer = Streamer(Session, batch_size=batch_size, dedup_window=32, metrics=metrics)
+    lines = test_data_path.read_bytes().splitlines()
+    for line in lines:
+        streamer.on_message(topic, line)
+    streamer.on_message(topic, b"not json")
+    streamer.close()
+
+    messages = {values[0]: child.value for values, child in metrics.messages.children()}
+    assert sum(messages.values()) == len(lines)
+    assert set(messages) <= {"UPLINK", "SUPERVISORY", "LINK_QUALITY", "OTHER"}
+    duplicates = metrics.duplicates.labels().value
+    assert duplicates > 0
+    stored = metrics.stored.labels().value
+    assert stored + duplicates == sum(messages.values()) - messages.get("OTHER", 0)
+    assert metrics.errors.labels("parse").value == 1
+    # Every message and batch was timed
+    for values, histogram in metrics.parse_seconds.children():
+        assert histogram.count == messages[values[1]]
+    batches = metrics.batch_size.labels().count
+    assert stored <= metrics.batch_size.labels().sum <= stored + duplicates
+    for stage in ("sensor_lookup", "orm_flush", "commit"):
+        assert metrics.store_seconds.labels(stage).count == batches
+
+
+def test_sampling():
+    metrics = IngestMetrics(MetricsRegistry(), sample_every=10)
+    assert sum(metrics.sample_parse() for _ in range(100)) == 10
+    assert sum(metrics.sample_store() for _ in range(100)) == 10
+    with pytest.raises(ValueError):
+        IngestMetrics(MetricsRegistry(), sample_every=0)
+
+
+def test_connection_and_overload():
+    registry = MetricsRegistry()
+    comms = MqttComms(cert_path=None, username="app", password="key", hostname="localhost", port=0,
+                      client_id="test-metrics")
+    watch_connections(registry, lambda: {"default": comms.health})
+    message = mqtt.MQTTMessage(topic=topic.encode())
+    message.payload = b"{}"
+    comms.on_message(comms.client, None, message)
+    comms.on_disconnect(comms.client, None, mqtt.MQTT_ERR_CONN_LOST)
+    stats = OverloadStats(depth=3, max_depth=7, received=10, delivered=5, dropped_supervisory=1,
+                          dropped_measurements=0, spilled=1, spill_pending_bytes=100, overloads=1,
+                          paused_seconds=0.5, overloaded=True)
+    watch_overload(registry, lambda: stats)
+    text = registry.render()
+    assert 'mqtt_connected{connection="default"} 0\n' in text
+    assert 'mqtt_messages_received_total{connection="default"} 1\n' in text
+    assert 'mqtt_disconnects_total{connection="default"} 1\n' in text
+    assert comms.health.state == "waiting"
+    assert comms.health.last_error
+    assert "overload_queue_depth 3\n" in text
+    assert "overload_active 1\n" in text
+    assert 'overload_dropped_total{kind="supervisory"} 1\n' in text
+
+
+def test_sinks(caplog):
+    registry = MetricsRegistry()
+    registry.counter("messages_total", "Messages").labels().inc(5)
+    registry.histogram("seconds", "Time taken").labels().observe(0.003)
+
+    def broken():
+        raise RuntimeError("not now")
+
+    registry.function("broken", "Fails", broken)
+    sink = PrometheusHttpSink(registry, port=0)
+    sink.start()
+    try:
+        with urllib.request.urlopen(f"http://localhost:{sink.port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            text = response.read().decode()
+        assert "messages_total 5\n" in text
+        assert "broken" not in text
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://localhost:{sink.port}/")
+    finally:
+        sink.close()
+
+    log_sink = LogSummarySink(registry, interval_seconds=3600)
+    log_sink.start()
+    with caplog.at_level(logging.INFO, logger="lora.mqtt"):
+        log_sink.close()
+    assert "messages_total: 5" in caplog.text
+    assert "seconds: 1 observed, mean 0.003, p50 <= 0.005, p99 <= 0.005" in caplog.text
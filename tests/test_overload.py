@@ -0,0 +1,146 @@
+"""
+Tests for the bounded hand-off between the MQTT thread and the listener
+"""
+import threading
+from pathlib import Path
+
+import pytest
+
+from sensors.mqtt_comms import SensorListener
+from sensors.overload import OverloadGuard, is_measurement
+
+test_data_path = Path("./testdata/messages.txt")
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+
+class GatedListener(SensorListener):
+    """
+    Stores nothing until the gate is opened, like a listener waiting on a locked database
+    """
+
+    def __init__(self):
+        self.received = []
+        self.gate = threading.Event()
+        self.closed = False
+
+    def on_message(self, topic: bytes, payload: bytes):
+        self.gate.wait()
+        self.received.append(payload)
+
+    def on_disconnect(self, reason: str):
+        pass
+
+    def on_connection_event(self, reason: str, level: int = 0) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def numbered(count: int):
+    return [str(x).encode() for x in range(count)]
+
+
+def test_arguments(tmp_path):
+    with pytest.raises(ValueError):
+        OverloadGuard(GatedListener(), policy="shrug")
+    with pytest.raises(ValueError):
+        OverloadGuard(GatedListener(), high_watermark=10, low_watermark=10)
+    with pytest.raises(ValueError):
+        OverloadGuard(GatedListener(), policy="spill")
+
+
+def test_pause():
+    listener = GatedListener()
+    guard = OverloadGuard(listener, policy="pause", high_watermark=5, low_watermark=2, max_pause_seconds=10)
+    # Few enough that after draining to the low watermark the rest can't reach the high one again
+    messages = numbered(8)
+    sender = threading.Thread(target=lambda: [guard.on_message(topic, x) for x in messages])
+    sender.start()
+    sender.join(0.3)
+    # Held up at the high watermark
+    assert sender.is_alive()
+    stats = guard.stats()
+    assert stats.overloaded
+    assert stats.max_depth == 5
+    listener.gate.set()
+    sender.join(5)
+    assert not sender.is_alive()
+    guard.flush()
+    assert listener.received == messages
+    stats = guard.stats()
+    assert stats.delivered == 8
+    assert stats.overloads == 1
+    assert stats.paused_seconds > 0.2
+    assert not stats.overloaded
+    guard.close()
+    guard.close()
+    assert listener.closed
+
+
+def test_drop_supervisory():
+    listener = GatedListener()
+    guard = OverloadGuard(listener, policy="drop-supervisory", high_watermark=20, low_watermark=5, max_size=100)
+    lines = test_data_path.read_bytes().splitlines()
+    for line in lines:
+        guard.on_message(topic, line)
+    stats = guard.stats()
+    assert stats.dropped_supervisory > 0
+    assert stats.dropped_measurements > 0
+    assert stats.depth == 100
+    listener.gate.set()
+    guard.close()
+    # Only measurements were queued after the high watermark, in the order they arrived
+    # As well as the one the listener was holding
+    assert 100 <= len(listener.received) <= 101
+    assert all(is_measurement(x) for x in listener.received[22:])
+    assert listener.received == [x for x in lines if x in set(listener.received)]
+    stats = guard.stats()
+    assert stats.received == stats.delivered + stats.dropped_supervisory + stats.dropped_measurements
+
+
+def test_spill(tmp_path):
+    listener = GatedListener()
+    guard = OverloadGuard(listener, policy="spill", high_watermark=5, low_watermark=2, spill_folder=tmp_path)
+    messages = numbered(50)
+    for message in messages:
+        guard.on_message(topic, message)
+    stats = guard.stats()
+    assert stats.spilled >= 44
+    assert stats.spill_pending_bytes > 0
+    listener.gate.set()
+    guard.flush()
+    assert listener.received == messages
+    stats = guard.stats()
+    assert stats.delivered == 50
+    assert stats.spill_pending_bytes == 0
+    # Once drained, back to the queue
+    guard.on_message(topic, b"after")
+    guard.flush()
+    assert guard.stats().spilled == stats.spilled
+    guard.close()
+
+
+def test_spill_left_for_restart(tmp_path):
+    listener = GatedListener()
+    guard = OverloadGuard(listener, policy="spill", high_watermark=5, low_watermark=2, spill_folder=tmp_path)
+    messages = numbered(30)
+    for message in messages:
+        guard.on_message(topic, message)
+    # Closed while the listener is held up, so the spilled messages are not handed over
+    closer = threading.Thread(target=guard.close)
+    closer.start()
+    while not guard._closed:
+        closer.join(0.01)
+    listener.gate.set()
+    closer.join(5)
+    assert listener.closed
+    assert guard.stats().spill_pending_bytes > 0
+    assert len(listener.received) < 30
+
+    again = GatedListener()
+    again.gate.set()
+    guard = OverloadGuard(again, policy="spill", high_watermark=5, low_watermark=2, spill_folder=tmp_path)
+    guard.flush()
+    assert listener.received + again.received == messages
+    guard.close()
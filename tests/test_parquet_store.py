@@ -0,0 +1,119 @@
+"""
+Tests for exporting the events to Parquet files and reading them back
+"""
+from pathlib import Path
+
+import pytest
+
+from models.models import Supervisory
+from sensors.db_streamer import Streamer
+from sensors.gap_analysis import find_gaps
+from sensors.rollups import rebuild_rollups
+from tests.db_helpers import make_session_factory
+from utils.date_time_utils import parseiso8601
+
+pytest.importorskip("pandas")
+ds = pytest.importorskip("pyarrow.dataset")
+from sensors import measurement_loader  # noqa: E402
+from sensors import parquet_store  # noqa: E402
+
+test_data_path = Path("./testdata/messages.txt")
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+
+def store_lines(tmp_path, lines):
+    engine, Session = make_session_factory(tmp_path)
+    streamer = Streamer(Session)
+    for line in lines:
+        streamer.on_message(topic, line)
+    streamer.close()
+    return engine, Session
+
+
+def test_export_and_load(tmp_path):
+    engine, Session = store_lines(tmp_path, test_data_path.read_bytes().splitlines())
+    root = tmp_path / "parquet"
+    report = parquet_store.export_events(engine, root, chunk_size=50)
+    assert report.events == 309
+    assert report.files > 0
+    assert (root / "type=measurement" / "sensor_id=CCC0790000EE4ED9").is_dir()
+    assert parquet_store.read_state(root)['last_event_id'] == report.last_event_id
+
+    expected = measurement_loader.load_measurements(engine)
+    df = parquet_store.load_measurements(root)
+    assert list(df.columns) == list(expected.columns)
+    assert str(df['sensor_id'].dtype) == 'category'
+    assert list(df['sensor_id'].astype(str)) == list(expected['sensor_id'].astype(str))
+    assert (df['timestamp'] == expected['timestamp']).all()
+    assert list(df['temp_c']) == list(expected['temp_c'])
+    assert list(df['humidity_percent']) == list(expected['humidity_percent'])
+
+    start = parseiso8601("2020-10-25T00:00:00Z")
+    end = parseiso8601("2020-10-26T00:00:00Z")
+    window = parquet_store.load_measurements(root, sensor_ids=["CCC0790000EE4ED9"], start=start, end=end)
+    expected = measurement_loader.load_measurements(engine, sensor_ids=["CCC0790000EE4ED9"], start=start, end=end)
+    assert 0 < len(window) == len(expected)
+    assert parquet_store.measurement_time_range(root) == measurement_loader.measurement_time_range(engine)
+    assert [x.device_id for x in parquet_store.load_sensors(root)] == ["CCC0790000EE4ED9", "CCC0790000EE521A",
+                                                                        "CCC0790000EE526B"]
+
+
+def test_supervisory_decoded(tmp_path):
+    engine, Session = store_lines(tmp_path, test_data_path.read_bytes().splitlines())
+    root = tmp_path / "parquet"
+    parquet_store.export_events(engine, root)
+    dataset = ds.dataset(root / "type=supervisory", format="parquet",
+                         schema=parquet_store.file_schema(parquet_store.SUPERVISORY_TYPE))
+    table = dataset.to_table()
+    session = Session()
+    try:
+        assert table.num_rows == session.query(Supervisory).count()
+    finally:
+        session.close()
+    assert table.num_rows > 0
+    assert table['batlevel'].null_count == 0
+    assert table['errorcodes'].null_count == 0
+
+
+def test_incremental_export(tmp_path):
+    lines = test_data_path.read_bytes().splitlines()
+    engine, Session = store_lines(tmp_path, lines[:200])
+    root = tmp_path / "parquet"
+    first = parquet_store.export_events(engine, root)
+    assert first.events == 200
+    assert parquet_store.export_events(engine, root).events == 0
+
+    streamer = Streamer(Session)
+    for line in lines[200:]:
+        streamer.on_message(topic, line)
+    streamer.close()
+    second = parquet_store.export_events(engine, root)
+    assert second.events == 109
+    assert second.last_event_id > first.last_event_id
+    assert len(parquet_store.load_measurements(root)) == len(measurement_loader.load_measurements(engine))
+
+
+@pytest.mark.parametrize("exclude_supervisory", [False, True])
+def test_find_gaps(tmp_path, exclude_supervisory):
+    engine, Session = store_lines(tmp_path, test_data_path.read_bytes().splitlines())
+    root = tmp_path / "parquet"
+    parquet_store.export_events(engine, root)
+    expected = find_gaps(engine, exclude_supervisory=exclude_supervisory)
+    reports = parquet_store.find_gaps(root, exclude_supervisory=exclude_supervisory)
+    assert reports == expected
+    assert sum(len(x.gaps) for x in reports) > 0
+
+
+def test_summarise_measurements(tmp_path):
+    engine, Session = store_lines(tmp_path, test_data_path.read_bytes().splitlines())
+    rebuild_rollups(engine)
+    root = tmp_path / "parquet"
+    parquet_store.export_events(engine, root)
+    hourly = parquet_store.summarise_measurements(parquet_store.load_measurements(root), 3600)
+    expected = measurement_loader.load_rollups(engine, 3600)
+    assert list(hourly.columns) == list(expected.columns)
+    assert list(hourly['sensor_id'].astype(str)) == list(expected['sensor_id'].astype(str))
+    assert (hourly['timestamp'] == expected['timestamp']).all()
+    assert list(hourly['count']) == list(expected['count'])
+    assert list(hourly['temp_mean']) == pytest.approx(list(expected['temp_mean']))
+    assert list(hourly['humidity_max']) == list(expected['humidity_max'])
@@ -0,0 +1,78 @@
+"""
+Tests for the Python port of the TTN payload decoder
+"""
+from pathlib import Path
+
+import pytest
+
+from sensors.payload_decoder import decode_payload_raw, decode_payloads_bulk, decode_payload
+from sensors.db_streamer import record_from_uplink
+from sensors.uplink_decoder import json_loads, payloads_from_messages, Uplink
+
+
+def load_messages():
+    test_data_path = Path("./testdata/messages.txt")
+    return test_data_path.read_bytes().splitlines()
+
+
+def test_same_as_ttn_decoder():
+    # The payload_fields in the test data were made by the TTN decoder
+    for payload in load_messages():
+        msg = json_loads(payload)
+        decoded = decode_payload_raw(msg['payload_raw'])
+        for key, value in msg['payload_fields'].items():
+            if isinstance(value, float):
+                assert decoded[key] == pytest.approx(value)
+            else:
+                assert decoded[key] == value
+
+
+def test_negative_temperature():
+    decoded = decode_payload(bytes([0x17, 0x0D, 0x00, 0x85, 0x20, 0x30]))
+    assert decoded['temp_c'] == pytest.approx(-5.2)
+    assert decoded['humidity_percent'] == pytest.approx(48.2)
+
+
+def test_short_payload():
+    # Empty, only the first header byte, and an uplink cut off before the humidity
+    for data in [b"", bytes([0x17]), bytes([0x17, 0x0D, 0x00, 0x85, 0x20])]:
+        decoded = decode_payload(data)
+        assert decoded == {'msgdesc': "UNKNOWN", 'event_type': f"Short payload of {len(data)} bytes"}
+    # The message types with no body only need the header
+    assert decode_payload(bytes([0x17, 0x00]))['msgdesc'] == "RESET"
+    # Such a message is not stored
+    msg = json_loads(load_messages()[0])
+    del msg['payload_fields']
+    msg['payload_raw'] = "Fw0AhSA="
+    assert Uplink(msg).payload_fields.msgtype is None
+    assert record_from_uplink(Uplink(msg), b"") is None
+
+
+def test_bulk_short_payload():
+    np = pytest.importorskip("numpy")
+    columns = decode_payloads_bulk(["", "Fw==", "Fw0AhSA=", "Fw0AhSAw", "FwA="])
+    assert list(columns['msgtype']) == [-1, -1, -1, 13, 0]
+    assert list(columns['sensor_event_type']) == [-1, -1, -1, 0, -1]
+    assert list(columns['version']) == [-1, -1, -1, 1, 1]
+    assert np.isnan(columns['temp_c'][:3]).all()
+    assert columns['temp_c'][3] == pytest.approx(-5.2)
+
+
+def test_bulk_same_as_single():
+    np = pytest.importorskip("numpy")
+    messages = load_messages()
+    payloads = payloads_from_messages(messages)
+    columns = decode_payloads_bulk(payloads)
+    assert len(columns['msgtype']) == len(messages)
+    for index, payload in enumerate(payloads):
+        decoded = decode_payload_raw(payload)
+        assert columns['msgtype'][index] == decoded['msgtype']
+        if 'temp_c' in decoded:
+            assert columns['temp_c'][index] == pytest.approx(decoded['temp_c'])
+            assert columns['humidity_percent'][index] == pytest.approx(decoded['humidity_percent'])
+            assert columns['sensor_event_type'][index] == decoded['sensor_event_type']
+        else:
+            assert np.isnan(columns['temp_c'][index])
+        if 'batlevel' in decoded:
+            assert columns['batlevel'][index] == pytest.approx(decoded['batlevel'])
+            assert columns['errorcodes'][index] == decoded['errorcodes']
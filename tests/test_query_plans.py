@@ -0,0 +1,90 @@
+"""
+Checks that the queries made by the analysis tools use the indexes on the event table
+rather than scanning it. Uses SQLite's EXPLAIN QUERY PLAN.
+"""
+from sqlalchemy import create_engine, inspect, Table, MetaData, Column, Integer, String, LargeBinary, Float
+
+from models.migrations import upgrade_schema
+from models.models import Sensor
+from sensors.gap_analysis import new_events_query, window_gap_query
+from sensors.measurement_loader import measurement_query
+from tests.db_helpers import make_session_factory, query_plan, assert_uses_index
+from utils.date_time_utils import parseiso8601
+
+
+def make_session():
+    engine, Session = make_session_factory()
+    session = Session()
+    sensor = Sensor(device_id="CCC0790000EE4ED9", device_name="sky-bar-main-room-temp")
+    session.add(sensor)
+    session.commit()
+    return engine, session, sensor
+
+
+def test_validity_query_uses_counter_index():
+    engine, session, sensor = make_session()
+    try:
+        # The window query made by gap_analysis for th_event_validity_main
+        plan = query_plan(engine, window_gap_query([sensor.device_id], exclude_supervisory=False))
+        assert_uses_index(plan, "ix_event_sensor_counter")
+    finally:
+        session.close()
+
+
+def test_checkpoint_query_reads_only_new_events():
+    engine, session, sensor = make_session()
+    try:
+        # Enough history for ANALYZE to have something to go on
+        engine.execute("INSERT INTO event (type, timestamp, counter, raw_message, sensor_id) "
+                       "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 2000) "
+                       f"SELECT 'measurement', x, x, x'7b7d', '{sensor.device_id}' FROM n")
+        engine.execute("ANALYZE")
+        # As in update_checkpoints, a range of ids is searched rather than the sensor's whole
+        # history, either through ix_event_sensor_id or the primary key when the range is short
+        for last_event_id in (0, 1000, 1990):
+            plan = query_plan(engine, new_events_query(sensor.device_id, last_event_id))
+            assert plan.startswith("SEARCH event"), plan
+            assert "rowid>?" in plan or "id>?" in plan, plan
+            assert "ix_event_sensor_counter" not in plan, plan
+    finally:
+        session.close()
+
+
+def test_visualize_query_uses_type_index():
+    engine, session, sensor = make_session()
+    try:
+        # As in th_visualize, for one sensor and for all of them
+        start = parseiso8601("2020-10-01T00:00:00Z")
+        plan = query_plan(engine, measurement_query([sensor.device_id], start=start))
+        assert_uses_index(plan, "ix_event_sensor_type_timestamp")
+        assert "TEMP B-TREE" not in plan, plan
+        plan = query_plan(engine, measurement_query())
+        assert_uses_index(plan, "ix_event_sensor_type_timestamp")
+    finally:
+        session.close()
+
+
+def test_upgrade_adds_indexes_to_existing_database():
+    engine = create_engine('sqlite:///:memory:')
+    # The event table as it was made before the indexes were added
+    old_metadata = MetaData()
+    Table('event', old_metadata,
+          Column('id', Integer, primary_key=True),
+          Column('type', String(32)),
+          Column('timestamp', Integer, nullable=False),
+          Column('counter', Integer, nullable=False),
+          Column('raw_message', LargeBinary, nullable=False),
+          Column('sensor_id', String(16)),
+          Column('temp_c', Float),
+          Column('humidity_percent', Float))
+    old_metadata.create_all(engine)
+    assert inspect(engine).get_indexes('event') == []
+
+    upgrade_schema(engine)
+    names = {x['name'] for x in inspect(engine).get_indexes('event')}
+    assert names == {'ix_event_sensor_type_timestamp', 'ix_event_sensor_counter', 'ux_event_sensor_counter_bucket',
+                     'ix_event_sensor_id'}
+    columns = {x['name'] for x in inspect(engine).get_columns('event')}
+    assert {'retry_count', 'best_rssi', 'best_snr', 'time_bucket'} <= columns
+    # Running it again does nothing
+    upgrade_schema(engine)
@@ -0,0 +1,94 @@
+"""
+Tests for the replay of message archives
+"""
+import gzip
+import shutil
+from pathlib import Path
+
+import pytest
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from models.models import LoraEvent, TempHumidityMeasurement, Sensor, ReplayProgress, MeasurementRollup
+from sensors.replay import Replayer
+from tests.db_helpers import make_engine
+
+test_data_path = Path("./testdata/messages.txt")
+# The test data has 309 messages, 79 of them copies of another with the same counter
+EXPECTED_UNIQUE_COUNT = 230
+EXPECTED_COPY_COUNT = 79
+
+
+def check_stored(engine, expected_count: int = EXPECTED_UNIQUE_COUNT, expected_copies: int = EXPECTED_COPY_COUNT):
+    session = sessionmaker(bind=engine)()
+    try:
+        assert session.query(LoraEvent).count() == expected_count
+        assert session.query(Sensor).count() == 3
+        assert (session.query(func.sum(LoraEvent.retry_count)).scalar() or 0) == expected_copies
+        event = session.query(LoraEvent).filter_by(sensor_id="CCC0790000EE4ED9", counter=990).first()
+        assert event.raw_message.startswith(b'{')
+    finally:
+        session.close()
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_replay(tmp_path, workers):
+    engine = make_engine(tmp_path, upgrade=True)
+    report = Replayer(engine, workers=workers, chunk_lines=40).replay(test_data_path)
+    assert report.lines == 309
+    assert report.events == EXPECTED_UNIQUE_COUNT
+    assert report.duplicates == EXPECTED_COPY_COUNT
+    assert report.bad_lines == 0
+    check_stored(engine)
+
+
+def test_replay_every_copy(tmp_path):
+    engine = make_engine(tmp_path, upgrade=True)
+    Replayer(engine, workers=0, dedup_window=0).replay(test_data_path)
+    check_stored(engine, expected_count=309, expected_copies=0)
+
+
+def test_interrupted_replay_carries_on(tmp_path, monkeypatch):
+    archive = tmp_path / "messages.txt.gz"
+    with open(test_data_path, "rb") as reader, gzip.open(archive, "wb") as writer:
+        shutil.copyfileobj(reader, writer)
+    engine = make_engine(tmp_path, upgrade=True)
+    replayer = Replayer(engine, workers=0, chunk_lines=50, maintain_rollups=True)
+    store = replayer._store
+    calls = []
+
+    def failing_store(*args):
+        calls.append(1)
+        if len(calls) == 4:
+            raise KeyboardInterrupt()
+        return store(*args)
+
+    monkeypatch.setattr(replayer, "_store", failing_store)
+    with pytest.raises(KeyboardInterrupt):
+        replayer.replay(archive)
+    session = sessionmaker(bind=engine)()
+    try:
+        assert session.query(ReplayProgress).one().lines == 150
+    finally:
+        session.close()
+
+    # A new run, as after a restart, with an empty dedup window
+    report = Replayer(engine, workers=0, chunk_lines=50, maintain_rollups=True).replay(archive)
+    assert report.resumed_at == 150
+    assert report.lines == 309 - 150
+    check_stored(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        rollup_count = session.query(func.sum(MeasurementRollup.count)) \
+            .filter(MeasurementRollup.resolution == 86400).scalar()
+        assert rollup_count == session.query(TempHumidityMeasurement).count()
+    finally:
+        session.close()
+
+    # Nothing more to do
+    assert Replayer(engine, workers=0).replay(archive).lines == 0
+    # Replaying it all again changes nothing, a replay is not a copy sent by the device
+    report = Replayer(engine, workers=0).replay(archive, restart=True)
+    assert report.events == 0
+    assert report.already_stored == EXPECTED_UNIQUE_COUNT
+    check_stored(engine)
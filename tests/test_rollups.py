@@ -0,0 +1,82 @@
+"""
+Tests for the measurement rollups
+"""
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+from models.models import MeasurementRollup, TempHumidityMeasurement
+from sensors.db_streamer import Streamer
+from sensors.rollups import rebuild_rollups, choose_resolution, RESOLUTIONS
+from tests.db_helpers import make_session_factory
+from utils.date_time_utils import parseiso8601
+
+
+def load_test_data(tmp_path, maintain_rollups, batch_size=0):
+    test_data_path = Path("./testdata/messages.txt")
+    topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+    engine, Session = make_session_factory(tmp_path)
+    streamer = Streamer(Session, batch_size=batch_size, maintain_rollups=maintain_rollups)
+    with open(test_data_path, "r") as reader:
+        for msg in reader:
+            streamer.on_message(topic, msg.encode("utf-8"))
+    streamer.close()
+    return engine, Session
+
+
+def rollup_values(Session):
+    session = Session()
+    try:
+        return {(x.sensor_id, x.resolution, x.bucket):
+                    (x.count, x.temp_min, x.temp_max, round(x.temp_sum, 6),
+                     x.humidity_min, x.humidity_max, round(x.humidity_sum, 6))
+                for x in session.query(MeasurementRollup)}
+    finally:
+        session.close()
+
+
+@pytest.mark.parametrize("batch_size", [0, 40])
+def test_streamed_rollups_same_as_rebuilt(tmp_path, batch_size):
+    engine, Session = load_test_data(tmp_path, maintain_rollups=True, batch_size=batch_size)
+    streamed = rollup_values(Session)
+    assert rebuild_rollups(engine) == len(streamed)
+    assert rollup_values(Session) == streamed
+
+    session = Session()
+    try:
+        measurement_count = session.query(TempHumidityMeasurement).count()
+        for resolution in RESOLUTIONS:
+            assert sum(count for (_, res, _), (count, *_) in streamed.items() if res == resolution) \
+                   == measurement_count
+    finally:
+        session.close()
+
+
+def test_rebuild_one_sensor(tmp_path):
+    engine, Session = load_test_data(tmp_path, maintain_rollups=False)
+    assert rollup_values(Session) == {}
+    rebuild_rollups(engine, sensor_ids=["CCC0790000EE4ED9"])
+    assert {sensor_id for sensor_id, _, _ in rollup_values(Session)} == {"CCC0790000EE4ED9"}
+
+
+def test_choose_resolution():
+    start = parseiso8601("2020-10-01T00:00:00Z")
+    assert choose_resolution(start, start + timedelta(days=1), 1600) is None
+    assert choose_resolution(start, start + timedelta(days=7), 1600) == 300
+    assert choose_resolution(start, start + timedelta(days=90), 1600) == 3600
+    assert choose_resolution(start, start + timedelta(days=5 * 365), 1600) == 86400
+
+
+def test_load_rollups(tmp_path):
+    pytest.importorskip("pandas")
+    from sensors.measurement_loader import load_rollups, load_measurements
+
+    engine, Session = load_test_data(tmp_path, maintain_rollups=True)
+    df = load_rollups(engine, 3600, sensor_ids=["CCC0790000EE4ED9"])
+    measurements = load_measurements(engine, sensor_ids=["CCC0790000EE4ED9"])
+    assert df['count'].sum() == len(measurements)
+    assert df['temp_min'].min() == measurements['temp_c'].min()
+    assert df['temp_max'].max() == measurements['temp_c'].max()
+    # The mean is a sum divided by a count so allow for rounding
+    assert (df['temp_min'] <= df['temp_mean'] + 1e-9).all() and (df['temp_mean'] <= df['temp_max'] + 1e-9).all()
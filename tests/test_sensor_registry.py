@@ -0,0 +1,61 @@
+"""
+Tests for the in-memory sensor registry
+"""
+from sqlalchemy import event
+
+from models.models import Sensor
+from sensors.db_streamer import Streamer
+from sensors.sensor_registry import SensorRegistry
+from tests.db_helpers import make_session_factory
+from tests.testdata import test_mixed_msgs
+
+
+def test_registry_warm_and_rename():
+    engine, Session = make_session_factory()
+    session = Session()
+    try:
+        session.add(Sensor(device_id="AAAA", device_name="old name"))
+        session.commit()
+    finally:
+        session.close()
+
+    registry = SensorRegistry(Session)
+    assert registry.warm() == 1
+    assert registry.get_name("AAAA") == "old name"
+
+    statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    # Known device with the same name, no database work at all
+    assert registry.ensure("AAAA", "old name") == "AAAA"
+    assert statements == []
+    # Renamed, updated once
+    registry.ensure("AAAA", "new name")
+    registry.ensure("AAAA", "new name")
+    assert len([x for x in statements if x.startswith("UPDATE")]) == 1
+    # New device
+    registry.ensure("BBBB", "another")
+    assert "BBBB" in registry
+
+    session = Session()
+    try:
+        assert session.query(Sensor).get("AAAA").device_name == "new name"
+        assert session.query(Sensor).get("BBBB").device_name == "another"
+    finally:
+        session.close()
+
+
+def test_streamer_does_not_query_known_sensors():
+    topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+    engine, Session = make_session_factory()
+    streamer = Streamer(Session)
+    for msg in test_mixed_msgs:
+        streamer.on_message(topic, msg)
+    assert len(streamer.registry) == 3
+
+    statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    for msg in test_mixed_msgs:
+        streamer.on_message(topic, msg)
+    assert not [x for x in statements if "FROM sensor" in x]
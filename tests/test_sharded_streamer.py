@@ -0,0 +1,72 @@
+"""
+Tests for storing the messages with worker processes
+"""
+from pathlib import Path
+
+import pytest
+
+from models.models import Sensor
+from sensors.db_streamer import Streamer
+from sensors.load_generator import TrafficGenerator
+from sensors.sharded_streamer import ShardedStreamer, shard_key, shard_of
+from sensors.uplink_decoder import decode_uplink
+from tests.db_helpers import make_session_factory, count_rows
+
+test_data_path = Path("./testdata/messages.txt")
+topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+
+
+def test_shard_key():
+    for _, message in TrafficGenerator(devices=5).messages(50):
+        assert shard_key(topic, message) == decode_uplink(message).hardware_serial.encode()
+    spaced = b'{"app_id": "a", "hardware_serial": "0004A30B001C0530", "counter": 1}'
+    assert shard_key(topic, spaced) == b"0004A30B001C0530"
+    assert shard_key(topic, b'{"app_id": "a"}') == topic.encode()
+    assert shard_key(topic, b'{"hardware_serial"') == topic.encode()
+    assert all(0 <= shard_of(str(x).encode(), 3) < 3 for x in range(100))
+
+
+def make_engine(tmp_path):
+    engine, Session = make_session_factory(tmp_path)
+    return str(engine.url), Session
+
+
+def test_sharded_streamer(tmp_path):
+    db_url, Session = make_engine(tmp_path)
+    streamer = ShardedStreamer(db_url, workers=3, batch_size=20, dedup_window=32)
+    messages = list(TrafficGenerator(devices=12, seed=5).messages(600))
+    for message_topic, message in messages:
+        streamer.on_message(message_topic, message)
+    streamer.flush()
+    assert sum(streamer.shard_counts) == 600
+    stored = count_rows(Session)
+    assert count_rows(Session, Sensor) == 12
+    streamer.close()
+    streamer.close()
+
+    # The same as one Streamer, each device's copies went to the same worker
+    (tmp_path / "expected").mkdir()
+    _, expected_Session = make_engine(tmp_path / "expected")
+    expected = Streamer(expected_Session, dedup_window=32)
+    for message_topic, message in messages:
+        expected.on_message(message_topic, message)
+    expected.close()
+    assert stored == count_rows(expected_Session)
+    assert stored < 600
+
+
+def test_sharded_streamer_test_data(tmp_path):
+    db_url, Session = make_engine(tmp_path)
+    streamer = ShardedStreamer(db_url, workers=2)
+    with open(test_data_path, "rb") as reader:
+        for line in reader:
+            streamer.on_message(topic, line)
+    streamer.close()
+    assert count_rows(Session) == 309
+
+
+def test_in_memory_database():
+    with pytest.raises(ValueError):
+        ShardedStreamer("sqlite:///:memory:", workers=2)
+    with pytest.raises(ValueError):
+        ShardedStreamer("sqlite://", workers=2)
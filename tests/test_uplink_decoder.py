@@ -0,0 +1,53 @@
+"""
+Tests for the TTN uplink decoder
+"""
+import json
+from pathlib import Path
+
+from sensors.db_streamer import customMeasurementDecoder
+from sensors.uplink_decoder import decode_uplink
+from tests.testdata import test_supervisory_msgs, test_humidity_change_msgs
+
+
+def test_decode_supervisory():
+    msg = decode_uplink(test_supervisory_msgs[0])
+    assert msg.hardware_serial == "CCC0790000EE4ED9"
+    assert msg.dev_id == "sky-bar-main-room-temp"
+    assert msg.counter == 264
+    assert msg.is_retry is False
+    assert msg.payload_fields.msgtype == 1
+    assert msg.payload_fields.batlevel == 3
+    assert msg.payload_fields.temp_c is None
+    assert msg.metadata.time == "2020-10-12T18:30:43.405029302Z"
+    assert msg.metadata.gateways[0].rssi == -29
+
+
+def test_decode_without_payload_fields():
+    # As sent when payload formatting is turned off in TTN
+    msg = decode_uplink(b'{"dev_id":"x","hardware_serial":"AB","counter":1,"payload_raw":"Fw0HFlAtIA==",'
+                        b'"metadata":{"time":"2020-10-12T19:10:25.328187286Z"}}')
+    assert msg.payload_raw == "Fw0HFlAtIA=="
+    assert msg.payload_fields.msgtype == 13
+    assert msg.payload_fields.sensor_event_type == 7
+    assert msg.payload_fields.temp_c == 22.5
+    assert msg.payload_fields.humidity_percent == 45.5
+    assert msg.metadata.gateways == []
+
+
+def test_same_as_namedtuple_decoder():
+    # Every message in the file should decode to the same values both ways
+    test_data_path = Path("./testdata/messages.txt")
+    msgs = test_humidity_change_msgs + test_data_path.read_bytes().splitlines()
+    for payload in msgs:
+        old = json.loads(payload, object_hook=customMeasurementDecoder)
+        new = decode_uplink(payload)
+        assert new.hardware_serial == old.hardware_serial
+        assert new.dev_id == old.dev_id
+        assert new.counter == old.counter
+        assert new.metadata.time == old.metadata.time
+        for key, value in old.payload_fields._asdict().items():
+            assert getattr(new.payload_fields, key) == value
+        for old_gw, new_gw in zip(old.metadata.gateways, new.metadata.gateways):
+            assert new_gw.gtw_id == old_gw.gtw_id
+            assert new_gw.rssi == old_gw.rssi
+            assert new_gw.snr == old_gw.snr
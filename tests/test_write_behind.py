@@ -0,0 +1,121 @@
+"""
+Tests for the write-behind (batched) mode of the Streamer
+"""
+import threading
+from pathlib import Path
+from time import monotonic, sleep
+from typing import List
+
+import pytest
+
+from models.models import TempHumidityMeasurement, Sensor, LoraEvent
+from sensors.batch_writer import BatchWriter
+from sensors.db_streamer import Streamer
+from tests.db_helpers import make_session_factory
+
+
+def test_batch_writer_flushes_on_size_and_close():
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=3, max_latency_seconds=60)
+    for item in range(7):
+        writer.put(item)
+    writer.close()
+    assert [len(x) for x in batches] == [3, 3, 1]
+    assert [x for batch in batches for x in batch] == list(range(7))
+
+
+def test_batch_writer_flushes_on_latency():
+    flushed = threading.Event()
+    batches = []
+
+    def flush_function(batch):
+        batches.append(batch)
+        flushed.set()
+
+    writer = BatchWriter(flush_function, batch_size=100, max_latency_seconds=0.05)
+    try:
+        writer.put("only one")
+        # Nowhere near the batch size, so only the deadline can cause this
+        assert flushed.wait(5)
+        assert batches == [["only one"]]
+    finally:
+        writer.close()
+
+
+def test_batch_writer_put_during_close():
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=50, max_latency_seconds=60)
+    queue_put = writer._queue.put
+    checked = threading.Event()
+
+    def slow_put(item, *args, **kwargs):
+        if item == "late":
+            # Held up after put() has checked that the writer is open, until close() starts
+            checked.set()
+            deadline = monotonic() + 5
+            while not writer._closed and monotonic() < deadline:
+                sleep(0.01)
+        queue_put(item, *args, **kwargs)
+
+    writer._queue.put = slow_put
+    producer = threading.Thread(target=writer.put, args=("late",))
+    producer.start()
+    assert checked.wait(5)
+    writer.close()
+    producer.join()
+    # The put that got in before the close is written, one after it is refused
+    assert batches == [["late"]]
+    with pytest.raises(RuntimeError):
+        writer.put("too late")
+    assert writer.flush()
+
+
+def test_batch_writer_tick():
+    flushed = threading.Event()
+    batches = []
+    ticks = []
+
+    def flush_function(batch):
+        batches.append(batch)
+        flushed.set()
+
+    def tick_function():
+        ticks.append(1)
+        if len(ticks) == 1:
+            raise RuntimeError("not yet")
+        return [f"tick {len(ticks)}"] if len(ticks) == 2 else []
+
+    writer = BatchWriter(flush_function, batch_size=100, max_latency_seconds=0.05,
+                         tick_function=tick_function, tick_seconds=0.02)
+    try:
+        # Nothing is put, the tick makes the items; one that fails is skipped
+        assert flushed.wait(5)
+        assert batches == [["tick 2"]]
+    finally:
+        writer.close()
+
+
+def test_write_behind_file_data(tmp_path):
+    # The writer thread has its own connection, so this needs a database file
+    # rather than an in-memory database
+    test_data_path = Path("./testdata/messages.txt")
+    topic = "skybar-sensors/devices/sky-bar-chill-room/up"
+    engine, Session = make_session_factory(tmp_path)
+    streamer = Streamer(Session, batch_size=50, max_latency_seconds=0.5)
+    expected_mixed_msg_count = 309
+    expected_measurement_count = 256
+    expected_sensor_count = 3
+
+    with open(test_data_path, "r") as reader:
+        for msg in reader:
+            streamer.on_message(topic, msg.encode("utf-8"))
+    streamer.close()
+
+    session = Session()
+    try:
+        all_events = session.query(LoraEvent).all()  # type: List[LoraEvent]
+        assert len(all_events) == expected_mixed_msg_count
+        assert session.query(TempHumidityMeasurement).count() == expected_measurement_count
+        assert session.query(Sensor).count() == expected_sensor_count
+    finally:
+        session.close()